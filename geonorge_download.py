@@ -1,18 +1,248 @@
 # standard python imports
+import os
 import re
+import json
 import time
 import random
+import shutil
+import struct
 import zipfile
+import itertools
+import threading
+import concurrent.futures
+from collections import Counter
 import logging
 logger = logging.getLogger('utility_to_osm.ssr2')
 
 # third party imports
+import requests
 from bs4 import BeautifulSoup
 
 # shared helper library
 import utility_to_osm.gentle_requests as gentle_requests
 
-def get_geonorge_url_dct(url='https://nedlasting.geonorge.no/geonorge/Basisdata/Stedsnavn/GML/'):
+# download statistics for this process, see get_cached_conditional
+statistics = Counter()
+_statistics_lock = threading.Lock()
+
+user_agent = 'ssr2_to_osm (https://github.com/osmno/ssr2_to_osm)'
+timeout = 600
+cache_age_days = 14         # a cached download is revalidated once it is older
+
+def count(key, value=1):
+    with _statistics_lock:
+        statistics[key] += value
+
+def meta_filename(filename):
+    return filename + '.meta.json'
+
+def read_meta(filename):
+    """The cache metadata for filename (url, etag, last_modified, size and checked), or None"""
+    try:
+        with open(meta_filename(filename), 'r') as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return None
+
+def write_meta(filename, meta):
+    with open(meta_filename(filename) + '.tmp', 'w') as f:
+        json.dump(meta, f, indent=1, sort_keys=True)
+    os.replace(meta_filename(filename) + '.tmp', meta_filename(filename))
+
+# retries of failed or invalid downloads, see configure_retries
+max_retries = 3
+retry_backoff = 2.          # seconds before the first retry, doubled for each retry
+retry_max_backoff = 120.
+retry_budget = None         # retries left for the whole run, a multiprocessing.Value shared by the processes, or None
+
+def configure_retries(retries=3, backoff=2., max_backoff=120., budget=None):
+    """Retry a failed (connection error, HTTP 429 or 5xx) or invalid download up to retries times,
+    waiting backoff*2**attempt seconds (at most max_backoff) with jitter.
+    budget is a multiprocessing.Value('i') with the number of retries allowed for the entire run."""
+    global max_retries, retry_backoff, retry_max_backoff, retry_budget
+    max_retries = retries
+    retry_backoff = backoff
+    retry_max_backoff = max_backoff
+    retry_budget = budget
+
+def take_retry(url, attempt, reason):
+    """Waits before the next attempt and returns True, or returns False if no more retries are allowed"""
+    if attempt >= max_retries:
+        logger.error('Giving up on %s after %s retries: %s', url, attempt, reason)
+        return False
+    if retry_budget is not None:
+        with retry_budget.get_lock():
+            if retry_budget.value <= 0:
+                logger.error('Retry budget for this run exhausted, giving up on %s: %s', url, reason)
+                count('http_retry_budget_exhausted')
+                return False
+            retry_budget.value -= 1
+
+    # exponential backoff with jitter, so that failed parallel downloads do not retry in lockstep
+    delay = min(retry_max_backoff, retry_backoff*2**attempt)*random.uniform(0.5, 1)
+    logger.warning('Retrying %s in %.1f s (retry %s of %s): %s', url, delay, attempt + 1, max_retries, reason)
+    count('http_retries')
+    count('http_retry_seconds', delay)
+    time.sleep(delay)
+    return True
+
+# the minimum time between the start of two requests, as utility_to_osm.gentle_requests, see configure_rate_limit
+min_request_interval = 0.5
+request_clock = None        # start of the latest request, a multiprocessing.Value('d') shared by the processes, or None
+_last_request = 0.
+_request_lock = threading.Lock()
+
+def configure_rate_limit(min_interval=0.5, clock=None):
+    """Start the requests at least min_interval seconds apart, across all threads of this process
+    and across the processes sharing clock, a multiprocessing.Value('d')"""
+    global min_request_interval, request_clock
+    min_request_interval = min_interval
+    request_clock = clock
+
+def wait_for_request():
+    """Waits until the next request may start, see configure_rate_limit"""
+    global _last_request
+    if min_request_interval <= 0:
+        return
+    lock = _request_lock if request_clock is None else request_clock.get_lock()
+    with lock:
+        last = _last_request if request_clock is None else request_clock.value
+        start = max(time.time(), last + min_request_interval)
+        if request_clock is None:
+            _last_request = start
+        else:
+            request_clock.value = start
+    delay = start - time.time()
+    if delay > 0:
+        count('http_rate_limit_seconds', delay)
+        time.sleep(delay)
+
+tail_size = 2**16 + 22      # the largest zip end of central directory record
+
+def expect_tail(expected):
+    """validate function for get_cached_conditional, requiring expected near the end of the download"""
+    def validate(tail, size):
+        if expected not in tail[-(len(expected) + 100):]:
+            return 'no %s at the end' % expected.decode('utf-8')
+        return None
+    return validate
+
+class InvalidDownload(Exception):
+    pass
+
+class DownloadFailed(IOError):
+    """A download that failed after the retries, unlike an empty result this fails the kommune"""
+    pass
+
+def validate_zip(tail, size):
+    """validate function for get_cached_conditional, requiring the zip end of central directory record,
+    with the central directory ending where the record starts"""
+    index = tail.rfind(b'PK\x05\x06')
+    if index == -1 or len(tail) - index < 22:
+        return 'no zip end of central directory'
+    directory_size, directory_offset = struct.unpack('<II', tail[index + 12:index + 20])
+    if directory_offset == 0xFFFFFFFF:
+        return None             # zip64, the offset is in the zip64 record
+    if directory_offset + directory_size != size - (len(tail) - index):
+        return 'truncated zip central directory'
+    return None
+
+def get_cached_conditional(url, filename, old_age_days=cache_age_days, conditional=True, validate=None, chunk_size=2**20):
+    """Download url to filename, unless filename was downloaded (or revalidated) less than old_age_days ago.
+    An older file is revalidated with a conditional request, using the ETag and Last-Modified of the previous download
+    (stored in <filename>.meta.json), and kept if the server answers 304 Not Modified.
+    Use conditional=False to download again regardless, e.g. for a broken file.
+    The download is checked as it is streamed, against the Content-Length and validate(tail, size),
+    returning None if valid or the problem, where tail is the last bytes, see expect_tail and validate_zip.
+    Only a complete and valid download replaces filename, failed or invalid downloads are retried, see configure_retries.
+    Returns filename, raises DownloadFailed once the retries (or the retry budget) are exhausted."""
+    meta = None
+    if os.path.exists(filename):
+        meta = read_meta(filename)
+        if meta is not None and meta.get('url') != url:
+            meta = None
+
+        checked = meta['checked'] if meta is not None else os.path.getmtime(filename)
+        age_days = (time.time() - checked)/(24*60*60)
+        invalid = None
+        if validate is not None:
+            invalid = validate(file_tail(filename, size=tail_size), os.path.getsize(filename))
+        if invalid is not None:
+            logger.error('Cached %s is invalid (%s), downloading again', filename, invalid)
+            conditional = False
+        elif age_days < old_age_days:
+            return filename
+
+    if not(conditional):
+        meta = None
+
+    for attempt in itertools.count():
+        try:
+            return download(url, filename, meta, validate=validate, chunk_size=chunk_size)
+        except (requests.RequestException, InvalidDownload) as e:
+            count('http_errors')
+            if os.path.exists(filename + '.part'):
+                os.remove(filename + '.part')
+            if isinstance(e, requests.HTTPError) and e.response.status_code != 429 and e.response.status_code < 500:
+                logger.error('Failed to download %s: %s', url, e)
+                raise DownloadFailed('Unable to download %s: %s' % (url, e)) from e
+            if not(take_retry(url, attempt, e)):
+                raise DownloadFailed('Unable to download %s after %s attempts: %s' % (url, attempt + 1, e)) from e
+
+def download(url, filename, meta, validate=None, chunk_size=2**20):
+    """A single attempt of get_cached_conditional, raises requests.RequestException or InvalidDownload"""
+    headers = {'User-Agent': user_agent}
+    if meta is not None:
+        if meta.get('etag'):
+            headers['If-None-Match'] = meta['etag']
+        if meta.get('last_modified'):
+            headers['If-Modified-Since'] = meta['last_modified']
+
+    wait_for_request()
+    with requests.get(url, headers=headers, stream=True, timeout=timeout) as r:
+        count('http_requests')
+        if r.status_code == 304 and len(headers) > 1:
+            logger.debug('Not modified %s, keeping %s', url, filename)
+            count('http_not_modified')
+            count('http_bytes_saved', os.path.getsize(filename))
+            meta['checked'] = time.time()
+            write_meta(filename, meta)
+            return filename
+        elif r.status_code != 200:
+            r.raise_for_status()
+            raise requests.HTTPError('HTTP %s' % r.status_code, response=r)
+
+        size = 0
+        tail = b''
+        with open(filename + '.part', 'wb') as f:
+            for chunk in r.iter_content(chunk_size):
+                f.write(chunk)
+                size += len(chunk)
+                tail = (tail + chunk)[-tail_size:]
+        count('http_bytes_downloaded', size)
+
+        # the length is of the encoded body, only comparable when the body is not compressed in transfer
+        expected_size = r.headers.get('Content-Length')
+        if expected_size is not None and 'Content-Encoding' not in r.headers and size != int(expected_size):
+            count('http_invalid_length')
+            raise InvalidDownload('got %s of %s bytes' % (size, expected_size))
+        if validate is not None:
+            invalid = validate(tail, size)
+            if invalid is not None:
+                count('http_invalid_content')
+                raise InvalidDownload(invalid)
+
+        os.replace(filename + '.part', filename)
+        write_meta(filename, {'url': url,
+                              'etag': r.headers.get('ETag'),
+                              'last_modified': r.headers.get('Last-Modified'),
+                              'size': size,
+                              'checked': time.time()})
+    return filename
+
+geonorge_base_url = 'https://nedlasting.geonorge.no/geonorge/Basisdata/Stedsnavn/GML/'
+
+def get_geonorge_url_dct(url=geonorge_base_url):
     '''
     Returns a dictionary with kommunenummer (as 4 character string) as key and the geonorge zip url as value
     {kommunenummer: url}
@@ -41,62 +271,209 @@ def get_geonorge_url_dct(url='https://nedlasting.geonorge.no/geonorge/Basisdata/
 
     return geonorge
 
+def get_geonorge_archive_url(url=geonorge_base_url):
+    '''
+    Returns the url of the national Basisdata_0000_Norge zip (skipped by get_geonorge_url_dct), or None
+    '''
+    req = gentle_requests.GentleRequests()
+    data = req.get(url)
+
+    soup = BeautifulSoup(data.content, 'lxml-xml')
+    for link in soup.find_all('a'):
+        href = link.get('href')
+        if re.match('Basisdata_0000_Norge_\d+_Stedsnavn_GML.zip', href):
+            return url + href
+    return None
+
 def unzip(zip_filename):
-    content = None
+    with open_unzip(zip_filename) as f:
+        return f.read()
+
+def open_unzip(zip_filename):
+    """Returns a binary file-like object for the single file in zip_filename,
+    decompressed as it is read"""
     with zipfile.ZipFile(zip_filename, 'r') as z:
         namelist = z.namelist()
         assert len(namelist) == 1, 'expected single file in zip, got %s' % z.namelist
 
-        for name in namelist:
-            with z.open(name, 'r') as f:
-                content = f.read()
-
-    return content
+        # NOTE: the opened member keeps the underlying file open after z is closed
+        return z.open(namelist[0], 'r')
 
 def download_unzip_geonorge(zip_url, zip_filename):
-    req = gentle_requests.GentleRequests()
-    
-    data = req.get_cached(zip_url, zip_filename, file_mode='b')
-    if data is None:
-        return None
+    f = download_unzip_geonorge_stream(zip_url, zip_filename)
+    with f:
+        return f.read()
 
-    # fixme: wrap data as a file-like object
-    try:
-        content = unzip(zip_filename)
-    except zipfile.BadZipFile as e:
-        # lets try again
-        logger.error('Bad zip file, trying again %s', e)
-        time.sleep(random.randrange(0, 15))
-        data = req.get_cached(zip_url, zip_filename, file_mode='b', old_age_days=0)
-        content = unzip(zip_filename)
-                    
-    return content
+def download_unzip_geonorge_stream(zip_url, zip_filename):
+    """Same as download_unzip_geonorge, but returns a binary file-like object for the
+    (cached) zip member instead of the entire decompressed content"""
+    get_cached_conditional(zip_url, zip_filename, validate=validate_zip)
+    return open_unzip(zip_filename)
+
+def file_tail(filename, size=100):
+    """Returns the last size bytes of filename"""
+    with open(filename, 'rb') as f:
+        f.seek(0, os.SEEK_END)
+        f.seek(max(0, f.tell() - size))
+        return f.read()
+
+wfs_base_url = 'http://wfs.geonorge.no/skwms1/wfs.stedsnavn50'
+
+def legacy_filter_url(value_reference, literal, base_url=None):
+    """WFS GetFeature url for all <Sted> where value_reference (e.g. app:kommune/app:Kommune/app:kommunenummer) equals literal,
+    use base_url to point to a different WFS, e.g. a local stand-in server for testing"""
+    if base_url is None:
+        base_url = wfs_base_url
+    url = '{base_url}?VERSION=2.0.0&SERVICE=WFS&srsName=EPSG:25832&REQUEST=GetFeature&TYPENAME=Sted&resultType=results&Filter=%3CFilter%3E%20%3CPropertyIsEqualTo%3E%20%3CValueReference%20xmlns:app=%22http://skjema.geonorge.no/SOSI/produktspesifikasjon/Stedsnavn/5.0%22%3E{value_reference}%3C/ValueReference%3E%20%3CLiteral%3E{literal}%3C/Literal%3E%20%3C/PropertyIsEqualTo%3E%20%3C/Filter%3E" --header "Content-Type:text/xml"'
+    return url.format(base_url=base_url, value_reference=value_reference, literal=literal)
+
+def legacy_url(kommunenummer, base_url=None):
+    return legacy_filter_url('app:kommune/app:Kommune/app:kommunenummer', kommunenummer, base_url=base_url)
+
+def legacy_land_url(land, base_url=None):
+    return legacy_filter_url('app:land/app:Land/app:landnummer', land, base_url=base_url)
 
 def legacy_download_geonorge(kommunenummer, xml_filename, url=None):
-    if url is None:
-        url = 'http://wfs.geonorge.no/skwms1/wfs.stedsnavn50?VERSION=2.0.0&SERVICE=WFS&srsName=EPSG:25832&REQUEST=GetFeature&TYPENAME=Sted&resultType=results&Filter=%3CFilter%3E%20%3CPropertyIsEqualTo%3E%20%3CValueReference%20xmlns:app=%22http://skjema.geonorge.no/SOSI/produktspesifikasjon/Stedsnavn/5.0%22%3Eapp:kommune/app:Kommune/app:kommunenummer%3C/ValueReference%3E%20%3CLiteral%3E{kommunenummer}%3C/Literal%3E%20%3C/PropertyIsEqualTo%3E%20%3C/Filter%3E" --header "Content-Type:text/xml"'
-        url = url.format(kommunenummer=kommunenummer)
-    
-    # get xml:
-    req = gentle_requests.GentleRequests()
-    d = req.get_cached(url, xml_filename)
+    f = legacy_download_geonorge_stream(kommunenummer, xml_filename, url=url)
+    with f:
+        d = f.read()
     try: d = d.decode('utf-8')
     except:pass
-    
-    ensure_contains = '</wfs:FeatureCollection>'
-    if ensure_contains not in d[-len(ensure_contains)-100:]:
-        logger.error('ERROR, no ending in %s? Trying to re-download "%s"',
-                     xml_filename, d[-len(ensure_contains)-100:-1])
-        time.sleep(random.randrange(0, 15))
-        d = req.get_cached(url, xml_filename, old_age_days=0.1)
-        try: d = d.decode('utf-8')
-        except:pass
-
-    if ensure_contains not in d[-len(ensure_contains)-100:]:
-        raise Exception("Still no file ending for %s" % (xml_filename))
-
     return d
 
+# the pages are sorted by stedsnummer, without a sort order the server may return the <Sted> in a different
+# order for each request, so that some are in two pages and others in none
+page_sort_by = 'NAMESPACES=xmlns(app,http://skjema.geonorge.no/SOSI/produktspesifikasjon/Stedsnavn/5.0)&sortBy=app:stedsnummer'
+
+def page_url(url, start_index, page_size):
+    """The GetFeature url with WFS 2.0 paging, for page_size <Sted> starting at start_index, see page_sort_by"""
+    if '&REQUEST=GetFeature' not in url:
+        raise ValueError('Expected a WFS GetFeature url, got %s' % url)
+    return url.replace('&REQUEST=GetFeature', '&REQUEST=GetFeature&%s&count=%d&startIndex=%d'
+                       % (page_sort_by, page_size, start_index), 1)
+
+feature_collection_end = b'</wfs:FeatureCollection>'
+
+def fetch_page(url, filename):
+    """Download (or read from cache) a single page, a failed or incomplete page is retried on its own"""
+    return get_cached_conditional(url, filename, validate=expect_tail(feature_collection_end))
+
+def page_header(filename, size=2**16):
+    """Returns (root start tag, numberMatched, length of the content before the first member) of a page,
+    the numberReturned, next and previous attributes are removed from the start tag.
+    numberMatched is None if the server did not count the matches."""
+    with open(filename, 'rb') as f:
+        head = f.read(size)
+    start = head.index(b'<wfs:FeatureCollection')
+    end = head.index(b'>', start) + 1
+    number_matched = re.search(rb'numberMatched="(\d+)"', head[start:end])
+    if number_matched is not None:
+        number_matched = int(number_matched.group(1))
+    header = re.sub(rb'\s(numberReturned|next|previous)="[^"]*"', b'', head[:end])
+    return header, number_matched, end
+
+def page_members(filename):
+    with open(filename, 'rb') as f:
+        data = f.read()
+    return data.count(b'<wfs:member>') + data.count(b'<wfs:member ')
+
+def check_pages(filenames, number_matched):
+    """Returns None if the pages are consistent, each with the numberMatched of the first page and together
+    with numberMatched members, otherwise the problem"""
+    if number_matched is None:
+        return None
+    for filename in filenames[1:]:
+        _, page_number_matched, _ = page_header(filename)
+        if page_number_matched != number_matched:
+            return 'numberMatched of %s is %s, the first page has %s' % (os.path.basename(filename),
+                                                                       page_number_matched, number_matched)
+    members = sum(map(page_members, filenames))
+    if members != number_matched:
+        return 'expected %s <Sted> from %s pages, got %s' % (number_matched, len(filenames), members)
+    return None
+
+def merge_pages(filenames, xml_filename, chunk_size=2**20):
+    """Writes the members of all the pages to xml_filename, within the root element of the first page"""
+    header, _, _ = page_header(filenames[0])
+    with open(xml_filename + '.part', 'wb') as out:
+        out.write(header)
+        for filename in filenames:
+            _, _, start = page_header(filename)
+            tail = file_tail(filename, size=len(feature_collection_end)+100)
+            end = os.path.getsize(filename) - len(tail) + tail.rindex(feature_collection_end)
+            with open(filename, 'rb') as f:
+                f.seek(start)
+                remaining = end - start
+                while remaining > 0:
+                    chunk = f.read(min(chunk_size, remaining))
+                    out.write(chunk)
+                    remaining -= len(chunk)
+        out.write(feature_collection_end + b'\n')
+    os.replace(xml_filename + '.part', xml_filename)
+
+def download_pages(url, xml_filename, page_size, page_parallel=1, old_age_days=cache_age_days, attempts=2):
+    """Fetch the WFS GetFeature url in pages of page_size <Sted> (count and startIndex), with up to page_parallel
+    concurrent requests, merged into xml_filename. Each page is cached and retried on its own, in <xml_filename>-pages/,
+    so that a failure only needs the missing pages to be downloaded again. The pages are removed once merged,
+    xml_filename is then kept for old_age_days (see get_cached_conditional).
+    Pages that do not add up (see check_pages), e.g. when the data changed while paging, are all fetched again,
+    raises DownloadFailed if they still do not add up after the given number of attempts."""
+    meta = read_meta(xml_filename)
+    if os.path.exists(xml_filename) and meta is not None and meta.get('url') == url:
+        if (time.time() - meta['checked'])/(24*60*60) < old_age_days:
+            return
+
+    folder = os.path.splitext(xml_filename)[0] + '-pages'
+
+    def fetch(start_index):
+        return fetch_page(page_url(url, start_index, page_size), os.path.join(folder, '%09d.xml' % start_index))
+
+    for attempt in range(attempts):
+        if not(os.path.exists(folder)):
+            os.makedirs(folder)
+
+        filenames = [fetch(0)]
+        _, number_matched, _ = page_header(filenames[0])
+        if number_matched is None:
+            # unknown number of pages, continue until a page is not full
+            while page_members(filenames[-1]) == page_size:
+                filenames.append(fetch(len(filenames)*page_size))
+        elif number_matched > page_size:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=page_parallel) as executor:
+                filenames.extend(executor.map(fetch, range(page_size, number_matched, page_size)))
+
+        problem = check_pages(filenames, number_matched)
+        if problem is None:
+            break
+        # the cached pages are removed, so that all of them are downloaded again
+        count('http_page_refetch')
+        logger.warning('Pages of %s do not add up, %s, did the data change while paging?', url, problem)
+        shutil.rmtree(folder)
+    else:
+        raise DownloadFailed('Pages of %s do not add up after %s attempts, %s' % (url, attempts, problem))
+
+    merge_pages(filenames, xml_filename)
+    write_meta(xml_filename, {'url': url,
+                              'pages': len(filenames),
+                              'size': os.path.getsize(xml_filename),
+                              'checked': time.time()})
+    shutil.rmtree(folder)
+
+def legacy_download_geonorge_stream(kommunenummer, xml_filename, url=None, base_url=None, page_size=0, page_parallel=1):
+    """Same as legacy_download_geonorge, but returns the cached xml_filename opened for binary reading,
+    the download is checked for the closing </wfs:FeatureCollection> as it is streamed.
+    Use page_size to fetch the <Sted> in pages, see download_pages."""
+    if url is None:
+        url = legacy_url(kommunenummer, base_url=base_url)
+
+    if page_size > 0:
+        download_pages(url, xml_filename, page_size, page_parallel=page_parallel)
+        return open(xml_filename, 'rb')
+    
+    # get xml, checking that the download is complete:
+    get_cached_conditional(url, xml_filename, validate=expect_tail(feature_collection_end))
+    return open(xml_filename, 'rb')
+
 if __name__ == '__main__':
     geonorge_urls = get_geonorge_url_dct()
     
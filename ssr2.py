@@ -1,25 +1,36 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 import os
+import io
 import re
+import zlib
+import gzip
+import zipfile
 import csv
 import json
 import glob
-import warnings
 import traceback
+import pickle
+import cProfile
+import itertools
+import multiprocessing
+import multiprocessing.pool
 from multiprocessing import Pool
 import signal
 import time
 import shutil
+import functools
 import codecs
 open = codecs.open
 import datetime
-from collections import defaultdict
+from array import array
+from collections import defaultdict, Counter, deque
 from pprint import pprint
 import logging
 logger = logging.getLogger('utility_to_osm.ssr2')
 
 from bs4 import BeautifulSoup
+from lxml import etree
 
 # Shared helper function import:
 import utility_to_osm
@@ -33,58 +44,103 @@ from utility_to_osm.csv_unicode import UnicodeWriter
 
 # third party:
 from utility_to_osm import osmapis
-import pyproj
 
 # This project
 import ssr2_split
 import ssr2_tags
+import ssr2_stream
+import ssr2_projection
+import ssr2_records
+import ssr2_writer
+import ssr2_schedule
+import ssr2_prefetch
+import ssr2_manifest
+import ssr2_sted_cache
+import ssr2_logging
+import ssr2_journal
+import ssr2_timing
+import ssr2_archive
+import ssr2_raw_store
 import geonorge_download
 
-def init_pool_worker():
+# read-only state shared by all jobs of a pool worker, see init_pool_worker and run_job
+pool_state = dict()
+
+def init_pool_worker(state=None):
     # https://stackoverflow.com/a/11312948
     signal.signal(signal.SIGINT, signal.SIG_IGN)
-
-def add_file_handler(filename='warnings.log'):
-    fh = logging.FileHandler(filename, mode='w')
-    #fh.setLevel(logging.WARNING)
-    fh.setLevel(logging.INFO)
-    fh.setFormatter(formatter)
-    logger.addHandler(fh)
-    return fh
-
-def parse_gml_point(point, epsg = 'EPSG:25832'):
-    # hack, translate urn:ogc:def:crs:EPSG::25832 into EPSG:25832
-    epsg = epsg.replace('::', ':')
-    sg_split = epsg.split(':')
-    if len(sg_split) != 2:
-        epsg = ':'.join(sg_split[-2:])
-        
-    with warnings.catch_warnings():
-        warnings.simplefilter(action='ignore', category=FutureWarning)
-        
-        #epsg = point['srsName']
-        #print('epsg', epsg)
-        projection = pyproj.Proj(init=epsg)#'epsg:%s' % srid)
-        #print 'POINT', point
-        utm33 = point # (lat, lon)
-        lon, lat = projection(utm33[0], utm33[1], inverse=True)
-
-        #gml_id = point['gml:id']
-    
-    return lon, lat#, gml_id
+    if state is not None:
+        pool_state.update(state)
+        if 'log_queue' in state:
+            ssr2_logging.install_queue_handler(state['log_queue'], state['log_level'])
+        if 'retry_budget' in state:
+            configure_downloads(state['args'], state['retry_budget'], state['request_clock'])
+
+class NonDaemonProcess(multiprocessing.get_context().Process):
+    """A pool worker that may start processes of its own, see NonDaemonPool"""
+    @property
+    def daemon(self):
+        return False
+
+    @daemon.setter
+    def daemon(self, value):
+        pass
+
+class NonDaemonContext(type(multiprocessing.get_context())):
+    Process = NonDaemonProcess
+
+class NonDaemonPool(multiprocessing.pool.Pool):
+    """The --parallel pool, its (non-daemonic) workers can transform a large kommune in chunks
+    across a pool of their own, see iter_transformed"""
+    def __init__(self, *args, **kwargs):
+        kwargs['context'] = NonDaemonContext()
+        super(NonDaemonPool, self).__init__(*args, **kwargs)
+
+def configure_downloads(args, retry_budget=None, request_clock=None):
+    """Download retries and rate limit for this process, retry_budget and request_clock are the
+    multiprocessing.Value shared by the run"""
+    geonorge_download.configure_retries(retries=args.max_retries, backoff=args.retry_backoff,
+                                        max_backoff=args.retry_max_backoff, budget=retry_budget)
+    geonorge_download.configure_rate_limit(min_interval=args.request_interval, clock=request_clock)
+
+def run_job(job, submit_time):
+    """Pool worker, runs main for the ssr2_schedule.Job using the args, conversion and geonorge_urls
+    given to init_pool_worker, so that only the job itself is sent for each job"""
+    start_time = time.time()
+    args = pool_state['args']
+    folder = os.path.join(args.output, job.n)
+    try:
+        statistics = main(args, folder, job.n, pool_state['conversion'], pool_state['geonorge_urls'], url=job.url)
+    except Exception as e:
+        # the exception is sent to the main process, where e.g. a lxml.etree.XMLSyntaxError
+        # can not be unpickled, hiding the actual error
+        try:
+            pickle.loads(pickle.dumps(e))
+        except Exception:
+            raise ValueError('%s: %s\n%s' % (type(e).__name__, e, traceback.format_exc())) from None
+        raise
+    statistics['dispatch_wait_seconds'] = start_time - submit_time
+    return statistics
+
+def dispatch_payload_size(*payload):
+    """Size in bytes of the pickled payload (args) for a pool job, and the time spent pickling it"""
+    start = time.perf_counter()
+    size = len(pickle.dumps(payload, protocol=pickle.HIGHEST_PROTOCOL))
+    return size, time.perf_counter() - start
 
 def parse_posList(soup):
-    posList = soup.find('posList').text.split() # 505308.28 6989000.89 505310.79 6988994.01 505296.69 6988916.41
-    
-    even, odd = posList[::2], posList[1::2] # (['505308.28', '505310.79', '505296.69'], ['6989000.89', '6988994.01', '6988916.41'])
-    assert len(even) == len(odd), 'expected pair of lat/lon, got %s/%s' % (even, odd)
-    
-    positions = list()
-    for ix in range(len(even)):
-        positions.append((even[ix], odd[ix]))
-
+    """Returns the x, y coordinates in <posList> as a flat array, e.g.
+    505308.28 6989000.89 505310.79 6988994.01 -> array('d', [505308.28, 6989000.89, 505310.79, 6988994.01])"""
+    positions = array('d', map(float, soup.find('posList').text.split()))
+    assert len(positions) % 2 == 0, 'expected pair of lat/lon, got %s' % positions
     return positions
 
+def parse_pos(soup):
+    """Returns the x, y coordinate of a single <pos> as an array, see parse_posList"""
+    position = array('d', map(float, soup.find('pos').text.split()))
+    assert len(position) == 2, 'expected pair of lat/lon, got %s' % position
+    return position
+
 def parse_sortering(entry):
     """Extract sorterings-kode from xml tags app:sortering1kode and app:sortering2kode"""
     viktighet1 = entry.find('sortering1kode').text
@@ -94,6 +150,36 @@ def parse_sortering(entry):
     sorting = viktighet1 + viktighet2
     return sorting
 
+# 2019-01-02, 2019-01-02T10:11:12 or 2019-01-02T10:11:12.123
+iso_date_reg = re.compile('([0-9]{4}-[0-9]{2}-[0-9]{2})(T([01][0-9]|2[0-3]):[0-5][0-9]:[0-5][0-9](\.[0-9]{1,6})?)?$')
+
+@functools.lru_cache(maxsize=4096)
+def normalize_date(date):
+    """Returns the date part of the given timestamp as a 'YYYY-MM-DD' string,
+    the same handful of dates are repeated for each kommune, so the result is memoized,
+    see normalize_date.cache_info()"""
+    reg = iso_date_reg.match(date)
+    if reg:
+        date_str = reg.group(1)
+        try:
+            datetime.date(int(date_str[:4]), int(date_str[5:7]), int(date_str[8:10])) # validate
+            return date_str
+        except ValueError:
+            pass
+
+    date_python = None
+    for fmt in ('%Y-%m-%dT%H:%M:%S.%f', '%Y-%m-%dT%H:%M:%S', '%Y-%m-%d'):
+        try:
+            date_python = datetime.datetime.strptime(date, fmt) # to python object
+            break
+        except ValueError as e:
+            error = e
+
+    if date_python is None:
+        raise error # raise latest date failure
+
+    return date_python.strftime('%Y-%m-%d') # to string
+
 name_status_conv = {'hovednavn': 1,
                     'sidenavn':  2,
                     'undernavn': 3,
@@ -110,27 +196,39 @@ def name_status_to_num(name_status):
         logger.error('invalid name_status = "%s"', name_status)
         return 10
 
-def parse_stedsnavn(entry, return_only=('godkjent', 'internasjonal', 'vedtatt', 'vedtattNavneledd'),
-                    silently_ignore=('historisk', ), additional_tags=None):
-    """
-     Structure seems to be
-    <sted>
-      <stedsnavn> 
-        <Stedsnavn> "NAME1" </stedsnavn>
-      </stedsnavn>
-      <stedsnavn> 
-        <Stedsnavn> "NAME2" </stedsnavn>
-      </stedsnavn>
-    <sted>
-    note the nested <stedsnavn><stedsnavn>...
-
-    Returns a list of dictionaries for each name, where skrivemåte is 
-    in return_only, default:
-    ('godkjent', 'internasjonal', 'vedtatt', 'vedtattNavneledd')
-    Items not in silently_ignore will be logged.
-    """
-    if additional_tags is None:
-        additional_tags = dict()
+# skrivemåtestatus for name=*, old_name=* and loc_name=*, see parse_stedsnavn_buckets
+name_buckets = ((u'godkjent', u'internasjonal', u'vedtatt', u'vedtattNavneledd', u'privat'), # , u'uvurdert'
+                (u'historisk', ),
+                (u'foreslått', u'uvurdert'))
+
+def parse_stedsnavn_buckets(entry, buckets=name_buckets):
+    """Returns one list of ssr2_records.Skrivemaate, in a single pass,
+    for each tuple of skrivemåte statuses in buckets (default: current, historic and local names).
+    Statuses not found in any of the buckets are logged."""
+    status_to_bucket = dict()
+    for ix, statuses in enumerate(buckets):
+        for status in statuses:
+            status_to_bucket[status] = ix
+
+    parsed_names = [list() for _ in buckets]
+    for skrivem in iter_stedsnavn(entry):
+        try:
+            ix = status_to_bucket[skrivem.spelling_status]
+        except KeyError:
+            logger.info('ignoring non approved status = "%s" name = "%s"',
+                        skrivem.spelling_status, skrivem.name)
+            continue
+
+        parsed_names[ix].append(skrivem)
+
+    return [sorted_names(lst) for lst in parsed_names]
+
+def sorted_names(parsed_names):
+    """Sort list of ssr2_records.Skrivemaate by name_status_num and order_spelling"""
+    return sorted(parsed_names, key = lambda x: (x.name_status_num, x.order_spelling))
+
+def parse_language_priority(entry):
+    """Returns the <språkprioritering> of entry, e.g. 'nor-sme'"""
     language_priority = entry.find('språkprioritering')
     
     if language_priority is None:
@@ -145,9 +243,10 @@ def parse_stedsnavn(entry, return_only=('godkjent', 'internasjonal', 'vedtatt',
     else:
         language_priority = language_priority.text
 
-    additional_tags['name:language_priority'] = language_priority
+    return language_priority
 
-    parsed_names = list()
+def iter_stedsnavn(entry):
+    """Yields a ssr2_records.Skrivemaate for every skrivemåte in entry, see parse_stedsnavn_buckets"""
     #print(entry.prettify())
     for names in entry.find_all('stedsnavn', recursive=False):
         names_nested = names.find_all('Stedsnavn', recursive=False)
@@ -168,16 +267,18 @@ def parse_stedsnavn(entry, return_only=('godkjent', 'internasjonal', 'vedtatt',
             logger.info('Skipping name_status = "%s"', name_status)
             continue
 
+        stedsnavn = ssr2_records.Stedsnavn(language=language,
+                                           name_status=name_status,
+                                           name_status_num=name_status_num,
+                                           eksonym=eksonym,
+                                           stedsnavnnummer=stedsnavnnummer)
+
         for skrivem in names.find_all(u'skrivemåte', recursive=False):
             skrivem_nested = skrivem.find_all(u'Skrivemåte', recursive=False)
             assert len(skrivem_nested) == 1, 'Vops: expected this to only be 1 element %s' % skrivem
             skrivem = skrivem_nested[0]
             
             #print 'SKRIVEM', skrivem.prettify()
-            if additional_tags is None:
-                tags = dict()
-            else:
-                tags = dict(additional_tags) # start with the additional tags
 
             # Date
             date = skrivem.find('oppdateringsdato')
@@ -185,37 +286,14 @@ def parse_stedsnavn(entry, return_only=('godkjent', 'internasjonal', 'vedtatt',
                 date = skrivem.find('statusdato')
                 #date = entry.find('oppdateringsdato')
 
-            date = date.text
-
-            date_python = None
-            for fmt in ('%Y-%m-%dT%H:%M:%S.%f', '%Y-%m-%dT%H:%M:%S', '%Y-%m-%d'):
-                try:
-                    date_python = datetime.datetime.strptime(date, fmt) # to python object
-                    break
-                except ValueError as e:
-                    pass
-
-            if date_python is None:
-                raise e # raise latest date failure
-
-            date_str = date_python.strftime('%Y-%m-%d') # to string
+            date_str = normalize_date(date.text)
 
             name = skrivem.find('langnavn')
             if name is None:
                 name = skrivem.find('komplettskrivemåte')
-            
-            tags['name'] = name.text
-            #print skrivem.prettify()
-            tags['name:date'] = date_str
-            tags['name:language'] = language
-            tags['name:name_status'] = name_status
-            tags['name:name_status_num'] = name_status_num
-            tags['name:eksonym'] = eksonym
-            tags['name:stedsnavnnummer'] = stedsnavnnummer
             #tags['name:order'] = skrivem.find('app:rekkef').text
 
             order_spelling = int(skrivem.find(u'skrivemåtenummer').text)
-            tags['name:order_spelling'] = order_spelling
             status = skrivem.find(u'skrivemåtestatus').text            
 
             priority_spelling = skrivem.find(u'prioritertSkrivemåte')
@@ -238,32 +316,55 @@ def parse_stedsnavn(entry, return_only=('godkjent', 'internasjonal', 'vedtatt',
             # Hack, difference between skrivemåtestatus and navnesakstatus
             if name_status == u'historisk':
                 status = u'historisk'
- 
-            tags['name:priority_spelling'] = priority_spelling
-            tags['name:spelling_status'] = status
-                
-            if status in return_only:
-                parsed_names.append((name_status_num, order_spelling, tags))
-            else:
-                if not(status in silently_ignore):
-                    logger.info('ignoring non approved status = "%s" name = "%s"',
-                                status, tags['name'])
-            
-    parsed_names_sort = sorted(parsed_names, key = lambda x: [x[0], x[1]])
-    # if len(parsed_names_sort) >= 3:
-    #     print parsed_names_sort
+
+            yield ssr2_records.Skrivemaate(stedsnavn,
+                                           name=name.text,
+                                           date=date_str,
+                                           order_spelling=order_spelling,
+                                           priority_spelling=priority_spelling,
+                                           spelling_status=status)
+
+def parse_sted(entry):
+    """Parse a single <Sted> into a ssr2_records.Sted, returns None if the place is not active"""
+    stedsnr = entry.find('stedsnummer').text
+
+    # Active?
+    active = entry.find('stedstatus')
+    if active is not None:
+        active = active.text
+        if active != 'aktiv':
+            logger.info('ssr:stedsnr = %s not active = "%s". Skipping...', stedsnr, active)
+            return None
+
+    # Date
+    date_str = normalize_date(entry.find('oppdateringsdato').text)
+
+    sted = ssr2_records.Sted(stedsnr=stedsnr,
+                             hovedgruppe=entry.find('navneobjekthovedgruppe').text,
+                             gruppe=entry.find('navneobjektgruppe').text,
+                             type=entry.find('navneobjekttype').text,
+                             date=date_str,
+                             language_priority=parse_language_priority(entry))
+
+    # # Sorting:
+    # sortering = parse_sortering(entry)
+    # if sortering != '':
+    #     tags['ssr:sorting'] = sortering
+
+    # fixme: parse ssr:navnetype and ssr:navnekategori into proper openstreetmap tag(s)
+
+    sted.names, sted.historic_names, sted.local_names = parse_stedsnavn_buckets(entry)
+    # if tags['ssr:stedsnr'] == '237775':
+    #     print(parsed_names)
     #     exit(1)
-    parsed_names_tags = list()
-    for _, _, tags in parsed_names_sort:
-        parsed_names_tags.append(tags)
 
-    return parsed_names_tags
+    return sted
 
 def find_all_languages(*args):
     languages = set()
     for arg in args:
         for item in arg:
-            languages.add(item['name:language'])
+            languages.add(item.language)
     return languages
 
 ssr_language_to_osm = {'nor': 'no',
@@ -308,22 +409,18 @@ def update_lang_name_dct(dct, parsed_names, tag_key, language, lang_key):
         'name:lang1' = [list, of, names]
         'name:lang2' = [list, of, names]
     """
-    # fixme: class?
     for name in parsed_names:
-        if name['name:language'] == language:
+        if name.language == language:
             tag_key_lang = '%s:%s' % (tag_key, lang_key)
-            dct[tag_key_lang].append(name) # ['name']
-
-            name['added_to_lang_dct'] = True # debug only
+            dct[tag_key_lang].append(name)
 
 def add_name_lang_tags(dct, tags):
     """Using dictionary 'dct' from above function, 
     add tags with comma seperated 'name' values to 'tags'"""
-    # fixme: class
     for key in dct:
         lst = list()
         for item in dct[key]:
-            lst.append(item['name'])
+            lst.append(item.name)
 
         assert key not in tags
         tags[key] = ';'.join(lst)
@@ -342,10 +439,10 @@ def sorted_priority_spelling(dct, language_priority, tag_key='name'):
         # 1) Get the lowest name_status_num for this language
         name_status_num_min = 6
         for item in parsed_names:
-            name_status_num_min = min(name_status_num_min, item['name:name_status_num'])
+            name_status_num_min = min(name_status_num_min, item.name_status_num)
 
         for item in parsed_names:
-            if item['name:priority_spelling'] and name_status_num_min == item['name:name_status_num']:
+            if item.priority_spelling and name_status_num_min == item.name_status_num:
                 name_pri_spelling.append(item)#['name'])
     
     return name_pri_spelling
@@ -378,8 +475,8 @@ def sort_by_priority_spelling(names, language_priority):
     #logger.debug('sort_by_priority_spelling -> %s', new_lst)
     return new_lst
 
-def sorted_remaining_spelling(dct, language_priority, tag_key='name'):
-    ''' Return, sorted by language_priority, a list of names without a True "added_to_name"'''
+def sorted_remaining_spelling(dct, language_priority, tag_key='name', added_to_name=()):
+    ''' Return, sorted by language_priority, a list of names not in added_to_name'''
     # fixme: shares a lot of code with above function
     # make the nested if statement a callback
     #logger.info('sorted_remaining_spelling(%s, %s, %s)...', dct, language_priority, tag_key)
@@ -389,7 +486,7 @@ def sorted_remaining_spelling(dct, language_priority, tag_key='name'):
         tag_key_lang = '%s:%s' % (tag_key, lang_key)
         parsed_names = dct[tag_key_lang]
         for item in parsed_names:
-            if not('added_to_name' in item and item['added_to_name']):
+            if item not in added_to_name:
                 name_pri_spelling.append(item)#['name'])
 
     #logger.info('sorted_remaining_spelling -> %s', name_pri_spelling)
@@ -400,7 +497,7 @@ def handle_multiple_priority_spellings(names_pri, languages=None, names=None):
     if languages is None:
         languages = list()
         for item in names_pri:
-            lang = item['name:language']
+            lang = item.language
             if lang not in languages:
                 languages.append(lang)
 
@@ -418,393 +515,625 @@ def handle_multiple_priority_spellings(names_pri, languages=None, names=None):
         names.append(current_lang)
         for item in names_pri:
             # NOTE: not efficient, create a list in the previous loop instead
-            if lang == item['name:language']:
+            if lang == item.language:
                 #item['added_to_name'] = True # Added later
                 current_lang[1].append(item)
 
     return names
 
-def parse_geonorge(soup, create_multipoint_way=False, soup_format='xml'):
-    # create OSM object:
-    osm = osmapis.OSM()
-    osm_noName = osmapis.OSM()
-    #multi_names = dict()
-    #print soup.prettify()
-    for entry in soup.find_all('Sted'):
-        #print 'STED', entry.prettify()
-        tags = dict()
-        attribs = dict()
-        stedsnr = entry.find('stedsnummer').text
-        tags['ssr:stedsnr'] = stedsnr
-
-        # Active?
-        active = entry.find('stedstatus')
-        if active is not None:
-            active = active.text
-            if active != 'aktiv':
-                logger.info('ssr:stedsnr = %s not active = "%s". Skipping...', stedsnr, active)
-                continue
-
-        # Date
-        date = entry.find('oppdateringsdato').text
-        try:
-            date_python = datetime.datetime.strptime(date, '%Y-%m-%dT%H:%M:%S.%f') # to python object
-        except ValueError:
-            date_python = datetime.datetime.strptime(date, '%Y-%m-%dT%H:%M:%S') # to python object
-
-        date_str = date_python.strftime('%Y-%m-%d') # to string
-        
-        tags['ssr:hovedgruppe'] = entry.find('navneobjekthovedgruppe').text
-        tags['ssr:gruppe'] = entry.find('navneobjektgruppe').text
-        tags['ssr:type'] = entry.find('navneobjekttype').text
-        tags['ssr:date'] = date_str
-
-        # # Sorting:
-        # sortering = parse_sortering(entry)
-        # if sortering != '':
-        #     tags['ssr:sorting'] = sortering
-
-        # fixme: parse ssr:navnetype and ssr:navnekategori into proper openstreetmap tag(s)
-
-        return_only = (u'godkjent', u'internasjonal', u'vedtatt', u'vedtattNavneledd', u'privat') # , u'uvurdert'
-        parsed_names = parse_stedsnavn(entry, return_only=return_only,
-                                       silently_ignore=[u'historisk', u'foreslått', 'uvurdert'])
-        # if tags['ssr:stedsnr'] == '237775':
-        #     print(parsed_names)
-        #     exit(1)
-        
-        silently_ignore = list(return_only)
-        silently_ignore.append(u'foreslått')
-        silently_ignore.append(u'uvurdert')
-        parsed_names_historic = parse_stedsnavn(entry, return_only=[u'historisk'],
-                                                 silently_ignore=silently_ignore)
-        silently_ignore = list(return_only)
-        silently_ignore.append(u'historisk')
-        silently_ignore.append(u'uvurdert')
-        parsed_names_locale =    parse_stedsnavn(entry, return_only=[u'foreslått', 'uvurdert'],
-                                                 silently_ignore=silently_ignore)
-
-        language_priority = None
-        if len(parsed_names) + len(parsed_names_historic) + len(parsed_names_locale) == 0:
-            logger.warning('ssr:stedsnr = %s: No valid names found, skipping', stedsnr)
-            continue
-        else:
-            # name:language_priority is equal for all elements in parsed_names
-            # but we needs to skip through and find the first non-empty list:
-            for lst in (parsed_names, parsed_names_historic, parsed_names_locale):
-                try:
-                    language_priority = lst[0]['name:language_priority'] # this is equal for all elements in parsed_names
-                    break
-                except:
-                    pass
-        
-        languages = find_all_languages(parsed_names, parsed_names_historic, parsed_names_locale)
-        languages = list(languages)
-        if len(languages) != 1:
-            logger.debug('ssr:stedsnr = %s, languages = %s', tags['ssr:stedsnr'], languages)
-        # Convert to osm keys:
-        lang_keys = list(map(ssr_language_to_osm_key, languages))
-
-        # Step 1) generate a dictionary, where keys are:
-        # name:lang1 = [list, of, names]
-        # name:lang2 = [list, of, names]
-        # ...
-        # Do the exact same operation on old_names and loc_names.
-        names_dct = defaultdict(list)
-        old_names_dct = defaultdict(list)
-        loc_names_dct = defaultdict(list)
-        for ix in range(len(languages)):
-            update_lang_name_dct(names_dct, parsed_names, tag_key='name',
-                                 language=languages[ix], lang_key=lang_keys[ix])
-            update_lang_name_dct(old_names_dct, parsed_names_historic, tag_key='old_name',
-                                 language=languages[ix], lang_key=lang_keys[ix])
-            update_lang_name_dct(loc_names_dct, parsed_names_locale, tag_key='loc_name',
-                                 language=languages[ix], lang_key=lang_keys[ix])
-
-        # DEBUG prints:
+def resolve_names(sted):
+    """Figure out name=*, name:<lang>=*, alt_name=*, old_name=* and loc_name=* for the given ssr2_records.Sted,
+    returns the osm tags and True if a name=* was found"""
+    parsed_names = sted.names
+    parsed_names_historic = sted.historic_names
+    parsed_names_locale = sted.local_names
+    language_priority = sted.language_priority
+    tags = sted.tags()
+
+    languages = find_all_languages(parsed_names, parsed_names_historic, parsed_names_locale)
+    languages = list(languages)
+    if len(languages) != 1 and logger.isEnabledFor(logging.DEBUG):
+        logger.debug('ssr:stedsnr = %s, languages = %s', tags['ssr:stedsnr'], languages)
+    # Convert to osm keys:
+    lang_keys = list(map(ssr_language_to_osm_key, languages))
+
+    # Step 1) generate a dictionary, where keys are:
+    # name:lang1 = [list, of, names]
+    # name:lang2 = [list, of, names]
+    # ...
+    # Do the exact same operation on old_names and loc_names.
+    names_dct = defaultdict(list)
+    old_names_dct = defaultdict(list)
+    loc_names_dct = defaultdict(list)
+    for ix in range(len(languages)):
+        update_lang_name_dct(names_dct, parsed_names, tag_key='name',
+                             language=languages[ix], lang_key=lang_keys[ix])
+        update_lang_name_dct(old_names_dct, parsed_names_historic, tag_key='old_name',
+                             language=languages[ix], lang_key=lang_keys[ix])
+        update_lang_name_dct(loc_names_dct, parsed_names_locale, tag_key='loc_name',
+                             language=languages[ix], lang_key=lang_keys[ix])
+
+    # DEBUG prints:
+    if logger.isEnabledFor(logging.DEBUG):
         if len(names_dct) != 0:
             logger.debug('names_dct.keys = %s', names_dct.keys())
         if len(old_names_dct) != 0:
             logger.debug('old_names_dct.keys = %s', old_names_dct.keys())
         if len(loc_names_dct) != 0:
             logger.debug('loc_names_dct.keys = %s', loc_names_dct.keys())
-        # END DEBUG
+    # END DEBUG
+    
+    # Step 2) Figure out name=*
+    names = list()
+    fixme = ''
+
+    # 2.1 start with priority spelling
+    names_pri = sorted_priority_spelling(names_dct, language_priority, tag_key='name')
+    names = handle_multiple_priority_spellings(names_pri)
+
+    # 2.2) Figure out alt_name
+    added_to_name = set()
+    alt_names_pri = sorted_remaining_spelling(names_dct, language_priority, tag_key='name',
+                                              added_to_name=added_to_name)
+
+    # if tags['ssr:stedsnr'] == '505247':
+    #     print('languages', languages)
+    #     print('lang_keys', lang_keys)
+    #     print('language_priority', language_priority)
+    #     print('parsed_names_locale', parsed_names_locale)
         
-        # Step 2) Figure out name=*
-        names = list()
-        fixme = ''
-
-        # 2.1 start with priority spelling
-        names_pri = sorted_priority_spelling(names_dct, language_priority, tag_key='name')
-        names = handle_multiple_priority_spellings(names_pri)
+    #     print('names_dct', pprint(names_dct))
+    #     print('old_names_dct', pprint(old_names_dct))
+    #     print('loc_names_dct', pprint(loc_names_dct))
+        
+    #     print('names', names)
+    #     print('alt_names', alt_names_pri)
+    #     print('tags', tags)
+    #     exit(1)
 
-        # 2.2) Figure out alt_name
-        alt_names_pri = sorted_remaining_spelling(names_dct, language_priority, tag_key='name')
+    for lang in languages:
+        lang_key = ssr_language_to_osm_key(lang)
+        lang_missing = True
+        for l, lst in names:
+            if l == lang_key:
+                lang_missing = False
+                break
 
-        # if tags['ssr:stedsnr'] == '505247':
-        #     print('languages', languages)
-        #     print('lang_keys', lang_keys)
-        #     print('language_priority', language_priority)
-        #     print('parsed_names_locale', parsed_names_locale)
-            
-        #     print('names_dct', pprint(names_dct))
-        #     print('old_names_dct', pprint(old_names_dct))
-        #     print('loc_names_dct', pprint(loc_names_dct))
-            
-        #     print('names', names)
-        #     print('alt_names', alt_names_pri)
-        #     print('tags', tags)
-        #     exit(1)
-
-        for lang in languages:
-            lang_key = ssr_language_to_osm_key(lang)
-            lang_missing = True
-            for l, lst in names:
-                if l == lang_key:
-                    lang_missing = False
-                    break
-
-            #if len(names) == 0:        # use alt_name instead if available
-            upgrade_alt_names_to_names = False # https://github.com/osmno/ssr2_to_osm/issues/2 disable for now
-            if lang_missing and len(alt_names_pri) != 0 and upgrade_alt_names_to_names:
-                lang_names = handle_multiple_priority_spellings(alt_names_pri,
-                                                                languages=[lang]) # only for lang
-                assert len(lang_names) == 1
-                names.append(lang_names[0])
-                # if tags['ssr:stedsnr'] == '505247':
-                #     print('alt_names_pri = ', pprint(alt_names_pri))
-                #     print('lang = ', lang)
-                #     print('names = ', pprint(names))
-                #     print('language_priority = ', language_priority)
-                    
-                names = sort_by_priority_spelling(names, language_priority)
-
-                # if tags['ssr:stedsnr'] == '505247':
-                #     print('names = ', pprint(names))
-                #     exit(1)
-
-                # DEBUG:
-                names_str = list()
-                for lang, lst in names:
-                    for item in lst:
-                        names_str.append((lang, item['name']))
-
-                logger.info('ssr:stedsnr = %s: No priority spelling found for lang = %s, using alt_name to get "%s"',
-                               tags['ssr:stedsnr'], lang, names_str)
-                    # end DEBUG
-
-            # # fixme: multi language support for this case?
-            # if len(alt_names_pri) != 0:
-            #     name = alt_names_pri[0]
-            #     name['added_to_name'] = True
+        #if len(names) == 0:        # use alt_name instead if available
+        upgrade_alt_names_to_names = False # https://github.com/osmno/ssr2_to_osm/issues/2 disable for now
+        if lang_missing and len(alt_names_pri) != 0 and upgrade_alt_names_to_names:
+            lang_names = handle_multiple_priority_spellings(alt_names_pri,
+                                                            languages=[lang]) # only for lang
+            assert len(lang_names) == 1
+            names.append(lang_names[0])
+            # if tags['ssr:stedsnr'] == '505247':
+            #     print('alt_names_pri = ', pprint(alt_names_pri))
+            #     print('lang = ', lang)
+            #     print('names = ', pprint(names))
+            #     print('language_priority = ', language_priority)
                 
-            #     names = [(ssr_language_to_osm_key(name['name:language']), [name])]
-
-            #     alt_names_pri_names = [item['name'] for item in alt_names_pri]
-            #     logger.warning('ssr:stedsnr = %s: No priority spelling found, using first alt_name = %d %s',
-            #                    tags['ssr:stedsnr'], len(alt_names_pri_names), alt_names_pri_names)
-            #     if len(alt_names_pri_names) >= 2:
-            #         for ix in range(len(alt_names_pri)):
-            #             logger.info('ssr:stedsnr = %s: alt_name[%d] = %s',
-            #                         tags['ssr:stedsnr'],
-            #                         ix, alt_names_pri[ix])
-                
-            #     del alt_names_pri[0]                
-            else:
-                logger.info('ssr:stedsnr = %s: No name found',
-                             tags['ssr:stedsnr'])
-                #continue
-
-        # # Create an alt_names_dct based on names_dct
-        # alt_names_dct = defaultdict(list)
-        # for key in names_dct:
-        #     alt_key = key.replace('name', 'alt_name')
-        #     for item in names_dct[key]:
-        #         if not('added_to_name' in item and item['added_to_name']):
-        #             alt_names_dct[alt_key].append(item)
-
-        alt_names_dct = defaultdict(list)        
-        if len(names) == 0:
-            name_found = False
-        else:
-            name_found = True
-            # 2.3) Add tags['name']
-            # and tags['name:lang']
+            names = sort_by_priority_spelling(names, language_priority)
+
+            # if tags['ssr:stedsnr'] == '505247':
+            #     print('names = ', pprint(names))
+            #     exit(1)
+
+            # DEBUG:
             names_str = list()
             for lang, lst in names:
-                if len(lst) == 0:
-                    continue
-                
-                names_str_lang = list() # one list for each language
                 for item in lst:
-                    names_str_lang.append(item['name'])
-                    item['added_to_name'] = True
-
-                s = ';'.join(names_str_lang)
-                names_str.append(s)
-                tags['name:%s' % lang] = s
+                    names_str.append((lang, item.name))
 
-                if len(names_str_lang) >= 2:
-                    logger.info('ssr:stedsnr = %s: Adding multiple names to name tag, this is not OK! name = "%s"',
-                                 tags['ssr:stedsnr'], s)
-                    fixme = 'multiple name tags, choose one and add the other to alt_name'
+            logger.info('ssr:stedsnr = %s: No priority spelling found for lang = %s, using alt_name to get "%s"',
+                           tags['ssr:stedsnr'], lang, names_str)
+                # end DEBUG
 
-            assert len(names_str) != 0
-            tags['name'] = ' - '.join(names_str)
+        # # fixme: multi language support for this case?
+        # if len(alt_names_pri) != 0:
+        #     name = alt_names_pri[0]
+        #     name['added_to_name'] = True
+            
+        #     names = [(ssr_language_to_osm_key(name['name:language']), [name])]
+
+        #     alt_names_pri_names = [item['name'] for item in alt_names_pri]
+        #     logger.warning('ssr:stedsnr = %s: No priority spelling found, using first alt_name = %d %s',
+        #                    tags['ssr:stedsnr'], len(alt_names_pri_names), alt_names_pri_names)
+        #     if len(alt_names_pri_names) >= 2:
+        #         for ix in range(len(alt_names_pri)):
+        #             logger.info('ssr:stedsnr = %s: alt_name[%d] = %s',
+        #                         tags['ssr:stedsnr'],
+        #                         ix, alt_names_pri[ix])
+            
+        #     del alt_names_pri[0]                
+        else:
+            logger.info('ssr:stedsnr = %s: No name found',
+                         tags['ssr:stedsnr'])
+            #continue
+
+    # # Create an alt_names_dct based on names_dct
+    # alt_names_dct = defaultdict(list)
+    # for key in names_dct:
+    #     alt_key = key.replace('name', 'alt_name')
+    #     for item in names_dct[key]:
+    #         if not('added_to_name' in item and item['added_to_name']):
+    #             alt_names_dct[alt_key].append(item)
+
+    alt_names_dct = defaultdict(list)        
+    if len(names) == 0:
+        name_found = False
+    else:
+        name_found = True
+        # 2.3) Add tags['name']
+        # and tags['name:lang']
+        names_str = list()
+        for lang, lst in names:
+            if len(lst) == 0:
+                continue
             
-            if fixme != '':
-                tags['fixme'] = fixme
-
-            if len(names_str) >= 2:
-                logger.info('ssr:stedsnr = %s: Multi-language name tag = %s',
-                            tags['ssr:stedsnr'], tags['name'])
-
-            # Create alt_name again, now that we know 'added_to_name'
-            # alt_names_pri = sorted_remaining_spelling(names_dct, language_priority, tag_key='name')
-            for key in names_dct:
-                alt_key = key.replace('name', 'alt_name')
-                for item in names_dct[key]:
-                    if not('added_to_name' in item and item['added_to_name']):
-                        alt_names_dct[alt_key].append(item)
-
-        # 3) Add tags loc_name:lang, old_name:lang, alt_name:lang
-        add_name_lang_tags(old_names_dct, tags)
-        add_name_lang_tags(loc_names_dct, tags)
-        add_name_lang_tags(alt_names_dct, tags)
+            names_str_lang = list() # one list for each language
+            for item in lst:
+                names_str_lang.append(item.name)
+                added_to_name.add(item)
+
+            s = ';'.join(names_str_lang)
+            names_str.append(s)
+            tags['name:%s' % lang] = s
+
+            if len(names_str_lang) >= 2:
+                logger.info('ssr:stedsnr = %s: Adding multiple names to name tag, this is not OK! name = "%s"',
+                             tags['ssr:stedsnr'], s)
+                fixme = 'multiple name tags, choose one and add the other to alt_name'
+
+        assert len(names_str) != 0
+        tags['name'] = ' - '.join(names_str)
         
-        # 4) Remove redundant :lang keys 
-        # if no other :lang key is used for this place
-        lang_suffix = ssr_language_to_osm.values()
-        lang_suffic_without_no = tuple(filter(lambda x: x != 'no', lang_suffix))
-
-        multi_language = False
-        first_pri_language = language_priority.split('-')[0]
-        first_pri_language = ssr_language_to_osm_key(first_pri_language)
-        #if first_pri_language == 'no':, disable, https://github.com/osmno/ssr2_to_osm/issues/2
-        for key in tags.keys():
-            if key.endswith(lang_suffic_without_no):
-                multi_language = True
-                break
-
-        if not(multi_language): # first_pri_language == 'no' and 
-            for key in list(tags.keys()):
-                if key.endswith(':no'):
-                    key_without_lang = key[:-len(':no')]
-                    if key_without_lang in tags: # do not overwrite
-                        # unless value is the same
-                        if tags[key] != tags[key_without_lang]:
-                            continue
-                    
-                    tags[key_without_lang] = tags[key]
-                    del tags[key]
-
-        # 5) Ensure we do not have alt_name:<lang> without a name:<lang>
+        if fixme != '':
+            tags['fixme'] = fixme
+
+        if len(names_str) >= 2:
+            logger.info('ssr:stedsnr = %s: Multi-language name tag = %s',
+                        tags['ssr:stedsnr'], tags['name'])
+
+        # Create alt_name again, now that we know 'added_to_name'
+        # alt_names_pri = sorted_remaining_spelling(names_dct, language_priority, tag_key='name')
+        for key in names_dct:
+            alt_key = key.replace('name', 'alt_name')
+            for item in names_dct[key]:
+                if item not in added_to_name:
+                    alt_names_dct[alt_key].append(item)
+
+    # 3) Add tags loc_name:lang, old_name:lang, alt_name:lang
+    add_name_lang_tags(old_names_dct, tags)
+    add_name_lang_tags(loc_names_dct, tags)
+    add_name_lang_tags(alt_names_dct, tags)
+    
+    # 4) Remove redundant :lang keys 
+    # if no other :lang key is used for this place
+    lang_suffix = ssr_language_to_osm.values()
+    lang_suffic_without_no = tuple(filter(lambda x: x != 'no', lang_suffix))
+
+    multi_language = False
+    first_pri_language = language_priority.split('-')[0]
+    first_pri_language = ssr_language_to_osm_key(first_pri_language)
+    #if first_pri_language == 'no':, disable, https://github.com/osmno/ssr2_to_osm/issues/2
+    for key in tags.keys():
+        if key.endswith(lang_suffic_without_no):
+            multi_language = True
+            break
+
+    if not(multi_language): # first_pri_language == 'no' and 
         for key in list(tags.keys()):
-            reg = re.match('alt_name:(\w+)', key)
-            if reg:
-                lang = reg.group(1)
-                key_name = 'name:%s' % lang
-                if key_name not in tags:
-                    tags[key_name] = tags[key]
-                    del tags[key]
-                    if ';' in tags[key_name]:
-                        logger.warning('empty name:%s, moving from alt_name:%s, FIXME: handle multiple names = %s',
-                                       lang, lang, tags[key_name])
-                        old_fixme = tags.pop('fixme', '')
-                        fixme = 'multiple name:%s tags, choose one and add the other to alt_name:%s' % (lang, lang)
-                        if old_fixme != '':
-                            fixme = old_fixme + '; ' + fixme
-                        
-                        tags['fixme'] = fixme
-
-        # if tags['ssr:stedsnr'] == '323139':
-        #     print('tags2', tags)
-        #     exit(1)
-                        
-        pos = entry.find('posisjon')
-        lineString = entry.find('LineString')
-        multiPoint = entry.find('MultiPoint')
-        surface    = entry.find('Surface')
-        epsg = None
-        if pos is not None:
-            positions = list()
-            for point in pos.find_all('Point'):
-                epsg = point['srsName'] #'EPSG:25832'
+            if key.endswith(':no'):
+                key_without_lang = key[:-len(':no')]
+                if key_without_lang in tags: # do not overwrite
+                    # unless value is the same
+                    if tags[key] != tags[key_without_lang]:
+                        continue
                 
-                p = point.find('pos').text.split()
-                assert len(p) == 2, 'expected pair of lat/lon, got %s' % p
-                positions.append(p)
-            for lineString in pos.find_all('LineString'):
-                epsg = lineString['srsName']
-                positions.extend(parse_posList(lineString))
-            for lineString in pos.find_all('Polygon'):
-                epsg = lineString['srsName']
-                positions.extend(parse_posList(lineString))
-            
-            if len(positions) == 0:
-                raise ValueError("no positions %s" % pos.prettify())
-                
-        elif lineString is not None:
-            epsg = lineString['srsName']
-            positions = parse_posList(lineString)
+                tags[key_without_lang] = tags[key]
+                del tags[key]
+
+    # 5) Ensure we do not have alt_name:<lang> without a name:<lang>
+    for key in list(tags.keys()):
+        reg = re.match('alt_name:(\w+)', key)
+        if reg:
+            lang = reg.group(1)
+            key_name = 'name:%s' % lang
+            if key_name not in tags:
+                tags[key_name] = tags[key]
+                del tags[key]
+                if ';' in tags[key_name]:
+                    logger.warning('empty name:%s, moving from alt_name:%s, FIXME: handle multiple names = %s',
+                                   lang, lang, tags[key_name])
+                    old_fixme = tags.pop('fixme', '')
+                    fixme = 'multiple name:%s tags, choose one and add the other to alt_name:%s' % (lang, lang)
+                    if old_fixme != '':
+                        fixme = old_fixme + '; ' + fixme
+                    
+                    tags['fixme'] = fixme
 
-        elif surface is not None:
-            epsg = surface['srsName']
-            positions = parse_posList(surface)
-            
-        elif multiPoint is not None: # fixme: copy paste of if pos is not None
-            epsg = multiPoint['srsName']
-            positions = list()
-            for point in multiPoint.find_all('Point'):
-                p = point.find('pos').text.split()
-                assert len(p) == 2, 'expected pair of lat/lon, got %s' % p
-                positions.append(p)
-        else:
-            raise ValueError('No valid position indicator for %s' % (entry.prettify()))
+    # if tags['ssr:stedsnr'] == '323139':
+    #     print('tags2', tags)
+    #     exit(1)
 
-        create_node = False
+    return tags, name_found
+
+def parse_positions(entry):
+    """Returns (srsName, positions) for the geometry of a <Sted>,
+    where positions is a flat array of x, y coordinates, see parse_posList"""
+    pos = entry.find('posisjon')
+    lineString = entry.find('LineString')
+    multiPoint = entry.find('MultiPoint')
+    surface    = entry.find('Surface')
+    epsg = None
+    if pos is not None:
+        positions = array('d')
+        for point in pos.find_all('Point'):
+            epsg = point['srsName'] #'EPSG:25832'
+            positions.extend(parse_pos(point))
+        for lineString in pos.find_all('LineString'):
+            epsg = lineString['srsName']
+            positions.extend(parse_posList(lineString))
+        for lineString in pos.find_all('Polygon'):
+            epsg = lineString['srsName']
+            positions.extend(parse_posList(lineString))
+        
         if len(positions) == 0:
-            logger.error('ssr:stedsnr = %s. No positions found, skipping',
-                         tags['ssr:stedsnr'])
+            raise ValueError("no positions %s" % pos.prettify())
+            
+    elif lineString is not None:
+        epsg = lineString['srsName']
+        positions = parse_posList(lineString)
+
+    elif surface is not None:
+        epsg = surface['srsName']
+        positions = parse_posList(surface)
+        
+    elif multiPoint is not None: # fixme: copy paste of if pos is not None
+        epsg = multiPoint['srsName']
+        positions = array('d')
+        for point in multiPoint.find_all('Point'):
+            positions.extend(parse_pos(point))
+    else:
+        raise ValueError('No valid position indicator for %s' % (entry.prettify()))
+
+    return epsg, positions
+
+def transform_entry(entry, create_multipoint_way=False):
+    """Name resolution for a single <Sted> entry, returns (tags, epsg, positions, name_found)
+    with the positions not yet projected, or None if the place is skipped"""
+    #print 'STED', entry.prettify()
+    with ssr2_timing.stage('names'):
+        sted = parse_sted(entry)
+        if sted is None:
+            return None
+
+        if len(sted.names) + len(sted.historic_names) + len(sted.local_names) == 0:
+            logger.warning('ssr:stedsnr = %s: No valid names found, skipping', sted.stedsnr)
+            return None
+
+        tags, name_found = resolve_names(sted)
+
+    with ssr2_timing.stage('positions'):
+        epsg, positions = parse_positions(entry)
+
+    if len(positions) == 0:
+        logger.error('ssr:stedsnr = %s. No positions found, skipping',
+                     tags['ssr:stedsnr'])
+        return None
+    elif len(positions) != 2 and not(create_multipoint_way):
+        if logger.isEnabledFor(logging.INFO):
+            logger.info('ssr:stedsnr = %s has multiple (%s) positions, using the first one!',
+                        tags['ssr:stedsnr'], len(positions)//2)
+        positions = positions[:2]
+
+    return tags, epsg, positions, name_found
+
+def iter_geonorge_entries(entries, create_multipoint_way=False, batch_size=10000, sted_cache=None,
+                          parse_processes=1, chunk_threshold=50000, chunk_size=1000):
+    """Yields (elements, name_found) for each of the given <Sted> entries, where elements is a list of osm elements
+    with the osmapis.Node or osmapis.Way for the place last (any nodes of the way comes first).
+    Coordinates are projected in batches of batch_size elements, see iter_pending.
+    With a ssr2_sted_cache.StedCache, unchanged places are served from the cache, see transform_entry_cached.
+    With parse_processes > 1, large inputs are transformed in chunks across processes, see iter_transformed."""
+    pending = list()
+    pending_cache = list()      # (stedsnr, key, log records) for the cache misses in pending
+    #multi_names = dict()
+    #print soup.prettify()
+    for item, cache_item in iter_transformed(entries, create_multipoint_way=create_multipoint_way,
+                                             sted_cache=sted_cache, parse_processes=parse_processes,
+                                             chunk_threshold=chunk_threshold, chunk_size=chunk_size):
+        if item is None:
             continue
-        elif len(positions) == 1:
-            create_node = True
+
+        pending.append(item)
+        pending_cache.append(cache_item)
+        if len(pending) >= batch_size:
+            for item in iter_pending_cached(pending, pending_cache, sted_cache):
+                yield item
+            pending = list()
+            pending_cache = list()
+
+    for item in iter_pending_cached(pending, pending_cache, sted_cache):
+        yield item
+
+def transform_entry_cached(entry, sted_cache, create_multipoint_way=False):
+    """transform_entry, using sted_cache, returns (item, cache_item) where item is as for transform_entry
+    but with already projected lon, lat positions (and epsg None) on a cache hit.
+    On a cache miss, cache_item is (stedsnr, key, log records) to be stored once the positions are projected,
+    the log records of the place are captured and repeated on later cache hits."""
+    with ssr2_timing.stage('sted_cache'):
+        stedsnr = entry.find('stedsnummer').text
+        key = sted_cache.key(str(entry))
+        value = sted_cache.get(stedsnr, key)
+    if value is not None:
+        ssr2_sted_cache.replay(value['log'])
+        if value['result'] is None:
+            return None, None
+        tags, positions, name_found = value['result']
+        return (tags, None, array('d', positions), name_found), None
+
+    capture = ssr2_sted_cache.RecordCapture()
+    root_logger = logging.getLogger('utility_to_osm')
+    root_logger.addHandler(capture)
+    try:
+        item = transform_entry(entry, create_multipoint_way=create_multipoint_way)
+    finally:
+        root_logger.removeHandler(capture)
+    
+    if item is None:
+        sted_cache.put(stedsnr, key, {'result': None, 'log': capture.records})
+        return None, None
+    
+    return item, (stedsnr, key, capture.records)
+
+def iter_transformed(entries, create_multipoint_way=False, sted_cache=None,
+                     parse_processes=1, chunk_threshold=50000, chunk_size=1000):
+    """Yields (item, cache_item) for each of the given <Sted> entries, see transform_entry_cached,
+    where the log records of an entry are emitted before it is yielded.
+    With parse_processes > 1, the entries after the first chunk_threshold are transformed in chunks of chunk_size
+    by a pool of parse_processes processes and yielded in the original order, see iter_transformed_chunks.
+    Not available inside a daemonic pool worker, which can not start processes of its own
+    (the --parallel workers are not daemonic, see NonDaemonPool)."""
+    if parse_processes > 1 and multiprocessing.current_process().daemon:
+        logger.warning('In a daemonic pool worker, not transforming in parallel')
+        parse_processes = 1
+    
+    entries = iter(entries)
+    if parse_processes > 1:
+        serial_entries = itertools.islice(entries, chunk_threshold)
+    else:
+        serial_entries = entries
+    
+    for entry in serial_entries:
+        if sted_cache is None:
+            yield transform_entry(entry, create_multipoint_way=create_multipoint_way), None
         else:
-            if create_multipoint_way:
-                nds = list()
-                for ix, pos in enumerate(positions):
-                    lon, lat = parse_gml_point(pos, epsg=epsg)
-                    attribs['lat'], attribs['lon'] = lat, lon
-                    node = osmapis.Node(attribs=attribs,
-                                        tags={'ssr:gml_nr': str(ix)})
-                    osm.add(node)
-                    nds.append(node.id)
-                osm_element = osmapis.Way(tags=tags, nds=nds)
+            yield transform_entry_cached(entry, sted_cache, create_multipoint_way=create_multipoint_way)
+
+    if parse_processes > 1:
+        for item in iter_transformed_chunks(entries, create_multipoint_way=create_multipoint_way,
+                                            sted_cache=sted_cache, processes=parse_processes,
+                                            chunk_size=chunk_size):
+            yield item
+
+def iter_transformed_chunks(entries, create_multipoint_way=False, sted_cache=None, processes=2, chunk_size=1000):
+    """iter_transformed using a pool of processes, the entries are serialized and sent in chunks of chunk_size
+    to transform_chunk, at most 2*processes chunks are in flight.
+    Cache lookups are done here, only the cache misses are sent to the pool."""
+    logger.debug('Transforming the remaining <Sted> in chunks of %s using %s processes', chunk_size, processes)
+    level = logging.getLogger('utility_to_osm').getEffectiveLevel()
+    pool = Pool(processes, init_parse_worker, (level, ))
+    in_flight = deque()         # (slots, AsyncResult)
+    try:
+        slots = list()          # for each entry: None or (stedsnr, key, cached value or None)
+        fragments = list()      # the entries to transform
+        for entry in entries:
+            fragment = str(entry)
+            if sted_cache is None:
+                slots.append(None)
+                fragments.append(fragment)
             else:
-                logger.info('ssr:stedsnr = %s has multiple (%s) positions, using the first one!',
-                               tags['ssr:stedsnr'], len(positions))
-                create_node = True
-
-        if create_node:
-            lon, lat = parse_gml_point(positions[0], epsg=epsg)
-            attribs['lat'], attribs['lon'] = lat, lon
-            osm_element = osmapis.Node(attribs=attribs, tags=tags)
-
-        if name_found:
-            osm.add(osm_element)
+                with ssr2_timing.stage('sted_cache'):
+                    stedsnr = entry.find('stedsnummer').text
+                    key = sted_cache.key(fragment)
+                    value = sted_cache.get(stedsnr, key)
+                slots.append((stedsnr, key, value))
+                if value is None:
+                    fragments.append(fragment)
+
+            if len(slots) >= chunk_size:
+                res = pool.apply_async(transform_chunk, (fragments, create_multipoint_way))
+                in_flight.append((slots, res))
+                slots = list()
+                fragments = list()
+                while len(in_flight) > 2*processes:
+                    for item in iter_chunk_result(*in_flight.popleft(), sted_cache=sted_cache):
+                        yield item
+
+        if len(slots) != 0:
+            res = pool.apply_async(transform_chunk, (fragments, create_multipoint_way))
+            in_flight.append((slots, res))
+        while len(in_flight) != 0:
+            for item in iter_chunk_result(*in_flight.popleft(), sted_cache=sted_cache):
+                yield item
+    finally:
+        pool.terminate()
+        pool.join()
+
+# statistics returned by the transform_chunk pool workers of this process, see iter_chunk_result
+chunk_statistics = Counter()
+
+def iter_chunk_result(slots, res, sted_cache=None):
+    """Yields (item, None) for each entry of a chunk from iter_transformed_chunks, in order,
+    emitting the log records from the worker (or the cache) and storing the cache misses"""
+    with ssr2_timing.stage('chunk_wait'):
+        results, worker_statistics = res.get()
+    chunk_statistics.update(worker_statistics)
+    results = iter(results)
+    for slot in slots:
+        if slot is not None and slot[2] is not None:
+            result, records = slot[2]['result'], slot[2]['log']
+        else:
+            result, records = next(results)
+            if slot is not None:
+                sted_cache.put(slot[0], slot[1], {'result': result, 'log': records})
+        
+        ssr2_sted_cache.replay(records)
+        if result is None:
+            yield None, None
+        else:
+            tags, positions, name_found = result
+            yield (tags, None, array('d', positions), name_found), None
+
+# log records captured in a transform_chunk pool worker
+parse_worker_capture = None
+
+def init_parse_worker(level):
+    """Pool initializer for transform_chunk, the log records are captured
+    and emitted by the parent process instead, see iter_chunk_result"""
+    global parse_worker_capture
+    init_pool_worker()
+    parse_worker_capture = ssr2_sted_cache.RecordCapture(level=logging.NOTSET)
+    # drop the handlers inherited from the parent process, e.g. the queue handler, see ssr2_logging.install_queue_handler
+    for name in list(logging.root.manager.loggerDict.keys()) + ['utility_to_osm']:
+        if name == 'utility_to_osm' or name.startswith('utility_to_osm.'):
+            inherited_logger = logging.getLogger(name)
+            for handler in list(inherited_logger.handlers):
+                inherited_logger.removeHandler(handler)
+    root_logger = logging.getLogger('utility_to_osm')
+    root_logger.addHandler(parse_worker_capture)
+    root_logger.setLevel(level)
+    root_logger.propagate = False
+
+def transform_chunk(fragments, create_multipoint_way=False):
+    """Pool worker, transforms the serialized <Sted> fragments and returns (a list of (result, log records), statistics),
+    where result is None or (tags, positions, name_found) with the projected positions [lon0, lat0, lon1, ...]
+    and statistics are the date cache hits and misses of the chunk"""
+    date_cache_start = normalize_date.cache_info()
+    items = list()
+    records = list()
+    for fragment in fragments:
+        parse_worker_capture.records = list()
+        items.append(transform_entry(ssr2_stream.from_string(fragment),
+                                     create_multipoint_way=create_multipoint_way))
+        records.append(parse_worker_capture.records)
+
+    projected = iter(project_positions([item for item in items if item is not None]))
+    results = list()
+    for item, item_records in zip(items, records):
+        if item is None:
+            results.append((None, item_records))
         else:
-            osm_noName.add(osm_element)
+            tags, _, _, name_found = item
+            results.append(((tags, next(projected), name_found), item_records))
+    return results, cache_statistics('date_cache', date_cache_start, normalize_date.cache_info())
+
+def project_positions(items):
+    """Returns the projected positions [lon0, lat0, lon1, ...] for each (tags, epsg, positions, name_found) in items,
+    projected in a single batch"""
+    coordinates = dict()        # epsg: flat array of x, y coordinates
+    for _, epsg, positions, _ in items:
+        if epsg not in coordinates:
+            coordinates[epsg] = array('d')
+        coordinates[epsg].extend(positions)
+
+    points = dict()
+    with ssr2_timing.stage('projection'):
+        projected = ssr2_projection.transform_batch(coordinates)
+    for epsg, (lon, lat) in projected.items():
+        points[epsg] = zip(lon, lat)
+
+    result = list()
+    for _, epsg, positions, _ in items:
+        lonlat = list()
+        for _ in range(len(positions)//2):
+            lonlat.extend(next(points[epsg]))
+        result.append(lonlat)
+    return result
+
+def iter_pending_cached(pending, pending_cache, sted_cache):
+    """iter_pending, storing the projected cache misses in sted_cache"""
+    for (tags, _, _, name_found), cache_item, (elements, _) in zip(pending, pending_cache, iter_pending(pending)):
+        if cache_item is not None:
+            stedsnr, key, records = cache_item
+            positions = list()
+            for node in elements:
+                if isinstance(node, osmapis.Node):
+                    positions.extend((node.attribs['lon'], node.attribs['lat']))
+            sted_cache.put(stedsnr, key, {'result': (tags, positions, name_found), 'log': records})
+        yield elements, name_found
+
+def iter_pending(pending):
+    """Projects the positions of all the (tags, epsg, positions, name_found) elements in pending
+    in a single batch and yields ([osmapis.Node], name_found)
+    (or ([osmapis.Node, ..., osmapis.Way], name_found) for multiple positions).
+    Positions with epsg None are already projected (lon, lat), e.g. from ssr2_sted_cache."""
+    coordinates = dict()        # epsg: flat array of x, y coordinates
+    for _, epsg, positions, _ in pending:
+        if epsg is None:
+            continue
+        if epsg not in coordinates:
+            coordinates[epsg] = array('d')
+        coordinates[epsg].extend(positions)
+
+    points = dict()
+    with ssr2_timing.stage('projection'):
+        projected = ssr2_projection.transform_batch(coordinates)
+    for epsg, (lon, lat) in projected.items():
+        points[epsg] = zip(lon, lat)
+
+    for tags, epsg, positions, name_found in pending:
+        if epsg is None:
+            lonlat = zip(positions[0::2], positions[1::2])
+        else:
+            lonlat = points[epsg]
+        
+        if len(positions) == 2:
+            lon, lat = next(lonlat)
+            elements = [osmapis.Node(attribs={'lat': lat, 'lon': lon}, tags=tags)]
+        else:
+            elements = list()
+            for ix in range(len(positions)//2):
+                lon, lat = next(lonlat)
+                node = osmapis.Node(attribs={'lat': lat, 'lon': lon},
+                                    tags={'ssr:gml_nr': str(ix)})
+                elements.append(node)
+            elements.append(osmapis.Way(tags=tags, nds=[node.id for node in elements]))
 
-    return osm, osm_noName
+        yield elements, name_found
 
 class EmptyResultException(Exception):
     pass
 
-def fetch_and_process_kommune(kommunenummer, xml_filename, osm_filename, osm_filename_noName, geonorge_urls,
-                              character_limit=-1, create_multipoint_way=False, url=None):
+def fetch_kommune(kommunenummer, xml_filename, geonorge_urls, url=None, wfs_url=None, archive=False,
+                  page_size=0, page_parallel=1, raw_store=None):
+    """Download (or read from cache) the geonorge data for the given kommune,
+    returns (source, format) where source is a binary file-like object.
+    Use wfs_url to replace the geonorge WFS, e.g. with a local stand-in server.
+    Use page_size to fetch from the WFS in pages, with up to page_parallel concurrent requests.
+    With archive=True, xml_filename is the partition of the national archive, see ssr2_archive.
+    With a ssr2_raw_store.RawStore, the download is moved to the store and read from it.
+    Raises geonorge_download.DownloadFailed if the download failed (after the retries)."""
     if not(isinstance(kommunenummer, str)):
         raise ValueError('expected kommunenummer to be a string e.g. "0529"')
 
+    if archive:
+        if not(os.path.exists(xml_filename)):
+            raise EmptyResultException('No <Sted> records for %s in the national archive' % kommunenummer)
+        return open(xml_filename, 'rb'), 'xml'
+
+    if raw_store is not None:
+        pointer = raw_store.pointer(kommunenummer)
+        if raw_store.is_fresh(pointer, geonorge_download.cache_age_days):
+            ssr2_raw_store.count('raw_store_hits')
+            return raw_store.open(pointer), raw_format(pointer)
+        elif pointer is not None:
+            # an outdated download, put it back so that it can be revalidated
+            raw_filename = xml_filename.replace('.xml', '.zip') if raw_format(pointer) == 'gml' else xml_filename
+            if not(os.path.exists(raw_filename)):
+                raw_store.restore(pointer, raw_filename)
+
     # xml = file_util.read_file('ssr2_query_template.xml')
     # xml = xml.format(kommunenummer="0529")
     
@@ -819,118 +1148,320 @@ def fetch_and_process_kommune(kommunenummer, xml_filename, osm_filename, osm_fil
     if url is None:
         try:
             url = geonorge_urls[kommunenummer]
-            d = geonorge_download.download_unzip_geonorge(url, xml_filename.replace('.xml', '.zip'))
+            d = geonorge_download.download_unzip_geonorge_stream(url, xml_filename.replace('.xml', '.zip'))
             format = 'gml'
         except KeyError as e:
             if len(geonorge_urls) != 0:
                 logger.error('Did not find %s in %s', kommunenummer, geonorge_urls.keys())
 
-            d = geonorge_download.legacy_download_geonorge(kommunenummer, xml_filename)
+            d = geonorge_download.legacy_download_geonorge_stream(kommunenummer, xml_filename, base_url=wfs_url,
+                                                                  page_size=page_size, page_parallel=page_parallel)
 
     else:
-        d = geonorge_download.legacy_download_geonorge(kommunenummer, xml_filename, url=url)
+        d = geonorge_download.legacy_download_geonorge_stream(kommunenummer, xml_filename, url=url,
+                                                              page_size=page_size, page_parallel=page_parallel)
+
+    if raw_store is not None:
+        d.close()
+        pointer = raw_store.put(kommunenummer, xml_filename.replace('.xml', '.zip') if format == 'gml' else xml_filename)
+        d = raw_store.open(pointer)
+
+    return d, format
+
+def raw_format(pointer):
+    """The fetch_kommune format of a ssr2_raw_store pointer"""
+    return 'gml' if pointer['object'].endswith('.zip') else 'xml'
+
+def open_raw_store(args):
+    if args.raw_store is None:
+        return None
+    return ssr2_raw_store.RawStore(args.raw_store)
+
+def sample_stedsnr(stedsnr, sample_rate):
+    """Deterministic sampling, returns True for approximately sample_rate (0 to 1) of all stedsnummer"""
+    return zlib.crc32(stedsnr.encode('utf-8')) < sample_rate*2**32
+
+def select_entries(entries, max_sted=-1, sample_rate=1.):
+    """Yields at most max_sted (-1 for all) of the given <Sted> entries,
+    where only sample_rate (0 to 1) of the entries are kept, based on a hash of stedsnummer.
+    Stops consuming entries (and parsing, for the streaming engine) once max_sted is reached."""
+    count = 0
+    for entry in entries:
+        if max_sted != -1 and count >= max_sted:
+            break
         
-    if d is None:
-        msg = 'Unable to fetch %s, cached to %s' % (url, xml_filename)
-        logger.error(msg)
-        raise EmptyResultException(msg)
-    
-    # parse xml:
-    soup = BeautifulSoup(d[:character_limit], 'lxml-xml')
-    osm, osm_noName = parse_geonorge(soup, create_multipoint_way=create_multipoint_way,
-                                     soup_format=format)
-    
-    # Save result:
-    if len(osm) != 0:
-        osm.save(osm_filename)
-    else:
-        #print(soup.prettify())
-        raise EmptyResultException('Empty osm result for %s' % kommunenummer)
+        if sample_rate < 1:
+            stedsnr = entry.find('stedsnummer').text
+            if not(sample_stedsnr(stedsnr, sample_rate)):
+                continue
+
+        count += 1
+        yield entry
+
+def iter_kommune(source, format='xml', character_limit=-1, create_multipoint_way=False, parser='stream',
+                 max_sted=-1, sample_rate=1., sted_cache=None, parse_processes=1, chunk_threshold=50000, chunk_size=1000):
+    """Parse the binary file-like source from fetch_kommune, yields (elements, name_found), see iter_geonorge_entries.
+    Use max_sted and sample_rate to only parse some of the <Sted> records, see select_entries.
+    parse_processes, chunk_threshold and chunk_size are only used by the "stream" parser, see iter_transformed.
+    source is closed when done."""
+    if isinstance(source, (zipfile.ZipExtFile, gzip.GzipFile)):
+        # the input is decompressed as it is read, within the parse stage
+        source = ssr2_timing.timed_reader(source, 'unzip', within='parse')
+    try:
+        if parser == 'soup':
+            with ssr2_timing.stage('parse'):
+                d = source.read()
+                source.close()
+                soup = BeautifulSoup(d[:character_limit], 'lxml-xml')
+                del d
+                entries = soup.find_all('Sted')
+            parse_processes = 1
+        elif parser == 'stream':
+            recover = False
+            if character_limit != -1:
+                with ssr2_timing.stage('parse'):
+                    source = io.BytesIO(source.read(character_limit))
+                recover = True # truncated xml
+            entries = ssr2_timing.timed(ssr2_stream.iter_sted(source, recover=recover), 'parse')
+        else:
+            raise ValueError('Unknown parser = "%s", expected "soup" or "stream"' % parser)
+
+        if max_sted != -1 or sample_rate < 1:
+            entries = select_entries(entries, max_sted=max_sted, sample_rate=sample_rate)
+
+        for item in iter_geonorge_entries(entries, create_multipoint_way=create_multipoint_way,
+                                          sted_cache=sted_cache, parse_processes=parse_processes,
+                                          chunk_threshold=chunk_threshold, chunk_size=chunk_size):
+            yield item
+    finally:
+        source.close()
+
+def write_kommune(elements_iter, folder, n, conversion, args):
+    """Writes the (elements, name_found) from iter_kommune to the output files for kommune n, as they arrive:
+    %s.osm, %s-NoTags.osm, %s-NoName.osm, %s-NoName-NoTags.osm and the clean/ copies without the ssr:* debug tags,
+    split by "hovedgruppe" (or %s-ssr.osm and %s-ssr-NoName.osm with --not_convert_tags).
+    Returns the list of filenames written."""
+    output_clean_folder = os.path.join(folder, 'clean')
+    filename_clean = os.path.join(output_clean_folder, '%s.osm' % n)
+    count_name = 0
+
+    sinks = ssr2_writer.OSMSinks(order=args.output_order)
+    try:
+        for elements, name_found in elements_iter:
+            element = elements[-1]
+            if name_found:
+                count_name += 1
+                filename_base = os.path.join(folder, n)
+            else:
+                filename_base = os.path.join(folder, '%s-NoName' % n)
 
-    if len(osm_noName) != 0:
-        osm_noName.save(osm_filename_noName)
+            if args.not_convert_tags:
+                filename_ssr = os.path.join(folder, ('%s-ssr.osm' if name_found else '%s-ssr-NoName.osm') % n)
+                with ssr2_timing.stage('save'):
+                    for item in elements:
+                        sinks.write(filename_ssr, item)
+                continue
+
+            with ssr2_timing.stage('tag_conversion'):
+                tags = ssr2_tags.convert_element_tags(element, conversion, include_empty=args.include_empty_tags)
+            if tags is None:
+                with ssr2_timing.stage('save'):
+                    for item in elements:
+                        sinks.write('%s-NoTags.osm' % filename_base, item)
+                continue
+
+            element.tags = tags
+            with ssr2_timing.stage('save'):
+                for item in elements:
+                    sinks.write('%s.osm' % filename_base, item)
+
+            if name_found:
+                with ssr2_timing.stage('split'):
+                    filenames_clean = [filename_clean]
+                    if not(args.not_split_hovedgruppe) and 'ssr:hovedgruppe' in tags:
+                        filenames_clean.append(ssr2_split.split_filename(filename_clean, tags['ssr:hovedgruppe']))
+
+                    for item in elements:
+                        tags_clean = dict(item.tags)
+                        for key in ssr2_tags.debug_tags:
+                            tags_clean.pop(key, '')
+                        for filename in filenames_clean:
+                            sinks.write(filename, item, tags=tags_clean)
+    except:
+        sinks.remove()
+        raise
+
+    with ssr2_timing.stage('save'):
+        sinks.close()
+    if count_name == 0:
+        sinks.remove()
+        raise EmptyResultException('Empty osm result for %s' % n)
+
+    return sinks.filenames()
+
+def convert_kommune(source, format, folder, n, conversion, args, parser, sted_cache=None):
+    """Parse source (see fetch_kommune) with the given parser and write the output files, see write_kommune"""
+    elements_iter = iter_kommune(source, format,
+                                 character_limit=args.character_limit,
+                                 create_multipoint_way=args.create_multipoint_way,
+                                 parser=parser,
+                                 max_sted=args.max_sted,
+                                 sample_rate=args.sample_rate,
+                                 sted_cache=sted_cache,
+                                 parse_processes=args.parse_processes,
+                                 chunk_threshold=args.parse_threshold,
+                                 chunk_size=args.parse_chunk_size)
+    return write_kommune(elements_iter, folder, n, conversion, args)
+
+def prefetch_kommune(job, root, geonorge_urls, wfs_url=None, page_size=0, page_parallel=1, raw_store=None):
+    """Download stage of the --parallel pipeline, job is (kommunenummer, url) where url is None
+    for the default url. Fills the cache read by fetch_kommune in main."""
+    n, url = job
+    xml_filename = os.path.join(root, n, '%s-ssr.xml' % n)
+    file_util.create_dirname(xml_filename)
+    d, _ = fetch_kommune(n, xml_filename=xml_filename, geonorge_urls=geonorge_urls,
+                         url=url, wfs_url=wfs_url, page_size=page_size, page_parallel=page_parallel,
+                         raw_store=raw_store)
+    d.close()
+
+def sted_cache_version(args):
+    """The logic_version of the sted cache, the code version and the arguments used by transform_entry"""
+    return '%s create_multipoint_way=%s' % (ssr2_manifest.code_version(), args.create_multipoint_way)
+
+def cache_statistics(name, info_start, info_end):
+    """Hits and misses between two functools.lru_cache cache_info() calls as a Counter"""
+    return Counter({'%s_hits' % name: info_end.hits - info_start.hits,
+                    '%s_misses' % name: info_end.misses - info_start.misses})
+
+def remove_output(folder, n):
+    """Removes the output files of a previous run of kommune n"""
+    ssr2_manifest.remove_manifest(folder, n)
     
-    return osm
+    for f in glob.glob(os.path.join(folder, '*.osm')):
+        os.remove(f)
+
+    output_clean_folder = os.path.join(folder, 'clean')
+    if os.path.exists(output_clean_folder):
+        shutil.rmtree(output_clean_folder)
+    os.mkdir(output_clean_folder)
 
 def main(args, folder, n, conversion, geonorge_urls, url=None):
+    """Fetch and process kommune n, returns a Counter with run statistics.
+    Kommune n is skipped (keeping the existing output) if the input, conversion, code and arguments
+    are unchanged since the last run, see ssr2_manifest, unless args.force is given."""
     print(n)
     start_time_kommune = datetime.datetime.now()
+    statistics = Counter()
+    date_cache_start = normalize_date.cache_info()
+    chunk_start = Counter(chunk_statistics)
+    logging_start = Counter(ssr2_logging.statistics)
+    download_start = Counter(geonorge_download.statistics)
+    raw_store_start = Counter(ssr2_raw_store.statistics)
+    timings_start = Counter(ssr2_timing.timings)
+    profiler = None
+    if args.profile:
+        profiler = cProfile.Profile()
+        profiler.enable()
     
-    for f in glob.glob(os.path.join(folder, '*.osm')):
-        os.remove(f)
-
     xml_filename = os.path.join(folder, '%s-ssr.xml' % n)
-    osm_filename = os.path.join(folder, '%s-ssr.osm' % n)
-    osm_filename_noName = os.path.join(folder, '%s-ssr-NoName.osm' % n)
+    if args.archive is not None:
+        xml_filename = ssr2_archive.partition_filename(os.path.dirname(folder), n)
     log_filename = os.path.join(folder, '%s.log' % n)
+    sted_cache = None
 
     file_util.create_dirname(log_filename)
-    logging_fh = add_file_handler(log_filename)
-
-    output_clean_folder = os.path.join(folder, 'clean')
-    if os.path.exists(output_clean_folder):
-        shutil.rmtree(output_clean_folder)
-    os.mkdir(output_clean_folder)
 
     # json_names_filename = os.path.join(folder, '%s-multi-names.json' % n)
     # csv_names_filename = os.path.join(folder, '%s-multi-names.csv' % n)
 
-    # Go from %s-geonorge.xml to %s-all.osm
+    # Go from %s-ssr.xml to %s.osm, %s-NoTags.osm and the clean/ files,
+    # the osm elements are written as they are parsed
     try:
-        fetch_and_process_kommune(n, xml_filename=xml_filename,
-                                  geonorge_urls=geonorge_urls,
-                                  url=url,
-                                  osm_filename=osm_filename,
-                                  osm_filename_noName=osm_filename_noName,
-                                  character_limit=args.character_limit,
-                                  create_multipoint_way=args.create_multipoint_way)
+        # fetch before removing the previous output, which is kept if nothing has changed
+        raw_store = open_raw_store(args)
+        with ssr2_timing.stage('download'):
+            d, format = fetch_kommune(n, xml_filename=xml_filename,
+                                      geonorge_urls=geonorge_urls,
+                                      url=url, wfs_url=args.wfs_url,
+                                      archive=args.archive is not None,
+                                      page_size=args.wfs_page_size, page_parallel=args.wfs_page_parallel,
+                                      raw_store=raw_store)
+        input_filename = xml_filename if format == 'xml' else xml_filename.replace('.xml', '.zip')
+        if raw_store is not None and args.archive is None:
+            input_filename = raw_store.pointer(n)['object']
+        with ssr2_timing.stage('manifest'):
+            previous_manifest = ssr2_manifest.load_manifest(folder, n)
+            manifest = ssr2_manifest.create_manifest(input_filename, conversion, args, previous=previous_manifest)
+            unchanged = ssr2_manifest.is_unchanged(folder, manifest, previous_manifest)
+        if not(args.force) and unchanged:
+            d.close()
+            print('Unchanged: Kommune = %s, skipping' % n)
+            statistics['kommune_unchanged'] += 1
+            return statistics
+
+        with ssr2_timing.stage('cleanup'):
+            remove_output(folder, n)
+        ssr2_logging.start_kommune(n, log_filename)
+
+        if args.sted_cache is not None:
+            file_util.create_dirname(os.path.join(args.sted_cache, n))
+            sted_cache = ssr2_sted_cache.StedCache(os.path.join(args.sted_cache, '%s.sqlite' % n),
+                                                   logic_version=sted_cache_version(args),
+                                                   max_age_runs=args.sted_cache_runs)
+        
+        try:
+            filenames = convert_kommune(d, format, folder, n, conversion, args, args.parser, sted_cache=sted_cache)
+        except etree.XMLSyntaxError as e:
+            # the stream parser is strict, the soup parser accepts (recovers from) minor errors in the input
+            if args.parser != 'stream':
+                raise
+            logger.warning('Kommune %s: %s, trying again with --parser soup', n, e)
+            statistics['parser_fallback'] += 1
+            d, format = fetch_kommune(n, xml_filename=xml_filename,
+                                      geonorge_urls=geonorge_urls,
+                                      url=url, wfs_url=args.wfs_url,
+                                      archive=args.archive is not None,
+                                      page_size=args.wfs_page_size, page_parallel=args.wfs_page_parallel,
+                                      raw_store=raw_store)
+            filenames = convert_kommune(d, format, folder, n, conversion, args, 'soup', sted_cache=sted_cache)
     except EmptyResultException as e:
         print('Empty result', e)
-        return
-
-    filenames_to_clean = list()
-    # Go from %s-all.osm to %s-all-tagged.osm, removing %s-all.osm when done
-    if not(args.not_convert_tags):
-        for convert_filename in (osm_filename_noName, osm_filename):
-            if os.path.exists(convert_filename):
-                filename_base = convert_filename[:-len('.osm')]
-                filename_out = "%s.osm" % filename_base.replace('-ssr', '') #'%s.osm' % (filename_base)
-                filename_out_notTagged = '%s-%s.osm' % (filename_base.replace('-ssr', ''), 'NoTags')
-                #filename_out_notTagged = filename_out_notTagged.replace('-all', '')
-                
-                ssr2_tags.replace_tags(convert_filename,
-                                       filename_out, filename_out_notTagged,
-                                       conversion, include_empty=args.include_empty_tags)
-                # osm_filename should now be redundant, as all the information is in either filename_out or filename_out_notTagged
-                # fixme: actually loop through and check this.
-                if os.path.exists(filename_out) or os.path.exists(filename_out_notTagged):
-                    os.remove(convert_filename)
-
-        head, tail = os.path.split(filename_out)
-        filename_out_cleaned = os.path.join(output_clean_folder, tail)
-        shutil.copy(filename_out, filename_out_cleaned)
-        filenames_to_clean.append(filename_out_cleaned)
-
-    if not(args.not_split_hovedgruppe):
-        split_filenames = ssr2_split.osm_split(filename_out_cleaned, split_key='ssr:hovedgruppe')
-        filenames_to_clean.extend(split_filenames)
-
-    # FIXME: function
-    for filename in filenames_to_clean:
-        content = file_util.read_file(filename)
-        osm = osmapis.OSM.from_xml(content)
-        tags_to_remove = ('ssr:hovedgruppe', 'ssr:gruppe', 'ssr:type', 'ssr:date')
-        for item in osm:
-            for key in tags_to_remove:
-                item.tags.pop(key, '')
-        osm.save(filename)
-        #shutil.move(filename, output_clean_folder)
+        ssr2_logging.end_kommune()
+        return statistics
+    except:
+        ssr2_logging.end_kommune()
+        raise
+    finally:
+        if sted_cache is not None:
+            sted_cache.close()
+            statistics.update({'sted_cache_hits': sted_cache.hits,
+                               'sted_cache_misses': sted_cache.misses,
+                               'sted_cache_evicted': sted_cache.evicted})
+        statistics.update(cache_statistics('date_cache', date_cache_start, normalize_date.cache_info()))
+        statistics.update(chunk_statistics - chunk_start)
+        statistics['duration_seconds'] = (datetime.datetime.now() - start_time_kommune).total_seconds()
+        statistics.update(ssr2_logging.statistics - logging_start)
+        statistics.update(Counter(geonorge_download.statistics) - download_start)
+        statistics.update(Counter(ssr2_raw_store.statistics) - raw_store_start)
+        statistics.update(ssr2_timing.stage_statistics(timings_start, ssr2_timing.timings))
+        if profiler is not None:
+            profiler.disable()
+            profile_filename = os.path.join(args.state_dir, 'profile', '%s.prof' % n)
+            file_util.create_dirname(profile_filename)
+            profiler.dump_stats(profile_filename)
 
     end_time = datetime.datetime.now()
     #logger.info('Done: Kommune = %s, Duration: %s', n, end_time - start_time_kommune)
     print('Done: Kommune = %s, Duration: %s' % (n, end_time - start_time_kommune)) # reduce diff size of logs
-        
-    logger.removeHandler(logging_fh)
+    # not logged, the cache and http counts change from run to run and the logs are committed with the output
+    print('Statistics: Kommune = %s, %s' % (n, dict((key, value) for key, value in statistics.items()
+                                                   if not(key.startswith('seconds_') or key.endswith('_seconds')))))
+
+    ssr2_logging.end_kommune()
+    with ssr2_timing.stage('manifest'):
+        ssr2_manifest.save_manifest(folder, n, manifest, filenames + [log_filename])
+    statistics['kommune_processed'] += 1
+    return statistics
 
 if __name__ == '__main__':
     import argparse
@@ -939,6 +1470,8 @@ if __name__ == '__main__':
 
     parser.add_argument('--output', default='output', 
                         help='Output root (working) directory. This tool will store files under <root>/<kommunenummer>/')
+    parser.add_argument('--state_dir', default=None,
+                        help='Directory for the state of the batch run, kept out of --output so that the output can be committed as is: journal.json, durations.json, timing.json/.csv and the --profile dumps. Default is <output>-state next to the output directory')
     parser.add_argument('--kommune', nargs='+', default=['ALL'], 
                         help='Specify one or more kommune (by kommune-number or kommune-name), or use the default "ALL" (slow!)')
     parser.add_argument('--excel_tagging', default=None,
@@ -946,7 +1479,21 @@ if __name__ == '__main__':
     parser.add_argument('--json_tagging', default='../ssr2osm/navnetyper_tagged.json',
                         help='Specify json conversion file, used to convert from ssr category to osm tags, assumed this format: https://github.com/NKAmapper/ssr2osm/blob/main/navnetyper_tagged.json.')
     parser.add_argument('--character_limit', default=-1, type=int,
-                        help='For quicker debugging, reduce the number of characters sent to the xml-parser, recommended --character_limit 100000 when playing around')
+                        help='Deprecated, use --max_sted. For quicker debugging, reduce the number of characters sent to the xml-parser (gives truncated xml)')
+    parser.add_argument('--max_sted', '--max-sted', default=-1, type=int,
+                        help='For quicker debugging and benchmarking, stop parsing after the given number of <Sted> records, recommended --max_sted 1000 when playing around')
+    parser.add_argument('--sample_rate', '--sample-rate', default=1., type=float,
+                        help='For quicker debugging and benchmarking, only process a deterministic sample (based on a hash of stedsnummer) of the <Sted> records, e.g. --sample_rate 0.1 for 10%%')
+    parser.add_argument('--parser', default='stream', choices=['stream', 'soup'],
+                        help='xml parser engine, "stream" parses one <Sted> at a time keeping memory usage flat, "soup" is the legacy BeautifulSoup engine reading the entire document into memory. The "stream" parser is strict, a kommune with an xml syntax error is parsed again with "soup", which recovers from minor errors')
+    parser.add_argument('--parse_processes', default=None, type=int,
+                        help='Transform the <Sted> records of a large kommune in chunks across the given number of processes, 1 transforms them in a single process. Only used by the "stream" parser. With --parallel, each job above --parse_threshold starts its own processes, so the default is a share of the cpus for each job: the number of cpus divided by --parallel')
+    parser.add_argument('--parse_threshold', default=50000, type=int,
+                        help='With --parse_processes, the number of <Sted> records transformed in a single process before the remaining records are split into chunks')
+    parser.add_argument('--parse_chunk_size', default=1000, type=int,
+                        help='With --parse_processes, the number of <Sted> records in each chunk')
+    parser.add_argument('--output_order', default='arrival', choices=['arrival', 'id'],
+                        help='Order of the elements in the .osm output files, "arrival" writes the elements as they are parsed, "id" sorts the elements by type and id (buffered until the file is complete)')
     parser.add_argument('--create_multipoint_way', default=False, action='store_true',
                         help='For debugging: create a osm-way for all elements that have multiple locations associated with it.')
     parser.add_argument('--not_split_hovedgruppe', default=False, action='store_true',
@@ -959,22 +1506,73 @@ if __name__ == '__main__':
                         help='Do not download "land=zz", which contains nodes outside of mainland Norway')
     parser.add_argument('--parallel', default=0, type=int,
                         help='Process kommune list in parrallel using specified number of processes')
+    parser.add_argument('--download_parallel', default=0, type=int,
+                        help='With --parallel, download the kommune files using the specified number of threads, ahead of the processing. The default 0 lets each process download its own kommune')
+    parser.add_argument('--download_queue', default=None, type=int,
+                        help='With --download_parallel, the maximum number of kommuner downloaded (or downloading) but not yet processed, default is --parallel + --download_parallel')
+    parser.add_argument('--sted_cache', default=None,
+                        help='Directory for a persistent per-place cache of the name resolution and projected coordinates, so that unchanged places are not processed again (one sqlite file for each kommune)')
+    parser.add_argument('--sted_cache_runs', default=5, type=int,
+                        help='With --sted_cache, remove places not seen for the given number of runs')
+    parser.add_argument('--resume', default=False, action='store_true',
+                        help='Continue an interrupted run, skipping the kommuner already done (and those failed --max_attempts times), see <state_dir>/journal.json')
+    parser.add_argument('--max_attempts', default=3, type=int,
+                        help='With --resume, the maximum number of attempts for a failing kommune')
+    parser.add_argument('--profile', default=False, action='store_true',
+                        help='Save a cProfile dump for each kommune to <state_dir>/profile/<kommunenummer>.prof, the time spent in each stage is always written to <state_dir>/timing.json and timing.csv')
+    parser.add_argument('--force', default=False, action='store_true',
+                        help='Process all kommuner, also those where the input, tagging table, code and arguments are unchanged since the last run')
+    parser.add_argument('--archive', default=None,
+                        help='Read all kommuner from the national archive (Basisdata_0000_Norge_..._Stedsnavn_GML.zip) instead of downloading each kommune: a local .zip or .xml file, an url, or "geonorge" for the current archive url. The archive is split by kommune in a single pass before the processing')
+    parser.add_argument('--wfs_page_size', default=0, type=int,
+                        help='Fetch from the WFS in pages of the given number of <Sted> records (WFS 2.0 count and startIndex, sorted by stedsnummer), each page is retried on its own and kept until all pages are merged, and all pages are fetched again if they do not add up to numberMatched. The default 0 fetches each kommune in a single request')
+    parser.add_argument('--wfs_page_parallel', default=2, type=int,
+                        help='With --wfs_page_size, the maximum number of concurrent page requests for each kommune')
+    parser.add_argument('--raw_store', default=None,
+                        help='Directory for a compressed, content-addressed store of the downloaded input, instead of keeping <kommunenummer>-ssr.xml uncompressed in each kommune folder. Identical downloads are stored once')
+    parser.add_argument('--raw_store_max_age', default=30., type=float,
+                        help='With --raw_store, remove stored downloads no kommune points to anymore after the given number of days without use')
+    parser.add_argument('--raw_store_max_gb', default=None, type=float,
+                        help='With --raw_store, remove the least recently used downloads no kommune points to anymore, until the store is at most the given size')
+    parser.add_argument('--max_retries', default=3, type=int,
+                        help='Retry a failed or incomplete download up to the given number of times, with exponential backoff')
+    parser.add_argument('--retry_backoff', default=2., type=float,
+                        help='Seconds to wait before the first retry of a download, doubled for each further retry (with random jitter)')
+    parser.add_argument('--retry_max_backoff', default=120., type=float,
+                        help='The maximum number of seconds to wait before a retry')
+    parser.add_argument('--retry_budget', default=100, type=int,
+                        help='The maximum number of download retries for the entire run, so that an unavailable server does not stall the run')
+    parser.add_argument('--request_interval', default=0.5, type=float,
+                        help='The minimum number of seconds between the start of two download requests, across all processes and threads of the run, to be gentle to geonorge.no')
+    parser.add_argument('--geonorge_url', default=None,
+                        help='Download the zip file of each kommune from the given geonorge download listing instead of the WFS, e.g. %s or a local stand-in server for testing' % geonorge_download.geonorge_base_url)
+    parser.add_argument('--wfs_url', default=None,
+                        help='Replace the geonorge WFS url (%s), e.g. with a local stand-in server for testing' % geonorge_download.wfs_base_url)
 
     start_time = datetime.datetime.now()
     
     args = parser.parse_args()
-
+    if not(0 < args.sample_rate <= 1):
+        parser.error('--sample_rate should be in the range (0, 1], got %s' % args.sample_rate)
+    if args.download_queue is not None and args.download_queue < 1:
+        parser.error('--download_queue should be at least 1, got %s' % args.download_queue)
+    if args.parse_processes is None:
+        # the chunk processes of all the --parallel jobs together should not exceed the number of cpus
+        args.parse_processes = max(1, (os.cpu_count() or 1)//max(1, args.parallel))
+
+    # all records (also from the pool workers) are written by a single listener,
+    # to the console and to the log file of the kommune they belong to
     root_logger = logger = logging.getLogger('utility_to_osm')
-    root_logger.setLevel(logging.DEBUG)
-    formatter = logging.Formatter('%(name)s - %(levelname)s - %(message)s')
-    ch = logging.StreamHandler()
-    ch.setLevel(args.loglevel)
-    ch.setFormatter(formatter)
-    root_logger.addHandler(ch)
+    log_queue = multiprocessing.Queue() if args.parallel != 0 else None
+    log_listener = ssr2_logging.start_listener(args.loglevel, log_queue)
 
     file_util.create_dirname(args.output)
     if not(os.path.exists(args.output)):
         os.mkdir(args.output)
+    if args.state_dir is None:
+        args.state_dir = os.path.normpath(args.output) + '-state'
+    if not(os.path.exists(args.state_dir)):
+        os.makedirs(args.state_dir)
 
     if args.kommune == ['ALL']:
         nr2name, _ = kommunenummer()
@@ -993,53 +1591,180 @@ if __name__ == '__main__':
     #group_overview = defaultdict(list)
     root = args.output
 
-    # Lets not use this, use legacy API
-    #geonorge_urls = geonorge_download.get_geonorge_url_dct()
-    geonorge_urls = dict() 
+    # Lets not use this by default, use legacy API
+    geonorge_urls = dict()
+    if args.geonorge_url is not None:
+        geonorge_urls = geonorge_download.get_geonorge_url_dct(args.geonorge_url)
 
+    jobs = list()
     if args.include_zz:
-        url = 'http://wfs.geonorge.no/skwms1/wfs.stedsnavn50?VERSION=2.0.0&SERVICE=WFS&srsName=EPSG:25832&REQUEST=GetFeature&TYPENAME=Sted&resultType=results&Filter=%3CFilter%3E%20%3CPropertyIsEqualTo%3E%20%3CValueReference%20xmlns:app=%22http://skjema.geonorge.no/SOSI/produktspesifikasjon/Stedsnavn/5.0%22%3Eapp:land/app:Land/app:landnummer%3C/ValueReference%3E%20%3CLiteral%3E{land}%3C/Literal%3E%20%3C/PropertyIsEqualTo%3E%20%3C/Filter%3E" --header "Content-Type:text/xml"'
-        url = url.format(land='ZZ')
-
-        n = 'ZZ'
-        folder = os.path.join(root, n)
-        main(args, folder, n, conversion, geonorge_urls, url=url)
+        url = geonorge_download.legacy_land_url('ZZ', base_url=args.wfs_url)
+        jobs.append(ssr2_schedule.Job('ZZ', url))
+    for n in kommunenummer:
+        jobs.append(ssr2_schedule.Job(n, None))
+
+    # a single retry budget and rate limit for the downloads of all processes
+    retry_budget = multiprocessing.Value('i', args.retry_budget)
+    request_clock = multiprocessing.Value('d', 0.)
+    configure_downloads(args, retry_budget, request_clock)
+
+    # the state of each job is recorded in the journal, so that an interrupted run can be continued with --resume
+    journal = ssr2_journal.Journal(ssr2_journal.journal_filename(args.state_dir), resume=args.resume)
+    jobs = journal.select(jobs, max_attempts=args.max_attempts)
+
+    if args.archive is not None:
+        # a single pass through the national archive replaces the per-kommune downloads
+        archive = args.archive
+        if archive == 'geonorge':
+            archive = geonorge_download.get_geonorge_archive_url(args.geonorge_url or geonorge_download.geonorge_base_url)
+            if archive is None:
+                parser.error('Did not find the national archive at geonorge, use --archive with a file or url')
+        start_time_archive = datetime.datetime.now()
+        archive_counts = ssr2_archive.partition_archive(ssr2_archive.open_archive(archive, root), root,
+                                                        kommuner=set(job.n for job in jobs))
+        print('Archive: %s records for %s of %s kommuner, duration: %s' % (sum(archive_counts.values()), len(archive_counts),
+                                                                       len(jobs), datetime.datetime.now() - start_time_archive))
+        args.download_parallel = 0
 
     if args.parallel != 0:
-        p = Pool(args.parallel, init_pool_worker)
+        # longest job first, so that the largest kommuner do not start last and stretch the total duration
+        costs = ssr2_schedule.expected_costs(root, [job.n for job in jobs], args.state_dir)
+        jobs = ssr2_schedule.order_jobs(jobs, costs)
+        logger.debug('Job order: %s', [job.n for job in jobs])
+        # the shared read-only state is sent once to each worker, each job is then only the Job itself
+        shared_state = {'args': args, 'conversion': conversion, 'geonorge_urls': geonorge_urls}
+        p = NonDaemonPool(args.parallel, init_pool_worker, (dict(shared_state, log_queue=log_listener.log_queue,
+                                                                 retry_budget=retry_budget,
+                                                                 request_clock=request_clock,
+                                                                 log_level=root_logger.level), ))
+
+        if len(jobs) != 0:
+            job = jobs[0]
+            shared_size, shared_time = dispatch_payload_size(shared_state)
+            job_size, job_time = dispatch_payload_size(job, time.time())
+            legacy_size, legacy_time = dispatch_payload_size(args, os.path.join(root, job.n), job.n,
+                                                             conversion, geonorge_urls, job.url)
+            print('Dispatch: %d bytes (%.2f ms) for each job, %d bytes (%.2f ms) once for each worker, '
+                  'instead of %d bytes (%.2f ms) for each job' % (job_size, job_time*1000, shared_size, shared_time*1000,
+                                                                 legacy_size, legacy_time*1000))
     
+    start_time_pool = datetime.datetime.now()
     p_results = list()
     fatal_errors = list()
-    for n in kommunenummer:
-        folder = os.path.join(root, n)
-        if args.parallel != 0:
-            res = p.apply_async(main, (args, folder, n, conversion, geonorge_urls))
-            p_results.append((n, res))
-            #time.sleep(1) # to to be sligtly gentle to geonorge.no
-        else:
-            #main(args, folder, n, conversion)
-            try:
-                main(args, folder, n, conversion, geonorge_urls)
-            except Exception as e:
-                trace = traceback.format_exc()
-                logger.error('Fatal error:%s %s', n, e)
-                fatal_errors.append('ERROR: Komune %s failed with: %s.\n%s' % (n, e, trace))
-        
+    statistics = Counter()
+    durations = dict()
+
+    timing_rows = list()
+
+    def job_done(n, statistics_kommune):
+        journal.set_state(n, 'done')
+        timing_row = {'kommune': n}
+        for key, value in statistics_kommune.items():
+            if key.startswith('seconds_') or key == 'duration_seconds':
+                timing_row[key] = value
+        timing_rows.append(timing_row)
+        if statistics_kommune['kommune_processed']:
+            durations[n] = statistics_kommune['duration_seconds']
+        statistics.update(statistics_kommune)
+        statistics['jobs_done'] += 1
+
+    def job_failed(n, e, trace):
+        journal.set_state(n, 'failed', error=e)
+        logger.error('Fatal error:%s %s', n, e)
+        fatal_errors.append('ERROR: Komune %s failed with: %s.\n%s' % (n, e, trace))
+        statistics['jobs_failed'] += 1
+
+    def print_progress():
         end_time = datetime.datetime.now()
-        print('Elapsed time: {}'.format(end_time - start_time))
+        print('Progress: {} of {} jobs done, {} failed, elapsed time: {}'.format(statistics['jobs_done'], len(jobs),
+                                                                               statistics['jobs_failed'],
+                                                                               end_time - start_time))
+    
+    if args.parallel != 0 and args.download_parallel != 0:
+        # Two stage pipeline, the downloads run in threads ahead of the process pool,
+        # a download queue slot is freed once the kommune is processed
+        download_queue = args.download_queue
+        if download_queue is None:
+            download_queue = args.parallel + args.download_parallel
+        raw_store = open_raw_store(args)
+        def prefetch(job):
+            journal.set_state(job.n, 'downloading')
+            prefetch_kommune(job, root=root, geonorge_urls=geonorge_urls, wfs_url=args.wfs_url,
+                             page_size=args.wfs_page_size, page_parallel=args.wfs_page_parallel,
+                             raw_store=raw_store)
+        prefetcher = ssr2_prefetch.Prefetcher(prefetch, parallel=args.download_parallel, queue_depth=download_queue)
+        release = lambda _: prefetcher.release()
+        
+        for job, download_seconds, error in prefetcher.iter_fetched(jobs):
+            statistics['download_seconds'] += download_seconds
+            if error is not None:
+                prefetcher.release()
+                trace = ''.join(traceback.format_exception(type(error), error, error.__traceback__))
+                job_failed(job.n, error, trace)
+                continue
+            
+            journal.set_state(job.n, 'processing')
+            res = p.apply_async(run_job, (job, time.time()),
+                                callback=release, error_callback=release)
+            p_results.append((job.n, res))
+    else:
+        for job in jobs:
+            folder = os.path.join(root, job.n)
+            journal.set_state(job.n, 'processing')
+            if args.parallel != 0:
+                res = p.apply_async(run_job, (job, time.time()))
+                p_results.append((job.n, res))
+                #time.sleep(1) # to to be sligtly gentle to geonorge.no
+            else:
+                #main(args, folder, n, conversion)
+                try:
+                    job_done(job.n, main(args, folder, job.n, conversion, geonorge_urls, job.url))
+                except Exception as e:
+                    job_failed(job.n, e, traceback.format_exc())
+                print_progress()
 
     # Wait for all pool results:
     for n, res in p_results:
         try:
-            res.get()
+            job_done(n, res.get())
         except Exception as e:
-            trace = traceback.format_exc()
-            logger.error('Fatal error:%s %s', n, e)
-            fatal_errors.append('ERROR: Komune %s failed with: %s.\n%s' % (n, e, trace))
+            job_failed(n, e, traceback.format_exc())
+        print_progress()
+    if args.parallel != 0:
+        # the workers are not daemonic, see NonDaemonPool
+        p.close()
+        p.join()
         
+    journal_counts = journal.counts()
+    print('Journal: %s' % ', '.join('%s = %s' % (state, journal_counts[state]) for state in ssr2_journal.states))
+    makespan = (datetime.datetime.now() - start_time_pool).total_seconds()
+    ssr2_schedule.save_durations(args.state_dir, durations)
+    ssr2_timing.write_report(args.state_dir, timing_rows)
+    print(ssr2_schedule.makespan_summary(durations, args.parallel, makespan))
+    if statistics['jobs_done'] != 0 and 'dispatch_wait_seconds' in statistics:
+        print('Dispatch: mean time from submit to start of a job (including the wait for a free worker) %.3f s' % (statistics['dispatch_wait_seconds']/statistics['jobs_done']))
+
 
     for error in fatal_errors:
         print(error)
+
+    if args.raw_store is not None:
+        max_bytes = args.raw_store_max_gb*1e9 if args.raw_store_max_gb is not None else None
+        statistics['raw_store_evicted'] = open_raw_store(args).evict(max_age_days=args.raw_store_max_age,
+                                                                     max_bytes=max_bytes)
+
+    if args.parallel != 0:
+        statistics.update(ssr2_logging.statistics) # the records from this process
+        statistics.update(geonorge_download.statistics) # the prefetched downloads
+        statistics.update(ssr2_raw_store.statistics)
+    if statistics['http_requests'] != 0:
+        print('Download: %s requests, %s not modified, %.1f MB downloaded, %.1f MB saved by revalidation, '
+              '%s retries (%s of the retry budget left)' % (
+            statistics['http_requests'], statistics['http_not_modified'],
+            statistics['http_bytes_downloaded']/1e6, statistics['http_bytes_saved']/1e6,
+            statistics['http_retries'], retry_budget.value))
+    for key in sorted(statistics.keys()):
+        print('Statistics: %s = %s' % (key, statistics[key]))
         
     # table = list()
     # for key in sorted(group_overview.keys()):
@@ -1062,3 +1787,4 @@ if __name__ == '__main__':
     
     end_time = datetime.datetime.now()
     print('Duration: {}'.format(end_time - start_time))
+    ssr2_logging.stop_listener(log_listener)
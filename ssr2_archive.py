@@ -0,0 +1,141 @@
+# National archive ingest (--archive): the <Sted> records of the single nationwide geonorge archive
+# (Basisdata_0000_Norge_..._Stedsnavn_GML.zip) are split by the kommunenummer inside each record,
+# in one streaming pass, into <root>/<kommunenummer>/<kommunenummer>-archive.xml.
+# These are then processed like the per-kommune downloads, see ssr2.fetch_kommune.
+import os
+from collections import Counter
+import logging
+logger = logging.getLogger('utility_to_osm.ssr2.ssr2_archive')
+
+# third party
+from lxml import etree
+
+import ssr2_stream
+import geonorge_download
+
+def partition_filename(root, n):
+    """Not <n>-ssr.xml, which is the (revalidated) WFS download of the kommune when run without --archive"""
+    return os.path.join(root, n, '%s-archive.xml' % n)
+
+def qualified_name(element):
+    """'wfs:member' for a {http://www.opengis.net/wfs/2.0}member element"""
+    name = ssr2_stream.localname(element.tag)
+    if element.prefix is not None:
+        return '%s:%s' % (element.prefix, name)
+    return name
+
+def record_keys(sted):
+    """The work units of a <Sted> lxml element, each of its kommunenummer and 'ZZ' for land ZZ,
+    matching the WFS queries of geonorge_download.legacy_url and legacy_land_url"""
+    keys = list()
+    for element in sted.iterdescendants('{*}kommunenummer'):
+        if element.text and element.text.strip() not in keys:
+            keys.append(element.text.strip())
+    for element in sted.iterdescendants('{*}landnummer'):
+        if element.text and element.text.strip() == 'ZZ' and 'ZZ' not in keys:
+            keys.append('ZZ')
+    return keys
+
+class PartitionWriter(object):
+    """The open partition files, each a copy of the archive root element with the selected members.
+    The files are written to a temporary name and only replace the previous partition on close."""
+    def __init__(self, root, root_element):
+        self.root = root
+        self.files = dict()         # kommunenummer: open file
+
+        # the root start and end tag, without numberMatched and numberReturned (which no longer apply)
+        copy = etree.Element(root_element.tag, nsmap=root_element.nsmap)
+        copy.text = '\n'
+        header, _, footer = etree.tostring(copy, encoding='unicode').rpartition('</')
+        self.header = ("<?xml version='1.0' encoding='UTF-8'?>\n" + header).encode('utf-8')
+        self.footer = ('</' + footer + '\n').encode('utf-8')
+
+    def write(self, n, member_name, sted):
+        f = self.files.get(n)
+        if f is None:
+            filename = partition_filename(self.root, n)
+            if not(os.path.exists(os.path.dirname(filename))):
+                os.makedirs(os.path.dirname(filename))
+            f = open(filename + '.part', 'wb')
+            f.write(self.header)
+            self.files[n] = f
+
+        f.write(('<%s>' % member_name).encode('utf-8'))
+        f.write(sted)
+        f.write(('</%s>\n' % member_name).encode('utf-8'))
+
+    def close(self):
+        for n, f in self.files.items():
+            f.write(self.footer)
+            f.close()
+            filename = partition_filename(self.root, n)
+            os.replace(filename + '.part', filename)
+        self.files = dict()
+
+    def abort(self):
+        """Removes the unfinished partitions, keeping the previous ones"""
+        for n, f in self.files.items():
+            f.close()
+            os.remove(partition_filename(self.root, n) + '.part')
+        self.files = dict()
+
+def open_archive(archive, root):
+    """Returns a binary file-like object for the national archive, archive is either a local .zip or .xml file,
+    or an url that is downloaded to root (and revalidated, see geonorge_download.get_cached_conditional)"""
+    if archive.startswith('http://') or archive.startswith('https://'):
+        filename = os.path.join(root, os.path.basename(archive))
+        geonorge_download.get_cached_conditional(archive, filename)
+        archive = filename
+
+    if archive.endswith('.zip'):
+        return geonorge_download.open_unzip(archive)
+    return open(archive, 'rb')
+
+def partition_archive(source, root, kommuner=None):
+    """Splits the <Sted> records of source (binary file-like object) into <root>/<n>/<n>-archive.xml for each kommune n,
+    records in more than one kommune are written to each of them. Only the kommuner in kommuner are kept if given,
+    the previous partition of a kommune without records is removed.
+    Returns a Counter with the number of records for each kommune."""
+    counts = Counter()
+    writer = None
+    skipped = 0
+    member_names = dict()           # tag: qualified name
+    try:
+        for entry in ssr2_stream.iter_sted(source):
+            sted = entry.element
+            member = sted.getparent()
+            root_element = sted.getroottree().getroot()
+            if writer is None:
+                writer = PartitionWriter(root, root_element)
+
+            keys = record_keys(sted)
+            if kommuner is not None:
+                keys = [n for n in keys if n in kommuner]
+            if len(keys) == 0:
+                skipped += 1
+                continue
+
+            if member.tag not in member_names:
+                member_names[member.tag] = qualified_name(member)
+            data = etree.tostring(sted, encoding='utf-8', with_tail=False)
+            for n in keys:
+                writer.write(n, member_names[member.tag], data)
+                counts[n] += 1
+    except:
+        if writer is not None:
+            writer.abort()
+        raise
+    finally:
+        source.close()
+
+    if writer is not None:
+        writer.close()
+
+    if kommuner is not None:
+        for n in kommuner:
+            if counts[n] == 0 and os.path.exists(partition_filename(root, n)):
+                os.remove(partition_filename(root, n))
+
+    logger.info('Partitioned %s records into %s kommuner, skipped %s records',
+                sum(counts.values()), len(counts), skipped)
+    return counts
@@ -0,0 +1,83 @@
+# Run journal (<state_dir>/journal.json) with the state of each job in the current batch run:
+# pending -> downloading -> processing -> done or failed.
+# The journal is rewritten atomically on each change, so that an interrupted run can be continued with --resume.
+import os
+import json
+import datetime
+import threading
+from collections import Counter
+import logging
+logger = logging.getLogger('utility_to_osm.ssr2.ssr2_journal')
+
+states = ('pending', 'downloading', 'processing', 'done', 'failed')
+
+def journal_filename(state_dir):
+    return os.path.join(state_dir, 'journal.json')
+
+class Journal(object):
+    """{kommunenummer: {'state': state, 'attempts': attempts, 'error': last error}} stored in filename.
+    With resume=True the previous journal is continued, otherwise a new run is started."""
+    def __init__(self, filename, resume=False):
+        self.filename = filename
+        self.lock = threading.Lock()
+        self.jobs = dict()
+        self.started = datetime.datetime.now().isoformat()
+        if resume and os.path.exists(filename):
+            try:
+                with open(filename, 'r') as f:
+                    journal = json.load(f)
+                self.jobs = journal['jobs']
+                self.started = journal['started']
+            except (ValueError, KeyError) as e:
+                logger.warning('Ignoring invalid journal %s: %s', filename, e)
+
+    def select(self, jobs, max_attempts=3):
+        """Returns the ssr2_schedule.Job's in jobs that should be run, skipping the jobs already done and
+        the jobs that have failed max_attempts times. The selected jobs are set to pending."""
+        selected = list()
+        skipped = Counter()
+        with self.lock:
+            for job in jobs:
+                entry = self.jobs.setdefault(job.n, {'state': 'pending', 'attempts': 0, 'error': None})
+                if entry['state'] == 'done':
+                    skipped['done'] += 1
+                elif entry['state'] == 'failed' and entry['attempts'] >= max_attempts:
+                    skipped['failed'] += 1
+                    logger.warning('Not retrying %s, failed %s times: %s', job.n, entry['attempts'], entry['error'])
+                else:
+                    entry['state'] = 'pending'
+                    selected.append(job)
+            self._save()
+
+        if len(skipped) != 0:
+            logger.info('Resuming run from %s, skipping %s done and %s failed (after %s attempts)',
+                        self.started, skipped['done'], skipped['failed'], max_attempts)
+        return selected
+
+    def set_state(self, n, state, error=None):
+        """Record the new state of job n, an attempt is counted each time a pending job is started"""
+        if state not in states:
+            raise ValueError('Unknown state "%s", expected one of %s' % (state, states))
+
+        with self.lock:
+            entry = self.jobs.setdefault(n, {'state': 'pending', 'attempts': 0, 'error': None})
+            if entry['state'] == 'pending' and state in ('downloading', 'processing'):
+                entry['attempts'] += 1
+            entry['state'] = state
+            if state == 'failed':
+                entry['error'] = str(error)
+            elif state == 'done':
+                entry['error'] = None
+            self._save()
+
+    def counts(self):
+        """Counter with the number of jobs in each state"""
+        with self.lock:
+            return Counter(entry['state'] for entry in self.jobs.values())
+
+    def _save(self):
+        with open(self.filename + '.tmp', 'w') as f:
+            json.dump({'started': self.started, 'jobs': self.jobs}, f, indent=1, sort_keys=True)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(self.filename + '.tmp', self.filename)
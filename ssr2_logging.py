@@ -0,0 +1,148 @@
+# Logging for ssr2.py, the records of all processes are sent through a single queue to a listener
+# in the main process, which writes them to the console and to the log file of the kommune being processed.
+import time
+import queue
+import logging
+import logging.handlers
+from collections import Counter
+
+formatter = logging.Formatter('%(name)s - %(levelname)s - %(message)s')
+file_level = logging.INFO           # level of the per-kommune log files
+
+# logging overhead in this process, records sent and seconds spent sending them
+statistics = Counter()
+
+# the kommune (and log filename) being processed in this process, see start_kommune
+current_kommune = None
+current_log_filename = None
+_queue_handler = None
+
+class KommuneFilter(logging.Filter):
+    """Tags each record with the kommune (and log filename) being processed"""
+    def filter(self, record):
+        record.kommune = current_kommune
+        record.kommune_log = current_log_filename
+        return True
+
+class TimedQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler counting the records and the time spent formatting and sending them"""
+    def emit(self, record):
+        start = time.perf_counter()
+        super(TimedQueueHandler, self).emit(record)
+        statistics['log_records'] += 1
+        statistics['log_seconds'] += time.perf_counter() - start
+
+def is_control(record):
+    return getattr(record, 'kommune_control', None) is not None
+
+class ConsoleFilter(logging.Filter):
+    def filter(self, record):
+        return not(is_control(record))
+
+class KommuneRouter(logging.Handler):
+    """Writes the records of each kommune to its log file, the file is (re)created by the 'start'
+    control record from start_kommune and closed by the 'end' control record from end_kommune"""
+    def __init__(self, level=file_level):
+        super(KommuneRouter, self).__init__(level=logging.NOTSET)
+        self.file_level = level
+        self.files = dict()         # filename: logging.FileHandler
+
+    def handle(self, record):
+        # the control records bypass the level check
+        filename = getattr(record, 'kommune_log', None)
+        if filename is None:
+            return False
+
+        control = getattr(record, 'kommune_control', None)
+        if control == 'start':
+            self._close(filename)
+            fh = logging.FileHandler(filename, mode='w')
+            fh.setFormatter(formatter)
+            self.files[filename] = fh
+        elif control == 'end':
+            self._close(filename)
+        elif record.levelno >= self.file_level:
+            if filename not in self.files:
+                # a late record, after end_kommune
+                fh = logging.FileHandler(filename, mode='a')
+                fh.setFormatter(formatter)
+                self.files[filename] = fh
+            self.files[filename].handle(record)
+        return True
+
+    def emit(self, record):
+        self.handle(record)
+
+    def _close(self, filename):
+        fh = self.files.pop(filename, None)
+        if fh is not None:
+            fh.close()
+
+    def close(self):
+        for filename in list(self.files.keys()):
+            self._close(filename)
+        super(KommuneRouter, self).close()
+
+def logger_level(console_level):
+    """The level for the 'utility_to_osm' logger, so that records no handler wants are never created.
+    The per-kommune log files are written at file_level, so a higher console_level (e.g. -q) only
+    quiets the console, the INFO records are still created and sent to the listener."""
+    return min(console_level, file_level)
+
+def install_queue_handler(log_queue, level):
+    """Send all 'utility_to_osm' records of this process to log_queue, e.g. in a pool worker"""
+    global _queue_handler
+    root_logger = logging.getLogger('utility_to_osm')
+    for handler in list(root_logger.handlers):
+        root_logger.removeHandler(handler)
+
+    _queue_handler = TimedQueueHandler(log_queue)
+    _queue_handler.addFilter(KommuneFilter())
+    root_logger.addHandler(_queue_handler)
+    root_logger.setLevel(level)
+    root_logger.propagate = False
+
+def start_listener(console_level, log_queue=None):
+    """Starts the listener in the main process, writing to the console (at console_level) and to the
+    per-kommune log files. Use log_queue=multiprocessing.Queue() when records are sent from other processes.
+    The records of this process are sent through the same queue. Returns the QueueListener, stop it when done."""
+    if log_queue is None:
+        log_queue = queue.Queue()
+
+    ch = logging.StreamHandler()
+    ch.setLevel(console_level)
+    ch.setFormatter(formatter)
+    ch.addFilter(ConsoleFilter())
+
+    listener = logging.handlers.QueueListener(log_queue, ch, KommuneRouter(), respect_handler_level=True)
+    listener.start()
+    listener.log_queue = log_queue
+    install_queue_handler(log_queue, logger_level(console_level))
+    return listener
+
+def stop_listener(listener):
+    listener.stop()
+    for handler in listener.handlers:
+        handler.close()
+
+def _send_control(control):
+    record = logging.LogRecord('utility_to_osm.ssr2', logging.INFO, __file__, 0, '', None, None)
+    record.kommune_control = control
+    _queue_handler.handle(record)
+
+def start_kommune(n, log_filename):
+    """Route the records from this process to log_filename, until end_kommune"""
+    global current_kommune, current_log_filename
+    current_kommune = n
+    current_log_filename = log_filename
+    if _queue_handler is not None:
+        _send_control('start')
+    else:
+        logging.getLogger('utility_to_osm.ssr2').warning('Logging is not set up, see ssr2_logging.start_listener')
+
+def end_kommune():
+    global current_kommune, current_log_filename
+    if _queue_handler is not None and current_log_filename is not None:
+        _send_control('end')
+    current_kommune = None
+    current_log_filename = None
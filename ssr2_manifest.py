@@ -0,0 +1,138 @@
+# Per-kommune manifest (<folder>/<kommunenummer>-manifest.json), recording what the output files
+# were created from: the raw input, the conversion table, the code version and the relevant arguments.
+# A kommune where none of these have changed, and all outputs still exist, does not need to be processed again.
+import os
+import io
+import re
+import glob
+import gzip
+import json
+import hashlib
+import functools
+import logging
+logger = logging.getLogger('utility_to_osm.ssr2.ssr2_manifest')
+
+import geonorge_download
+
+# the arguments that change the content of the output files
+manifest_args = ('character_limit', 'max_sted', 'sample_rate', 'parser', 'output_order',
+                 'create_multipoint_way', 'not_split_hovedgruppe', 'not_convert_tags', 'include_empty_tags')
+
+def manifest_filename(folder, n):
+    return os.path.join(folder, '%s-manifest.json' % n)
+
+# the root element, e.g. <wfs:FeatureCollection ...>, is the first tag that is not <?xml ...?> or a <!-- comment -->
+root_start_reg = re.compile(rb'<[^?!][^>]*>')
+# attributes of the WFS root element that change with each request, also when the content is unchanged
+volatile_attributes_reg = re.compile(rb'\s(timeStamp|numberReturned|next|previous)="[^"]*"')
+
+def normalize_head(head):
+    """Removes the volatile attributes from the start tag of the root element in head (the start of the xml)"""
+    match = root_start_reg.search(head)
+    if match is None:
+        return head
+    return head[:match.start()] + volatile_attributes_reg.sub(b'', match.group()) + head[match.end():]
+
+def open_input(filename):
+    """Binary file-like object for the xml in filename, a .xml, .xml.gz (see ssr2_raw_store) or .zip file"""
+    if filename.endswith('.zip'):
+        return geonorge_download.open_unzip(filename)
+    elif filename.endswith('.gz'):
+        return gzip.open(filename, 'rb')
+    return open(filename, 'rb')
+
+def content_sha256(filename, chunk_size=2**20, head_size=2**16):
+    """sha256 of the xml in filename, without the volatile attributes of the root element (see normalize_head),
+    so that two downloads of unchanged content have the same hash"""
+    h = hashlib.sha256()
+    with open_input(filename) as f:
+        h.update(normalize_head(f.read(head_size)))
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+def conversion_sha256(conversion):
+    dump = json.dumps(conversion, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(dump.encode('utf-8')).hexdigest()
+
+@functools.lru_cache(maxsize=None)
+def code_version():
+    """Hash of the python source of this tool"""
+    folder = os.path.dirname(os.path.abspath(__file__))
+    filenames = glob.glob(os.path.join(folder, 'ssr2*.py'))
+    filenames.append(os.path.join(folder, 'geonorge_download.py'))
+    h = hashlib.sha256()
+    for filename in sorted(filenames):
+        h.update(os.path.basename(filename).encode('utf-8'))
+        with open(filename, 'rb') as f:
+            h.update(f.read())
+    return h.hexdigest()
+
+def load_manifest(folder, n):
+    """Returns the stored manifest for kommune n, or None"""
+    filename = manifest_filename(folder, n)
+    if not(os.path.exists(filename)):
+        return None
+    try:
+        with io.open(filename, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except ValueError as e:
+        logger.warning('Ignoring invalid %s: %s', filename, e)
+        return None
+
+def input_info(input_filename, previous=None):
+    """Size, modification time and content_sha256 of input_filename,
+    the hash is reused from the previous manifest if the size and modification time are unchanged"""
+    stat = os.stat(input_filename)
+    info = {'filename': os.path.basename(input_filename),
+            'size': stat.st_size,
+            'mtime_ns': stat.st_mtime_ns}
+    if previous is not None:
+        previous_info = previous.get('input', {})
+        if all(previous_info.get(key) == info[key] for key in info) and 'content_sha256' in previous_info:
+            info['content_sha256'] = previous_info['content_sha256']
+            return info
+
+    info['content_sha256'] = content_sha256(input_filename)
+    return info
+
+def create_manifest(input_filename, conversion, args, previous=None):
+    """The manifest for the current input, without the list of outputs"""
+    return {'input': input_info(input_filename, previous=previous),
+            'conversion_sha256': conversion_sha256(conversion),
+            'code_version': code_version(),
+            'args': dict((key, getattr(args, key)) for key in manifest_args)}
+
+def is_unchanged(folder, manifest, previous):
+    """True if the previous manifest has the same input, conversion, code and arguments,
+    and all of its output files still exist in folder"""
+    if previous is None:
+        return False
+
+    if previous.get('input', {}).get('content_sha256') != manifest['input']['content_sha256']:
+        return False
+    for key in ('conversion_sha256', 'code_version', 'args'):
+        if previous.get(key) != manifest[key]:
+            return False
+
+    outputs = previous.get('outputs')
+    if not(outputs):
+        return False
+    for filename in outputs:
+        if not(os.path.exists(os.path.join(folder, filename))):
+            return False
+    return True
+
+def remove_manifest(folder, n):
+    filename = manifest_filename(folder, n)
+    if os.path.exists(filename):
+        os.remove(filename)
+
+def save_manifest(folder, n, manifest, outputs):
+    """Stores manifest for kommune n, with outputs being the created files (relative to folder or absolute)"""
+    manifest = dict(manifest)
+    manifest['outputs'] = sorted(os.path.relpath(filename, folder) for filename in outputs)
+    filename = manifest_filename(folder, n)
+    with io.open(filename + '.tmp', 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True, ensure_ascii=False)
+    os.replace(filename + '.tmp', filename)
@@ -0,0 +1,53 @@
+# Download stage of the --parallel pipeline: a few threads prefetch the kommune input files
+# into the cache, ahead of the (CPU bound) process pool that parses and writes the osm files.
+# The requests themselves are rate limited across all threads and processes by geonorge_download.configure_rate_limit.
+import time
+import queue
+import threading
+import concurrent.futures
+import logging
+logger = logging.getLogger('utility_to_osm.ssr2.ssr2_prefetch')
+
+class Prefetcher(object):
+    """Calls fetch(job) for each job using parallel threads.
+    At most queue_depth jobs are downloading or waiting to be processed at any time,
+    a slot is freed by calling release() once the processing of a fetched job is done."""
+    def __init__(self, fetch, parallel=2, queue_depth=4):
+        if parallel < 1 or queue_depth < 1:
+            raise ValueError('Expected parallel and queue_depth >= 1, got %s and %s' % (parallel, queue_depth))
+        self.fetch = fetch
+        self.parallel = parallel
+        self.slots = threading.BoundedSemaphore(queue_depth)
+
+    def release(self):
+        """Frees the queue slot of a fetched job, call once for each job yielded by iter_fetched"""
+        self.slots.release()
+
+    def _fetch(self, job):
+        start = time.monotonic()
+        self.fetch(job)
+        return time.monotonic() - start
+
+    def _feed(self, jobs, executor, done):
+        for job in jobs:
+            self.slots.acquire()
+            future = executor.submit(self._fetch, job)
+            future.add_done_callback(lambda future, job=job: done.put((job, future)))
+
+    def iter_fetched(self, jobs):
+        """Yields (job, duration, error) in the order the downloads complete, where duration is the
+        download time in seconds and error is the exception raised by fetch (or None)"""
+        jobs = list(jobs)
+        done = queue.Queue()
+        with concurrent.futures.ThreadPoolExecutor(self.parallel) as executor:
+            feeder = threading.Thread(target=self._feed, args=(jobs, executor, done), daemon=True)
+            feeder.start()
+            for _ in range(len(jobs)):
+                job, future = done.get()
+                error = future.exception()
+                if error is not None:
+                    logger.error('Download failed for %s: %s', job, error)
+                    yield job, 0., error
+                else:
+                    yield job, future.result(), None
+            feeder.join()
@@ -0,0 +1,39 @@
+# Coordinate transformation from the geonorge projections (25832/25833/25835/4258) to lon/lat.
+# Each source projection is only set up once per process, see get_transformer.
+import functools
+import logging
+logger = logging.getLogger('utility_to_osm.ssr2.ssr2_projection')
+
+# third party
+import pyproj
+
+def to_epsg(srs_name):
+    """Translate e.g. 'urn:ogc:def:crs:EPSG::25832' into 'EPSG:25832'"""
+    epsg = srs_name.replace('::', ':')
+    sg_split = epsg.split(':')
+    if len(sg_split) != 2:
+        epsg = ':'.join(sg_split[-2:])
+    return epsg
+
+@functools.lru_cache(maxsize=None)
+def get_transformer(srs_name):
+    """Returns a (cached) pyproj.Transformer from srs_name to its geographic lon/lat,
+    equivalent to pyproj.Proj(init=epsg)(x, y, inverse=True)."""
+    epsg = to_epsg(srs_name)
+    crs = pyproj.CRS.from_user_input(epsg)
+    logger.debug('creating transformer for %s', epsg)
+    return pyproj.Transformer.from_crs(crs, crs.geodetic_crs, always_xy=True)
+
+def transform(xs, ys, srs_name):
+    """Transform the arrays xs and ys (in srs_name) to arrays lon, lat"""
+    transformer = get_transformer(srs_name)
+    return transformer.transform(xs, ys)
+
+def transform_batch(coordinates):
+    """Reprojects all positions with a single call for each srsName,
+    coordinates is a dictionary {srs_name: array('d', [x0, y0, x1, y1, ...])},
+    returns a dictionary {srs_name: (lon, lat)} where lon and lat are arrays."""
+    result = dict()
+    for srs_name, coords in coordinates.items():
+        result[srs_name] = transform(coords[0::2], coords[1::2], srs_name)
+    return result
@@ -0,0 +1,153 @@
+# Compressed, content-addressed store for the raw geonorge input (--raw_store), instead of keeping
+# <kommunenummer>-ssr.xml uncompressed in each kommune folder:
+#   <store>/objects/<sha256[:2]>/<sha256>.xml.gz    gzip of the raw xml (a .zip input is stored as is)
+#   <store>/pointers/<kommunenummer>.json           the current object of each kommune
+# The key is ssr2_manifest.content_sha256, which ignores the per-request attributes of the WFS response (timeStamp, ...),
+# so identical payloads (e.g. an unchanged kommune fetched again) are stored once. Objects no longer pointed to
+# are kept for re-use until evicted, see RawStore.evict.
+import os
+import json
+import gzip
+import time
+import shutil
+import threading
+from collections import Counter
+import logging
+logger = logging.getLogger('utility_to_osm.ssr2.ssr2_raw_store')
+
+import geonorge_download
+import ssr2_manifest
+
+# store statistics for this process
+statistics = Counter()
+_statistics_lock = threading.Lock()
+
+def count(key, value=1):
+    with _statistics_lock:
+        statistics[key] += value
+
+class RawStore(object):
+    """The raw input store in folder, see the module description"""
+    def __init__(self, folder, compresslevel=6):
+        self.folder = folder
+        self.compresslevel = compresslevel
+        for name in ('objects', 'pointers'):
+            if not(os.path.exists(os.path.join(folder, name))):
+                os.makedirs(os.path.join(folder, name), exist_ok=True)
+
+    def pointer_filename(self, n):
+        return os.path.join(self.folder, 'pointers', '%s.json' % n)
+
+    def object_filename(self, sha256, suffix):
+        return os.path.join(self.folder, 'objects', sha256[:2], sha256 + suffix)
+
+    def pointer(self, n):
+        """The pointer of kommune n, {'sha256', 'object', 'size', 'stored_size', 'checked'}, or None"""
+        try:
+            with open(self.pointer_filename(n), 'r') as f:
+                pointer = json.load(f)
+        except (IOError, ValueError):
+            return None
+        pointer['object'] = os.path.join(self.folder, pointer['object'])
+        if not(os.path.exists(pointer['object'])):
+            logger.warning('Missing object %s for %s, ignoring the pointer', pointer['object'], n)
+            return None
+        return pointer
+
+    def is_fresh(self, pointer, old_age_days):
+        """True if the object was downloaded (or revalidated) less than old_age_days ago"""
+        return pointer is not None and (time.time() - pointer['checked'])/(24*60*60) < old_age_days
+
+    def put(self, n, filename, chunk_size=2**20):
+        """Moves the downloaded filename (.xml or .zip) into the store and points kommune n to it.
+        The download metadata (<filename>.meta.json) is kept, so that the next download can be revalidated."""
+        sha256 = ssr2_manifest.content_sha256(filename, chunk_size=chunk_size)
+        size = os.path.getsize(filename)
+
+        if filename.endswith('.zip'):
+            object_filename = self.object_filename(sha256, '.zip') # already compressed
+        else:
+            object_filename = self.object_filename(sha256, '.xml.gz')
+
+        if os.path.exists(object_filename):
+            count('raw_store_dedup')
+        else:
+            if not(os.path.exists(os.path.dirname(object_filename))):
+                os.makedirs(os.path.dirname(object_filename), exist_ok=True)
+            tmp_filename = '%s.%s.tmp' % (object_filename, os.getpid())
+            if filename.endswith('.zip'):
+                shutil.copyfile(filename, tmp_filename)
+            else:
+                with open(filename, 'rb') as f, open(tmp_filename, 'wb') as raw:
+                    # mtime=0 keeps the compressed object reproducible
+                    with gzip.GzipFile(filename='', mode='wb', fileobj=raw,
+                                       compresslevel=self.compresslevel, mtime=0) as out:
+                        shutil.copyfileobj(f, out, chunk_size)
+            os.replace(tmp_filename, object_filename)
+            count('raw_store_objects')
+            count('raw_store_bytes_saved', size - os.path.getsize(object_filename))
+
+        meta = geonorge_download.read_meta(filename)
+        checked = meta['checked'] if meta is not None else os.path.getmtime(filename)
+        pointer = {'sha256': sha256,
+                   'object': os.path.relpath(object_filename, self.folder),
+                   'size': size,
+                   'stored_size': os.path.getsize(object_filename),
+                   'checked': checked}
+        with open(self.pointer_filename(n) + '.tmp', 'w') as f:
+            json.dump(pointer, f, indent=1, sort_keys=True)
+        os.replace(self.pointer_filename(n) + '.tmp', self.pointer_filename(n))
+        os.remove(filename)
+        return self.pointer(n)
+
+    def open(self, pointer):
+        """Returns a binary file-like object for the raw input, decompressed as it is read"""
+        # last use (access time) for evict, the modification time is kept for ssr2_manifest.input_info
+        os.utime(pointer['object'], (time.time(), os.path.getmtime(pointer['object'])))
+        if pointer['object'].endswith('.zip'):
+            return geonorge_download.open_unzip(pointer['object'])
+        return gzip.open(pointer['object'], 'rb')
+
+    def restore(self, pointer, filename):
+        """Decompress the object to filename, e.g. so that an outdated download can be revalidated"""
+        with self.open(pointer) as f, open(filename, 'wb') as out:
+            shutil.copyfileobj(f, out, 2**20)
+        os.utime(filename, (pointer['checked'], pointer['checked']))
+
+    def evict(self, max_age_days=None, max_bytes=None):
+        """Removes the objects no kommune points to that have not been used for max_age_days,
+        then the least recently used of these until the store is at most max_bytes.
+        Returns the number of objects removed."""
+        referenced = set()
+        for name in os.listdir(os.path.join(self.folder, 'pointers')):
+            if name.endswith('.json'):
+                pointer = self.pointer(name[:-len('.json')])
+                if pointer is not None:
+                    referenced.add(os.path.abspath(pointer['object']))
+
+        objects = list()
+        total = 0
+        for dirpath, _, filenames in os.walk(os.path.join(self.folder, 'objects')):
+            for name in filenames:
+                filename = os.path.join(dirpath, name)
+                stat = os.stat(filename)
+                total += stat.st_size
+                if os.path.abspath(filename) not in referenced and not(name.endswith('.tmp')):
+                    objects.append((max(stat.st_atime, stat.st_mtime), stat.st_size, filename))
+        objects.sort()                  # least recently used first
+
+        removed = 0
+        now = time.time()
+        for used, size, filename in objects:
+            too_old = max_age_days is not None and (now - used)/(24*60*60) > max_age_days
+            too_big = max_bytes is not None and total > max_bytes
+            if not(too_old or too_big):
+                continue
+            os.remove(filename)
+            total -= size
+            removed += 1
+
+        if max_bytes is not None and total > max_bytes:
+            logger.warning('Raw store %s is %s bytes, above %s, with only the current objects left',
+                           self.folder, total, max_bytes)
+        return removed
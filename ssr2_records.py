@@ -0,0 +1,71 @@
+# Compact intermediate record model for a parsed <Sted> -> <Stedsnavn> -> <Skrivemåte>,
+# the osm tags are only created once the names are resolved, see ssr2.resolve_names.
+from sys import intern
+
+class Sted(object):
+    """A parsed <Sted>, where names, historic_names and local_names are lists of Skrivemaate
+    sorted by (name_status_num, order_spelling), see ssr2.parse_stedsnavn_buckets"""
+    __slots__ = ('stedsnr', 'hovedgruppe', 'gruppe', 'type', 'date', 'language_priority',
+                 'names', 'historic_names', 'local_names')
+
+    def __init__(self, stedsnr, hovedgruppe, gruppe, type, date, language_priority,
+                 names=(), historic_names=(), local_names=()):
+        self.stedsnr = stedsnr
+        self.hovedgruppe = intern(hovedgruppe)
+        self.gruppe = intern(gruppe)
+        self.type = intern(type)
+        self.date = intern(date)
+        self.language_priority = intern(language_priority)
+        self.names = list(names)
+        self.historic_names = list(historic_names)
+        self.local_names = list(local_names)
+
+    def tags(self):
+        """Returns the ssr:* osm tags"""
+        return {'ssr:stedsnr': self.stedsnr,
+                'ssr:hovedgruppe': self.hovedgruppe,
+                'ssr:gruppe': self.gruppe,
+                'ssr:type': self.type,
+                'ssr:date': self.date}
+
+    def __repr__(self):
+        return 'Sted(%s, names=%s, historic_names=%s, local_names=%s)' % (self.stedsnr, self.names,
+                                                                          self.historic_names, self.local_names)
+
+class Stedsnavn(object):
+    """A <Stedsnavn>, shared by all of its spellings"""
+    __slots__ = ('language', 'name_status', 'name_status_num', 'eksonym', 'stedsnavnnummer')
+
+    def __init__(self, language, name_status, name_status_num, eksonym, stedsnavnnummer):
+        self.language = intern(language)
+        self.name_status = intern(name_status)
+        self.name_status_num = name_status_num
+        self.eksonym = intern(eksonym)
+        self.stedsnavnnummer = stedsnavnnummer
+
+class Skrivemaate(object):
+    """A single spelling (<Skrivemåte>) of a Stedsnavn"""
+    __slots__ = ('stedsnavn', 'name', 'date', 'order_spelling', 'priority_spelling', 'spelling_status')
+
+    def __init__(self, stedsnavn, name, date, order_spelling, priority_spelling, spelling_status):
+        self.stedsnavn = stedsnavn
+        self.name = name
+        self.date = intern(date)
+        self.order_spelling = order_spelling
+        self.priority_spelling = priority_spelling
+        self.spelling_status = intern(spelling_status)
+
+    @property
+    def language(self):
+        return self.stedsnavn.language
+
+    @property
+    def name_status(self):
+        return self.stedsnavn.name_status
+
+    @property
+    def name_status_num(self):
+        return self.stedsnavn.name_status_num
+
+    def __repr__(self):
+        return 'Skrivemaate(%r, language=%s, status=%s)' % (self.name, self.language, self.spelling_status)
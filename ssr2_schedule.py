@@ -0,0 +1,93 @@
+# Longest job first scheduling of the kommune jobs for --parallel,
+# using the durations from the previous run, or the size of the cached input files.
+import os
+import json
+import collections
+import logging
+logger = logging.getLogger('utility_to_osm.ssr2.ssr2_schedule')
+
+# A job for the pool, n is the kommunenummer (or e.g. 'ZZ') and url is None for the default geonorge url
+Job = collections.namedtuple('Job', ['n', 'url'])
+
+def durations_filename(state_dir):
+    return os.path.join(state_dir, 'durations.json')
+
+def load_durations(state_dir):
+    """Returns the per-kommune durations (in seconds) from the previous run, {kommunenummer: seconds}"""
+    filename = durations_filename(state_dir)
+    if not(os.path.exists(filename)):
+        return dict()
+
+    try:
+        with open(filename, 'r') as f:
+            return json.load(f)
+    except ValueError as e:
+        logger.warning('Ignoring invalid %s: %s', filename, e)
+        return dict()
+
+def save_durations(state_dir, durations):
+    """Updates the stored per-kommune durations with durations, {kommunenummer: seconds}"""
+    all_durations = load_durations(state_dir)
+    all_durations.update(durations)
+    filename = durations_filename(state_dir)
+    with open(filename + '.tmp', 'w') as f:
+        json.dump(all_durations, f, indent=1, sort_keys=True)
+    os.replace(filename + '.tmp', filename)
+
+def input_size(root, n):
+    """Size in bytes of the cached input for kommune n, or None if not cached"""
+    for ext in ('xml', 'zip'):
+        filename = os.path.join(root, n, '%s-ssr.%s' % (n, ext))
+        if os.path.exists(filename):
+            return os.path.getsize(filename)
+    return None
+
+def expected_costs(root, kommuner, state_dir):
+    """Returns {kommunenummer: expected cost in seconds}, based on the previous durations (in state_dir),
+    falling back to the cached input file size (scaled by the median seconds per byte of the kommuner with both).
+    Kommuner without any information get the largest known cost, so that they are started early."""
+    durations = load_durations(state_dir)
+    sizes = dict()
+    for n in kommuner:
+        size = input_size(root, n)
+        if size is not None:
+            sizes[n] = size
+
+    rates = sorted(durations[n]/sizes[n] for n in kommuner
+                   if n in durations and sizes.get(n, 0) != 0)
+    rate = rates[len(rates)//2] if len(rates) != 0 else None
+
+    costs = dict()
+    for n in kommuner:
+        if n in durations:
+            costs[n] = durations[n]
+        elif n in sizes and rate is not None:
+            costs[n] = sizes[n]*rate
+        elif n in sizes and len(durations) == 0:
+            costs[n] = sizes[n] # no durations at all, relative size is good enough for ordering
+
+    if len(costs) != 0:
+        unknown_cost = max(costs.values())
+        for n in kommuner:
+            if n not in costs:
+                costs[n] = unknown_cost
+
+    return costs
+
+def order_jobs(jobs, costs):
+    """Longest job first, jobs without a cost keep their relative order at the end"""
+    return [job for _, job in sorted(enumerate(jobs), key=lambda x: (-costs.get(x[1].n, -1), x[0]))]
+
+def makespan_summary(durations, parallel, makespan):
+    """Compares the achieved makespan (seconds) to the ideal for the given job durations (seconds),
+    the ideal is the larger of the total duration divided by the number of processes and the longest job"""
+    if len(durations) == 0:
+        return 'Makespan: no jobs'
+
+    parallel = max(1, parallel)
+    total = sum(durations.values())
+    longest = max(durations, key=durations.get)
+    ideal = max(total/parallel, durations[longest])
+    efficiency = 100.*ideal/makespan if makespan != 0 else 100.
+    return ('Makespan: %.0f s, ideal %.0f s (%.1f%%), total job duration %.0f s on %d processes, longest job %s = %.0f s'
+            % (makespan, ideal, efficiency, total, parallel, longest, durations[longest]))
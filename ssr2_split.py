@@ -47,14 +47,19 @@ def osm_split(filename_in, split_key='ssr:hovedgruppe'):
 
         # Save:
         if len(osm_new) != 0:
-            filename_out = filename_in.replace('.osm', '')
-            filename_out = filename_out.replace('-all', '')
-            filename_out = '%s-%s.osm' % (filename_out, split)
+            filename_out = split_filename(filename_in, split)
             osm_new.save(filename_out)
             filenames.append(filename_out)
 
     return filenames
 
+def split_filename(filename_in, split):
+    """Output filename for the given split value, e.g. 0301.osm -> 0301-bebyggelse.osm"""
+    filename_out = filename_in.replace('.osm', '')
+    filename_out = filename_out.replace('-all', '')
+    filename_out = '%s-%s.osm' % (filename_out, split)
+    return filename_out
+
 if __name__ == '__main__':
     import argparse
     parser = argparse.ArgumentParser(description='')
@@ -0,0 +1,84 @@
+# Persistent per-place cache of the <Sted> -> osm transformation (name resolution and projected coordinates),
+# one sqlite file per kommune. An entry is keyed by stedsnummer and a hash of the raw <Sted> xml
+# and the logic version (the code version and the arguments that change the transformation, e.g. --create_multipoint_way),
+# so any change to the place, to the name rules or to these arguments gives a cache miss.
+import json
+import hashlib
+import sqlite3
+import logging
+logger = logging.getLogger('utility_to_osm.ssr2.ssr2_sted_cache')
+
+class RecordCapture(logging.Handler):
+    """Collects (logger name, level, message) for the log records emitted while a place is transformed,
+    so that they can be repeated when the place is served from the cache"""
+    def __init__(self, level=logging.INFO):
+        super(RecordCapture, self).__init__(level=level)
+        self.records = list()
+
+    def emit(self, record):
+        self.records.append((record.name, record.levelno, record.getMessage()))
+
+def replay(records):
+    for name, level, message in records:
+        logging.getLogger(name).log(level, '%s', message)
+
+class StedCache(object):
+    """Cache of {stedsnr: (key, value)} in the sqlite database filename.
+    Each use of the cache counts as a run, entries not seen for max_age_runs runs are evicted on close."""
+    def __init__(self, filename, logic_version, max_age_runs=5):
+        self.filename = filename
+        self.logic_version = logic_version
+        self.max_age_runs = max_age_runs
+        self.hits = 0
+        self.misses = 0
+        self.evicted = 0
+        self._seen = list()     # stedsnr of the hits
+        self._new = list()      # (stedsnr, key, value) of the misses
+
+        self.db = sqlite3.connect(filename)
+        self.db.execute('CREATE TABLE IF NOT EXISTS sted (stedsnr TEXT PRIMARY KEY, key TEXT, value TEXT, last_run INTEGER)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value INTEGER)')
+        row = self.db.execute("SELECT value FROM meta WHERE name = 'run'").fetchone()
+        self.run = 1 if row is None else row[0] + 1
+
+    def key(self, fragment):
+        """Hash of the raw <Sted> xml fragment (str) and the logic version"""
+        h = hashlib.sha256(self.logic_version.encode('utf-8'))
+        h.update(fragment.encode('utf-8'))
+        return h.hexdigest()
+
+    def get(self, stedsnr, key):
+        """Returns the cached value for stedsnr (see put), or None on a cache miss"""
+        row = self.db.execute('SELECT key, value FROM sted WHERE stedsnr = ?', (stedsnr, )).fetchone()
+        if row is None or row[0] != key:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self._seen.append(stedsnr)
+        return json.loads(row[1])
+
+    def put(self, stedsnr, key, value):
+        """Store the json serializable value, written on close"""
+        self._new.append((stedsnr, key, json.dumps(value, ensure_ascii=False)))
+
+    def close(self):
+        """Writes the new entries and evicts the entries not seen for max_age_runs runs"""
+        with self.db:
+            self.db.executemany('UPDATE sted SET last_run = ? WHERE stedsnr = ?',
+                                ((self.run, stedsnr) for stedsnr in self._seen))
+            self.db.executemany('INSERT OR REPLACE INTO sted (stedsnr, key, value, last_run) VALUES (?, ?, ?, ?)',
+                                ((stedsnr, key, value, self.run) for stedsnr, key, value in self._new))
+            cursor = self.db.execute('DELETE FROM sted WHERE last_run <= ?', (self.run - self.max_age_runs, ))
+            self.evicted = cursor.rowcount
+            self.db.execute("INSERT OR REPLACE INTO meta (name, value) VALUES ('run', ?)", (self.run, ))
+        self.db.close()
+        self._seen = list()
+        self._new = list()
+        logger.debug('%s: %d hits, %d misses, %d evicted', self.filename, self.hits, self.misses, self.evicted)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
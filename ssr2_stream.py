@@ -0,0 +1,90 @@
+# Streaming, element-at-a-time, parsing of the geonorge <Sted> records.
+# Each record is freed once consumed, so peak memory does not grow with the input size.
+import logging
+logger = logging.getLogger('utility_to_osm.ssr2.ssr2_stream')
+
+# third party
+from lxml import etree
+
+def localname(tag):
+    """'{http://skjema.geonorge.no/...}Sted' -> 'Sted'"""
+    return tag.rpartition('}')[2]
+
+class Element(object):
+    """Wraps a lxml element, supporting the subset of the BeautifulSoup.Tag interface
+    used by ssr2.transform_entry: find, find_all, text, name, parent, [attribute] and prettify.
+    Names are matched on the local name (ignoring any namespace prefix), like the 'lxml-xml' soup.
+    """
+    __slots__ = ('element', )
+
+    def __init__(self, element):
+        self.element = element
+
+    @property
+    def name(self):
+        return localname(self.element.tag)
+
+    @property
+    def text(self):
+        return ''.join(self.element.itertext())
+
+    @property
+    def parent(self):
+        parent = self.element.getparent()
+        if parent is None:
+            return None
+        return Element(parent)
+
+    def find(self, name):
+        for element in self.element.iterdescendants('{*}%s' % name):
+            return Element(element)
+        return None
+
+    def find_all(self, name, recursive=True):
+        if recursive:
+            elements = self.element.iterdescendants('{*}%s' % name)
+        else:
+            elements = self.element.iterchildren('{*}%s' % name)
+        return [Element(element) for element in elements]
+
+    def __getitem__(self, key):
+        value = self.element.get(key)
+        if value is None:
+            # namespaced attribute, e.g. 'gml:id'
+            key = localname(key.replace(':', '}'))
+            for attrib_key, value in self.element.attrib.items():
+                if localname(attrib_key) == key:
+                    return value
+            raise KeyError(key)
+        return value
+
+    def prettify(self):
+        return etree.tostring(self.element, pretty_print=True, encoding='unicode')
+
+    def __str__(self):
+        return etree.tostring(self.element, encoding='unicode', with_tail=False)
+
+def from_string(fragment):
+    """Parse a single serialized element, str(Element), e.g. a <Sted> sent to another process"""
+    return Element(etree.fromstring(fragment))
+
+def iter_sted(source, tag='Sted', recover=False):
+    """Yields every <Sted> element in source (filename or binary file-like object)
+    wrapped as an Element. The element, and any already consumed siblings of it and
+    its ancestors, are freed before the next element is parsed.
+    Use recover=True to tolerate truncated input (see --character_limit).
+    """
+    context = etree.iterparse(source, events=('end', ), tag='{*}%s' % tag,
+                              huge_tree=True, recover=recover)
+    for _, element in context:
+        yield Element(element)
+
+        element.clear()
+        # drop the already consumed siblings of the element and of each of its ancestors
+        # (e.g. the <wfs:member> wrapping each <Sted>), so that the tree does not grow with the input
+        ancestor = element
+        while ancestor.getparent() is not None:
+            while ancestor.getprevious() is not None:
+                del ancestor.getparent()[0]
+            ancestor = ancestor.getparent()
+    del context
@@ -115,75 +115,12 @@ def replace_tags(filename_in,
     osm_new_notTagged = osmapis.OSM()
 
     for item in osm:
-        item.added_to_osm_new = False
-        key = ''
-        ssr_hovedgruppe = None
-        ssr_type = None
-        # if 'ssr:hovedgruppe' in item.tags:
-        #     ssr_hovedgruppe = item.tags['ssr:hovedgruppe']
-        #     key += ssr_hovedgruppe.lower()
-        if 'ssr:type' in item.tags:
-            ssr_type = item.tags['ssr:type']
-            key += ssr_type.lower()
-
-        # group_overview_key = ','.join([item.tags.get('ssr:hovedgruppe', ''),
-        #                                item.tags.get('ssr:gruppe', ''),
-        #                                item.tags.get('ssr:type', '')])
-        # group_overview_row = group_overview[group_overview_key]
-        # if len(group_overview_row) == 0: # first hit
-        #     # [item count, tags]
-        #     group_overview_row = [0, '']
-        # group_overview_tags = list()
-
-        if key != '' and key in conversion_dict:
-            tags = conversion_dict[key]
-            # if item.tags['name'] == 'Nord-Noreg;Nord-Norge':
-            #     print exclude_empty, len(tags) != 0, tags
-            #     exit(1)
-            if include_empty or len(tags) != 0:
-                new_tags = dict(item.tags)
-                # Moved:
-                # new_tags.pop('ssr:hovedgruppe', '')
-                # new_tags.pop('ssr:gruppe', '')
-                # new_tags.pop('ssr:type', '')
-                # new_tags.pop('ssr:sorting', '')
-                #new_tags.pop('ssr:stedsnr', '')
-                # new_tags.pop('ssr:date', '')
-
-                #new_tags.update(tags)
-                for key in sorted(tags.keys()):
-                    if key in new_tags:    # hmm, vops?
-                        if key == 'fixme': # ok, append
-                            new_tags[key] = '%s; %s' % (new_tags[key], tags[key])
-                        else:
-                            raise ValueError('Overwritting tag[%s] = %s not allowed' % (key, tags[key]))
-                    else:
-                        new_tags[key] = tags[key]
-                    # # Add to overview table
-                    # if ' ' in tags[key]:
-                    #     group_overview_tags.append('%s="%s"' % (key, tags[key]))
-                    # else:
-                    #     group_overview_tags.append('%s=%s' % (key, tags[key]))
-                    
-                item.tags = new_tags # NOTE: inplace!
-                #osm_new.add(item)
-                item.added_to_osm_new = True
-                copy_osm_element(osm, osm_new, item)
-            else:
-                logger.info('ssr:type = %s found in conversion table, but without tags', ssr_type)
+        new_tags = convert_element_tags(item, conversion_dict, include_empty=include_empty)
+        if new_tags is not None:
+            item.tags = new_tags # NOTE: inplace!
+            copy_osm_element(osm, osm_new, item)
         else:
-            if ssr_type is not None:
-                logger.warning('ssr:type = %s not found in conversion table', ssr_type)
-        
-        if not(item.added_to_osm_new):
             copy_osm_element(osm, osm_new_notTagged, item)
-
-        # group_overview_row[0] += 1
-        # s = ' '.join(group_overview_tags)
-        # if len(group_overview_row[1]) != 0 and group_overview_row[1] != s:
-        #     raise ValueError('Vops: different tags for the same group overview key: %s != %s' % (s, group_overview_row[1]))
-        # group_overview_row[1] = s
-        # group_overview[group_overview_key] = group_overview_row
     
     if len(osm_new) != 0:
         osm_new.save(filename_out)
@@ -192,6 +129,78 @@ def replace_tags(filename_in,
 
     return filename_out
 
+def convert_element_tags(item, conversion_dict, include_empty=False):
+    """Returns the osm tags for a single element, based on the conversion_dict entry for ssr:type,
+    or None if the element is not tagged (not found in conversion_dict or without any tags)."""
+    new_tags = None
+    key = ''
+    ssr_hovedgruppe = None
+    ssr_type = None
+    # if 'ssr:hovedgruppe' in item.tags:
+    #     ssr_hovedgruppe = item.tags['ssr:hovedgruppe']
+    #     key += ssr_hovedgruppe.lower()
+    if 'ssr:type' in item.tags:
+        ssr_type = item.tags['ssr:type']
+        key += ssr_type.lower()
+
+    # group_overview_key = ','.join([item.tags.get('ssr:hovedgruppe', ''),
+    #                                item.tags.get('ssr:gruppe', ''),
+    #                                item.tags.get('ssr:type', '')])
+    # group_overview_row = group_overview[group_overview_key]
+    # if len(group_overview_row) == 0: # first hit
+    #     # [item count, tags]
+    #     group_overview_row = [0, '']
+    # group_overview_tags = list()
+
+    if key != '' and key in conversion_dict:
+        tags = conversion_dict[key]
+        # if item.tags['name'] == 'Nord-Noreg;Nord-Norge':
+        #     print exclude_empty, len(tags) != 0, tags
+        #     exit(1)
+        if include_empty or len(tags) != 0:
+            new_tags = dict(item.tags)
+            # Moved:
+            # new_tags.pop('ssr:hovedgruppe', '')
+            # new_tags.pop('ssr:gruppe', '')
+            # new_tags.pop('ssr:type', '')
+            # new_tags.pop('ssr:sorting', '')
+            #new_tags.pop('ssr:stedsnr', '')
+            # new_tags.pop('ssr:date', '')
+
+            #new_tags.update(tags)
+            for key in sorted(tags.keys()):
+                if key in new_tags:    # hmm, vops?
+                    if key == 'fixme': # ok, append
+                        new_tags[key] = '%s; %s' % (new_tags[key], tags[key])
+                    else:
+                        raise ValueError('Overwritting tag[%s] = %s not allowed' % (key, tags[key]))
+                else:
+                    new_tags[key] = tags[key]
+                # # Add to overview table
+                # if ' ' in tags[key]:
+                #     group_overview_tags.append('%s="%s"' % (key, tags[key]))
+                # else:
+                #     group_overview_tags.append('%s=%s' % (key, tags[key]))
+                
+            #osm_new.add(item)
+        else:
+            logger.info('ssr:type = %s found in conversion table, but without tags', ssr_type)
+    else:
+        if ssr_type is not None:
+            logger.warning('ssr:type = %s not found in conversion table', ssr_type)
+
+    # group_overview_row[0] += 1
+    # s = ' '.join(group_overview_tags)
+    # if len(group_overview_row[1]) != 0 and group_overview_row[1] != s:
+    #     raise ValueError('Vops: different tags for the same group overview key: %s != %s' % (s, group_overview_row[1]))
+    # group_overview_row[1] = s
+    # group_overview[group_overview_key] = group_overview_row
+
+    return new_tags
+
+# ssr:* tags used for filtering and debugging, removed from the clean/ files
+debug_tags = ('ssr:hovedgruppe', 'ssr:gruppe', 'ssr:type', 'ssr:date')
+
 def get_conversion(excel_filename= None,
                    json_filename = '../ssr2osm/navnetyper_tagged.json'):
     table = None
@@ -0,0 +1,98 @@
+# Time spent in each stage of processing a kommune, accumulated per process in timings.
+# The stages are interleaved (the input is streamed), so each stage times its own calls, see stage and timed.
+import io
+import os
+import csv
+import json
+import time
+from collections import Counter
+
+stages = ('download', 'cleanup', 'manifest', 'unzip', 'parse', 'names', 'positions', 'projection',
+          'sted_cache', 'chunk_wait', 'tag_conversion', 'split', 'save')
+
+# seconds spent in each stage in this process
+timings = Counter()
+
+class stage(object):
+    """Context manager adding the time spent in the block to timings[name]"""
+    __slots__ = ('name', 'start')
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        timings[self.name] += time.perf_counter() - self.start
+
+def timed(iterable, name):
+    """Yields from iterable, adding the time spent getting each item to timings[name]"""
+    iterator = iter(iterable)
+    while True:
+        start = time.perf_counter()
+        try:
+            item = next(iterator)
+        except StopIteration:
+            timings[name] += time.perf_counter() - start
+            return
+        timings[name] += time.perf_counter() - start
+        yield item
+
+class timed_reader(object):
+    """Binary file-like object adding the time spent in f.read to timings[name], e.g. the decompression of
+    a zip input. The reads are made within stage 'within' (the parser reads as it parses), their time is moved
+    from timings[within] to timings[name]."""
+    __slots__ = ('f', 'name', 'within')
+
+    def __init__(self, f, name, within=None):
+        self.f = f
+        self.name = name
+        self.within = within
+
+    def read(self, size=-1):
+        start = time.perf_counter()
+        data = self.f.read(size)
+        elapsed = time.perf_counter() - start
+        timings[self.name] += elapsed
+        if self.within is not None:
+            timings[self.within] -= elapsed
+        return data
+
+    def close(self):
+        self.f.close()
+
+def stage_statistics(timings_start, timings_end):
+    """The time spent in each stage between two copies of timings, as a Counter with 'seconds_<stage>' keys"""
+    return Counter(dict(('seconds_%s' % name, timings_end[name] - timings_start[name])
+                        for name in stages))
+
+def load_report(state_dir):
+    """The rows of the previous <state_dir>/timing.json, or an empty list"""
+    try:
+        with io.open(os.path.join(state_dir, 'timing.json'), 'r', encoding='utf-8') as f:
+            return json.load(f)['kommuner']
+    except (IOError, ValueError, KeyError):
+        return list()
+
+def write_report(state_dir, rows):
+    """Writes the per-kommune timing rows, {'kommune': n, 'duration_seconds': ..., 'seconds_<stage>': ...},
+    to <state_dir>/timing.json and <state_dir>/timing.csv. The rows of the previous report are kept for the kommuner
+    not in rows, e.g. those done before a --resume."""
+    columns = ['kommune', 'duration_seconds'] + ['seconds_%s' % name for name in stages] + ['seconds_other']
+    merged = dict((row['kommune'], row) for row in load_report(state_dir))
+    merged.update((row['kommune'], row) for row in rows)
+    rows = sorted(merged.values(), key=lambda row: row['kommune'])
+    for row in rows:
+        row['seconds_other'] = row['duration_seconds'] - sum(row.get('seconds_%s' % name, 0) for name in stages)
+
+    totals = dict((column, sum(row.get(column, 0) for row in rows)) for column in columns[1:])
+    with io.open(os.path.join(state_dir, 'timing.json'), 'w', encoding='utf-8') as f:
+        json.dump({'kommuner': rows, 'total': totals}, f, indent=1, sort_keys=True)
+
+    with io.open(os.path.join(state_dir, 'timing.csv'), 'w', encoding='utf-8', newline='') as f:
+        w = csv.writer(f)
+        w.writerow(columns)
+        for row in rows:
+            w.writerow([row['kommune']] + ['%.3f' % row.get(column, 0) for column in columns[1:]])
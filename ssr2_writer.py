@@ -0,0 +1,154 @@
+# Incremental .osm writer, elements are written as they arrive instead of first
+# collecting everything in a osmapis.OSM object and calling OSM.save.
+import io
+import os
+import functools
+import logging
+logger = logging.getLogger('utility_to_osm.ssr2.ssr2_writer')
+
+from xml.sax.saxutils import quoteattr
+from xml.etree import ElementTree
+
+from utility_to_osm import osmapis
+
+# ssr2 only creates nodes and ways
+element_types = ((osmapis.Node, 'node'),
+                 (osmapis.Way, 'way'))
+
+def element_type(item):
+    for cls, name in element_types:
+        if isinstance(item, cls):
+            return name
+    raise ValueError('Expected Node or Way, got = %s' % type(item))
+
+@functools.lru_cache(maxsize=None)
+def header():
+    """The start of the file, with the <osm> attributes (e.g. the generator) written by osmapis OSM.save"""
+    root = osmapis.OSM().to_xml()
+    if isinstance(root, (str, bytes)):
+        root = ElementTree.fromstring(root)
+    attribs = ' '.join('%s=%s' % (key, quoteattr(str(value))) for key, value in root.attrib.items())
+    return '<?xml version="1.0" encoding="UTF-8"?>\n<osm %s>\n' % attribs
+
+def to_xml(item, tags=None):
+    """Serialize a single osmapis element, optionally with the given tags instead of item.tags,
+    the tags are sorted by key as by osmapis"""
+    if tags is None:
+        tags = item.tags
+    name = element_type(item)
+
+    attribs = ['id=%s' % quoteattr(str(item.id))]
+    for key, value in item.attribs.items():
+        if key != 'id':
+            attribs.append('%s=%s' % (key, quoteattr(str(value))))
+
+    children = list()
+    if name == 'way':
+        for ref in item.nds:
+            children.append('    <nd ref=%s/>' % quoteattr(str(ref)))
+    for key, value in sorted(tags.items()):
+        children.append('    <tag k=%s v=%s/>' % (quoteattr(key), quoteattr(str(value))))
+
+    if len(children) == 0:
+        return '  <%s %s/>\n' % (name, ' '.join(attribs))
+    return '  <%s %s>\n%s\n  </%s>\n' % (name, ' '.join(attribs), '\n'.join(children), name)
+
+class OSMWriter(object):
+    """Writes osmapis elements to filename as they arrive (order='arrival'),
+    or sorted by type (node, way) and id when closed (order='id').
+    The file is only created once the first element is written, like OSM.save is only
+    called for non-empty results.
+    With order='arrival' the caller is responsible for writing the nodes of a way before the way.
+    """
+    footer = '</osm>\n'
+
+    def __init__(self, filename, order='arrival'):
+        if order not in ('arrival', 'id'):
+            raise ValueError('Expected order to be "arrival" or "id", got "%s"' % order)
+        self.filename = filename
+        self.order = order
+        self.count = 0
+        self._f = None
+        self._buffer = list()   # (type index, id, xml) for order='id'
+
+    def write(self, item, tags=None):
+        """Write a single element, see to_xml"""
+        xml = to_xml(item, tags=tags)
+        if self.order == 'id':
+            type_ix = [name for _, name in element_types].index(element_type(item))
+            self._buffer.append((type_ix, item.id, xml))
+        else:
+            if self._f is None:
+                self._open()
+            self._f.write(xml)
+        self.count += 1
+
+    def write_all(self, items):
+        for item in items:
+            self.write(item)
+
+    def _open(self):
+        self._f = io.open(self.filename, 'w', encoding='utf-8')
+        self._f.write(header())
+
+    def close(self):
+        if self.order == 'id' and len(self._buffer) != 0:
+            self._open()
+            self._buffer.sort(key=lambda x: x[:2])
+            for _, _, xml in self._buffer:
+                self._f.write(xml)
+            self._buffer = list()
+
+        if self._f is not None:
+            self._f.write(self.footer)
+            self._f.close()
+            self._f = None
+
+    def __len__(self):
+        return self.count
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+class OSMSinks(object):
+    """A set of OSMWriter's keyed by filename, each opened on first use"""
+    def __init__(self, order='arrival'):
+        self.order = order
+        self.writers = dict()
+
+    def write(self, filename, item, tags=None):
+        try:
+            writer = self.writers[filename]
+        except KeyError:
+            writer = self.writers[filename] = OSMWriter(filename, order=self.order)
+        writer.write(item, tags=tags)
+
+    def count(self, filename):
+        try:
+            return len(self.writers[filename])
+        except KeyError:
+            return 0
+
+    def filenames(self):
+        """The filenames with at least one element"""
+        return [filename for filename, writer in self.writers.items() if len(writer) != 0]
+
+    def close(self):
+        for writer in self.writers.values():
+            writer.close()
+
+    def remove(self):
+        """Close and remove all files"""
+        self.close()
+        for filename in self.filenames():
+            if os.path.exists(filename):
+                os.remove(filename)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
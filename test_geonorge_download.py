@@ -0,0 +1,250 @@
+# Tests of the downloads in geonorge_download against a local http.server stand-in, run with pytest
+import io
+import os
+import zipfile
+import threading
+import http.server
+import urllib.parse
+import multiprocessing
+
+import pytest
+from lxml import etree
+
+# geonorge_download needs the utility_to_osm helper library, see install.sh
+pytest.importorskip('utility_to_osm')
+import geonorge_download
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    """Serves server.routes, {path: function(handler) -> (status, headers, body)}, and records each request"""
+    def do_GET(self):
+        path = urllib.parse.urlparse(self.path).path
+        self.server.requests.append((path, dict(self.headers)))
+        status, headers, body = self.server.routes[path](self)
+        self.send_response(status)
+        headers.setdefault('Content-Length', str(len(body)))
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+@pytest.fixture
+def server():
+    httpd = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    httpd.routes = dict()
+    httpd.requests = list()
+    httpd.url = 'http://127.0.0.1:%s' % httpd.server_address[1]
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield httpd
+    httpd.shutdown()
+    httpd.server_close()
+
+@pytest.fixture(autouse=True)
+def download_settings(monkeypatch):
+    """No waiting, and the statistics of a single test"""
+    delays = list()
+    monkeypatch.setattr(geonorge_download.time, 'sleep', delays.append)
+    geonorge_download.configure_retries(retries=2, backoff=1., max_backoff=120.)
+    geonorge_download.configure_rate_limit(min_interval=0)
+    geonorge_download.statistics.clear()
+    yield delays
+    geonorge_download.configure_retries()
+    geonorge_download.configure_rate_limit()
+
+def wfs_response(members, number_matched):
+    return (b'<?xml version="1.0" encoding="UTF-8"?>\n'
+            b'<wfs:FeatureCollection xmlns:wfs="http://www.opengis.net/wfs/2.0" xmlns:app="http://skjema.geonorge.no/SOSI/produktspesifikasjon/Stedsnavn/5.0" '
+            b'numberMatched="%d" numberReturned="%d">\n' % (number_matched, len(members))
+            + b''.join(b'<wfs:member><app:Sted><app:stedsnummer>%d</app:stedsnummer></app:Sted></wfs:member>\n' % ix
+                       for ix in members)
+            + b'</wfs:FeatureCollection>\n')
+
+def wfs(n):
+    """A WFS GetFeature stand-in with n <Sted>, with WFS 2.0 paging, which requires a sort order"""
+    def route(handler):
+        query = urllib.parse.parse_qs(urllib.parse.urlparse(handler.path).query)
+        if 'count' in query and query.get('sortBy') != ['app:stedsnummer']:
+            return 400, {}, b'paging without sortBy'
+        start = int(query.get('startIndex', ['0'])[0])
+        count = int(query.get('count', [str(n)])[0])
+        return 200, {}, wfs_response(range(start, min(n, start + count)), n)
+    return route
+
+def zip_file(size=3000):
+    f = io.BytesIO()
+    with zipfile.ZipFile(f, 'w') as z:
+        z.writestr('Basisdata_0301_Oslo_25832_Stedsnavn_GML.gml', os.urandom(size))
+    return f.getvalue()
+
+def test_revalidation_not_modified(server, tmp_path):
+    body = wfs_response(range(10), 10)
+    def route(handler):
+        if handler.headers.get('If-None-Match') == '"v1"':
+            return 304, {'Content-Length': '0'}, b''
+        return 200, {'ETag': '"v1"'}, body
+    server.routes['/data.xml'] = route
+    filename = str(tmp_path / 'data.xml')
+
+    assert geonorge_download.get_cached_conditional(server.url + '/data.xml', filename) == filename
+    assert geonorge_download.get_cached_conditional(server.url + '/data.xml', filename, old_age_days=0) == filename
+
+    assert len(server.requests) == 2
+    assert server.requests[1][1]['If-None-Match'] == '"v1"'
+    assert geonorge_download.statistics['http_not_modified'] == 1
+    assert geonorge_download.statistics['http_bytes_saved'] == len(body)
+    with open(filename, 'rb') as f:
+        assert f.read() == body
+
+def test_fresh_cache_without_request(server, tmp_path):
+    server.routes['/data.xml'] = lambda handler: (200, {}, b'data')
+    filename = str(tmp_path / 'data.xml')
+    geonorge_download.get_cached_conditional(server.url + '/data.xml', filename)
+    geonorge_download.get_cached_conditional(server.url + '/data.xml', filename)
+    assert len(server.requests) == 1
+
+def test_zip_revalidation(server, tmp_path):
+    data = zip_file()
+    def route(handler):
+        if handler.headers.get('If-Modified-Since') == 'Mon, 01 Jan 2018 00:00:00 GMT':
+            return 304, {'Content-Length': '0'}, b''
+        return 200, {'Last-Modified': 'Mon, 01 Jan 2018 00:00:00 GMT'}, data
+    server.routes['/0301.zip'] = route
+    filename = str(tmp_path / '0301.zip')
+
+    with geonorge_download.download_unzip_geonorge_stream(server.url + '/0301.zip', filename) as f:
+        assert len(f.read()) == 3000
+    assert geonorge_download.get_cached_conditional(server.url + '/0301.zip', filename, old_age_days=0) == filename
+    assert geonorge_download.statistics['http_bytes_saved'] == len(data)
+
+def members(filename):
+    return [etree.tostring(member, with_tail=False) for member in etree.parse(filename).getroot()]
+
+def test_paged_merge_equals_unpaged(server, tmp_path):
+    server.routes['/wfs'] = wfs(23)
+    url = geonorge_download.legacy_url('0301', base_url=server.url + '/wfs')
+    unpaged = str(tmp_path / 'unpaged' / '0301-ssr.xml')
+    paged = str(tmp_path / 'paged' / '0301-ssr.xml')
+    os.makedirs(os.path.dirname(unpaged))
+    os.makedirs(os.path.dirname(paged))
+
+    geonorge_download.legacy_download_geonorge_stream('0301', unpaged, url=url).close()
+    geonorge_download.legacy_download_geonorge_stream('0301', paged, url=url, page_size=5, page_parallel=2).close()
+
+    assert len(server.requests) == 1 + 5
+    assert len(members(unpaged)) == 23
+    assert members(paged) == members(unpaged)
+    assert etree.parse(paged).getroot().get('numberReturned') is None
+    assert not(os.path.exists(os.path.join(os.path.dirname(paged), '0301-ssr-pages')))
+
+    # the merged file is reused
+    geonorge_download.legacy_download_geonorge_stream('0301', paged, url=url, page_size=5, page_parallel=2).close()
+    assert len(server.requests) == 1 + 5
+
+def test_pages_changed_while_paging(server, tmp_path):
+    # a <Sted> is added after the first page was fetched
+    routes = [wfs(23)] + [wfs(24)]*9
+    server.routes['/wfs'] = lambda handler: routes.pop(0)(handler)
+    url = geonorge_download.legacy_url('0301', base_url=server.url + '/wfs')
+    filename = str(tmp_path / '0301-ssr.xml')
+
+    geonorge_download.legacy_download_geonorge_stream('0301', filename, url=url, page_size=5, page_parallel=2).close()
+    assert len(server.requests) == 5 + 5
+    assert geonorge_download.statistics['http_page_refetch'] == 1
+    assert len(members(filename)) == 24
+
+def test_pages_that_do_not_add_up(server, tmp_path):
+    # the first page always disagrees with the others
+    first, others = wfs(23), wfs(24)
+    def route(handler):
+        return (first if 'startIndex=0' in handler.path else others)(handler)
+    server.routes['/wfs'] = route
+    url = geonorge_download.legacy_url('0301', base_url=server.url + '/wfs')
+    filename = str(tmp_path / '0301-ssr.xml')
+
+    with pytest.raises(geonorge_download.DownloadFailed):
+        geonorge_download.legacy_download_geonorge_stream('0301', filename, url=url, page_size=5, page_parallel=2)
+    assert len(server.requests) == 5 + 5
+    assert not(os.path.exists(filename))
+
+def test_retry_with_backoff_then_success(server, tmp_path, download_settings):
+    responses = [(503, {}, b'busy'), (200, {}, b'data')]
+    server.routes['/data.xml'] = lambda handler: responses.pop(0)
+    filename = str(tmp_path / 'data.xml')
+
+    assert geonorge_download.get_cached_conditional(server.url + '/data.xml', filename) == filename
+    assert len(server.requests) == 2
+    assert geonorge_download.statistics['http_retries'] == 1
+    assert len(download_settings) == 1 and 0.5 <= download_settings[0] <= 1.
+
+def test_retry_with_backoff_then_failure(server, tmp_path, download_settings):
+    server.routes['/data.xml'] = lambda handler: (503, {}, b'busy')
+    filename = str(tmp_path / 'data.xml')
+
+    with pytest.raises(geonorge_download.DownloadFailed):
+        geonorge_download.get_cached_conditional(server.url + '/data.xml', filename)
+    assert len(server.requests) == 3
+    assert geonorge_download.statistics['http_retries'] == 2
+    # exponential backoff with jitter, 1 s then 2 s
+    assert 0.5 <= download_settings[0] <= 1. and 1. <= download_settings[1] <= 2.
+    assert not(os.path.exists(filename))
+
+def test_no_retry_on_not_found(server, tmp_path):
+    server.routes['/data.xml'] = lambda handler: (404, {}, b'not found')
+    with pytest.raises(geonorge_download.DownloadFailed):
+        geonorge_download.get_cached_conditional(server.url + '/data.xml', str(tmp_path / 'data.xml'))
+    assert len(server.requests) == 1
+
+def test_retry_budget(server, tmp_path):
+    server.routes['/data.xml'] = lambda handler: (503, {}, b'busy')
+    geonorge_download.configure_retries(retries=2, budget=multiprocessing.Value('i', 1))
+
+    for name in ('a.xml', 'b.xml'):
+        with pytest.raises(geonorge_download.DownloadFailed):
+            geonorge_download.get_cached_conditional(server.url + '/data.xml', str(tmp_path / name))
+    assert len(server.requests) == 2 + 1
+    assert geonorge_download.statistics['http_retry_budget_exhausted'] == 2
+
+def test_validate_zip():
+    data = zip_file()
+    assert geonorge_download.validate_zip(data[-geonorge_download.tail_size:], len(data)) is None
+    truncated = data[:-10]
+    assert geonorge_download.validate_zip(truncated[-geonorge_download.tail_size:], len(truncated)) is not None
+    missing = data[:100] + data[200:]
+    assert geonorge_download.validate_zip(missing[-geonorge_download.tail_size:], len(missing)) is not None
+
+def test_truncated_zip_rejected(server, tmp_path):
+    data = zip_file()
+    server.routes['/good.zip'] = lambda handler: (200, {}, data)
+    server.routes['/truncated.zip'] = lambda handler: (200, {}, data[:-10])
+
+    filename = str(tmp_path / 'good.zip')
+    with geonorge_download.download_unzip_geonorge_stream(server.url + '/good.zip', filename) as f:
+        assert len(f.read()) == 3000
+
+    filename = str(tmp_path / 'truncated.zip')
+    with pytest.raises(geonorge_download.DownloadFailed):
+        geonorge_download.download_unzip_geonorge_stream(server.url + '/truncated.zip', filename)
+    assert len(server.requests) == 1 + 3
+    assert geonorge_download.statistics['http_invalid_content'] == 3
+    assert not(os.path.exists(filename)) and not(os.path.exists(filename + '.part'))
+
+def test_short_body_rejected(server, tmp_path):
+    def route(handler):
+        handler.close_connection = True     # after the short body
+        return 200, {'Content-Length': '100'}, b'data'
+    server.routes['/data.xml'] = route
+    with pytest.raises(geonorge_download.DownloadFailed):
+        geonorge_download.get_cached_conditional(server.url + '/data.xml', str(tmp_path / 'data.xml'))
+    assert len(server.requests) == 3
+
+def test_rate_limit(server, tmp_path, download_settings):
+    server.routes['/data.xml'] = lambda handler: (200, {}, b'data')
+    geonorge_download.configure_rate_limit(min_interval=10.)
+    for name in ('a.xml', 'b.xml', 'c.xml'):
+        geonorge_download.get_cached_conditional(server.url + '/data.xml', str(tmp_path / name))
+    # the first request starts at once, the next two are given the following slots
+    assert len(download_settings) == 2
+    assert 9. < download_settings[0] <= 10. and 19. < download_settings[1] <= 20.
@@ -0,0 +1,67 @@
+# Tests of the unchanged-input check in ssr2_manifest, run with pytest
+import os
+import gzip
+import zipfile
+import argparse
+
+import pytest
+
+# ssr2_manifest reads .zip input with geonorge_download, which needs the utility_to_osm helper library, see install.sh
+pytest.importorskip('utility_to_osm')
+import ssr2_manifest
+
+def wfs_response(time_stamp, members=(1, 2, 3)):
+    """A WFS GetFeature response, geonorge sets timeStamp to the time of each request"""
+    return (b'<?xml version="1.0" encoding="UTF-8"?>\n'
+            b'<wfs:FeatureCollection xmlns:wfs="http://www.opengis.net/wfs/2.0" xmlns:app="http://skjema.geonorge.no/SOSI/produktspesifikasjon/Stedsnavn/5.0" '
+            b'timeStamp="%s" numberMatched="%d" numberReturned="%d">\n' % (time_stamp, len(members), len(members))
+            + b''.join(b'<wfs:member><app:Sted><app:stedsnummer>%d</app:stedsnummer></app:Sted></wfs:member>\n' % ix
+                       for ix in members)
+            + b'</wfs:FeatureCollection>\n')
+
+def args():
+    return argparse.Namespace(**dict((key, None) for key in ssr2_manifest.manifest_args))
+
+def download(filename, data, mtime):
+    with open(filename, 'wb') as f:
+        f.write(data)
+    os.utime(filename, (mtime, mtime))
+
+def run(folder, input_filename):
+    """The manifest part of ssr2.main, returns True if the kommune is skipped"""
+    previous = ssr2_manifest.load_manifest(folder, '0301')
+    manifest = ssr2_manifest.create_manifest(input_filename, {}, args(), previous=previous)
+    if ssr2_manifest.is_unchanged(folder, manifest, previous):
+        return True
+    output = os.path.join(folder, '0301.osm')
+    with open(output, 'w') as f:
+        f.write('<osm/>')
+    ssr2_manifest.save_manifest(folder, '0301', manifest, [output])
+    return False
+
+def test_new_time_stamp_is_unchanged(tmp_path):
+    folder = str(tmp_path)
+    filename = os.path.join(folder, '0301-ssr.xml')
+
+    download(filename, wfs_response(b'2024-01-01T10:00:00.000Z'), 1000)
+    assert not(run(folder, filename))
+    download(filename, wfs_response(b'2024-01-02T11:22:33.456Z'), 2000)
+    assert run(folder, filename)
+
+    download(filename, wfs_response(b'2024-01-03T10:00:00.000Z', members=(1, 2, 4)), 3000)
+    assert not(run(folder, filename))
+
+def test_content_sha256_formats(tmp_path):
+    xml_filename = str(tmp_path / 'a.xml')
+    download(xml_filename, wfs_response(b'2024-01-01T10:00:00.000Z'), 1000)
+
+    gz_filename = str(tmp_path / 'b.xml.gz')
+    with gzip.open(gz_filename, 'wb') as f:
+        f.write(wfs_response(b'2024-01-02T10:00:00.000Z'))
+
+    zip_filename = str(tmp_path / 'c.zip')
+    with zipfile.ZipFile(zip_filename, 'w') as z:
+        z.writestr('Basisdata_0301_Oslo_25832_Stedsnavn_GML.gml', wfs_response(b'2024-01-03T10:00:00.000Z'))
+
+    hashes = set(ssr2_manifest.content_sha256(filename) for filename in (xml_filename, gz_filename, zip_filename))
+    assert len(hashes) == 1
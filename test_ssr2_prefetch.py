@@ -0,0 +1,89 @@
+# Tests of the download stage of the --parallel pipeline against a local http.server stand-in, run with pytest
+import time
+import threading
+import http.server
+import urllib.request
+
+import pytest
+
+import ssr2_prefetch
+
+class SlowHandler(http.server.BaseHTTPRequestHandler):
+    """Answers each request after a short delay, counting the concurrent requests"""
+    def do_GET(self):
+        with self.server.lock:
+            self.server.active += 1
+            self.server.max_active = max(self.server.max_active, self.server.active)
+        time.sleep(0.1)
+        with self.server.lock:
+            self.server.active -= 1
+        body = self.path.encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+@pytest.fixture
+def server():
+    httpd = http.server.ThreadingHTTPServer(('127.0.0.1', 0), SlowHandler)
+    httpd.lock = threading.Lock()
+    httpd.active = 0
+    httpd.max_active = 0
+    httpd.url = 'http://127.0.0.1:%s' % httpd.server_address[1]
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield httpd
+    httpd.shutdown()
+    httpd.server_close()
+
+def test_concurrent_downloads(server):
+    fetched = dict()
+    def fetch(job):
+        with urllib.request.urlopen('%s/%s' % (server.url, job)) as r:
+            fetched[job] = r.read()
+
+    prefetcher = ssr2_prefetch.Prefetcher(fetch, parallel=3, queue_depth=6)
+    jobs = ['%04d' % n for n in range(6)]
+    for job, duration, error in prefetcher.iter_fetched(jobs):
+        assert error is None and duration > 0
+        prefetcher.release()
+
+    assert fetched == dict((job, ('/' + job).encode('utf-8')) for job in jobs)
+    assert server.max_active == 3
+
+def test_queue_depth(server):
+    lock = threading.Lock()
+    state = {'unreleased': 0, 'max_unreleased': 0}
+    def fetch(job):
+        with urllib.request.urlopen('%s/%s' % (server.url, job)) as r:
+            r.read()
+        with lock:
+            state['unreleased'] += 1
+            state['max_unreleased'] = max(state['max_unreleased'], state['unreleased'])
+
+    prefetcher = ssr2_prefetch.Prefetcher(fetch, parallel=4, queue_depth=2)
+    for job, duration, error in prefetcher.iter_fetched(range(8)):
+        time.sleep(0.05)        # the processing of the job
+        with lock:
+            state['unreleased'] -= 1
+        prefetcher.release()
+
+    # at most queue_depth jobs are downloaded (or downloading) but not yet processed
+    assert state['max_unreleased'] <= 2
+    assert server.max_active <= 2
+
+def test_failed_download():
+    def fetch(job):
+        if job == 'bad':
+            raise IOError('unable to download %s' % job)
+
+    prefetcher = ssr2_prefetch.Prefetcher(fetch, parallel=2, queue_depth=2)
+    results = dict()
+    for job, duration, error in prefetcher.iter_fetched(['good', 'bad']):
+        results[job] = error
+        prefetcher.release()
+    assert results['good'] is None
+    assert isinstance(results['bad'], IOError)
@@ -0,0 +1,40 @@
+# Tests of the content-addressed raw input store in ssr2_raw_store, run with pytest
+import os
+
+import pytest
+
+# ssr2_raw_store reads the download metadata with geonorge_download, which needs the utility_to_osm helper library, see install.sh
+pytest.importorskip('utility_to_osm')
+import ssr2_raw_store
+
+def wfs_response(time_stamp, members=(1, 2, 3)):
+    return (b'<?xml version="1.0" encoding="UTF-8"?>\n'
+            b'<wfs:FeatureCollection xmlns:wfs="http://www.opengis.net/wfs/2.0" timeStamp="%s" numberMatched="%d">\n'
+            % (time_stamp, len(members))
+            + b''.join(b'<wfs:member><Sted><stedsnummer>%d</stedsnummer></Sted></wfs:member>\n' % ix for ix in members)
+            + b'</wfs:FeatureCollection>\n')
+
+def put(store, n, data, tmp_path):
+    filename = str(tmp_path / ('%s-ssr.xml' % n))
+    with open(filename, 'wb') as f:
+        f.write(data)
+    return store.put(n, filename)
+
+def test_new_time_stamp_is_stored_once(tmp_path):
+    ssr2_raw_store.statistics.clear()
+    store = ssr2_raw_store.RawStore(str(tmp_path / 'store'))
+
+    first = put(store, '0301', wfs_response(b'2024-01-01T10:00:00.000Z'), tmp_path)
+    second = put(store, '0301', wfs_response(b'2024-01-02T11:22:33.456Z'), tmp_path)
+    assert second['object'] == first['object']
+    assert ssr2_raw_store.statistics['raw_store_objects'] == 1
+    assert ssr2_raw_store.statistics['raw_store_dedup'] == 1
+
+    changed = put(store, '0301', wfs_response(b'2024-01-03T10:00:00.000Z', members=(1, 2, 4)), tmp_path)
+    assert changed['object'] != first['object']
+    with store.open(changed) as f:
+        assert f.read() == wfs_response(b'2024-01-03T10:00:00.000Z', members=(1, 2, 4))
+
+    # the first object is no longer pointed to
+    assert store.evict(max_age_days=-1) == 1
+    assert os.path.exists(changed['object'])